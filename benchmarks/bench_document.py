@@ -0,0 +1,142 @@
+"""Micro-benchmark of the header handling of a single file.
+
+Compares the per-step helpers of the baseline (commit 6262544, copied
+verbatim below), which open the file once per step, with a
+MarkdownDocument that reads it once and writes it once.
+
+  PYTHONPATH=. python benchmarks/bench_document.py [FILES]
+"""
+import os
+import re
+import sys
+import shutil
+import tempfile
+import time
+
+from supermutes import dot
+from typing import List, Tuple
+
+import mark2confluence.main as main
+from mark2confluence.main import ParentCfg
+
+CONTENT = """<!-- Title: Page {index} -->
+<!-- Parent: Section -->
+
+<!-- Macro: <warning>\\s*(.+)\\s*</warning>
+     Template: ac:box
+     Name: note
+     Body: ${{1}}
+-->
+
+# Page {index}
+
+""" + "Some text in a paragraph.\n\n" * 40
+
+
+def generate(directory: str, count: int) -> list:
+  paths = []
+  for index in range(count):
+    subdir = os.path.join(directory, "docs", f"section-{index % 20}")
+    os.makedirs(subdir, exist_ok=True)
+    path = os.path.join(subdir, f"page-{index}.md")
+    with open(path, "w") as f:
+      f.write(CONTENT.format(index=index))
+    paths.append(path)
+  return paths
+
+
+# baseline helpers, verbatim from mark2confluence/main.py at commit 6262544:
+# the helpers of the current module are wrappers around MarkdownDocument
+def begins_with_mark_headers(path: str, headers: List[str] = ["Space", "Parent", "Title"]) -> bool:
+  with open(path, 'r+') as f:
+    first_row = f.readline()
+    for header in headers:
+      regex = re.compile(f"^<!--.?{header}:.*-->", re.IGNORECASE)
+      if regex.match(first_row):
+        return True
+  return False
+
+def begins_with_mark_space_header(path: str):
+  return begins_with_mark_headers(path, ["Space"])
+
+class MultilineCommentIsOpenException(Exception):
+    pass
+
+def inject_header_before_first_line_of_content(path: str, header: str) -> Tuple[List[str], int]:
+  def is_comment_line(line: str) -> bool:
+    return re.compile("^<!--.*-->$").match(line.strip())
+  def is_opening_comment_line(line: str) -> bool:
+    return re.compile("^<!--").match(line.strip()) and not is_comment_line(line)
+  def is_closing_comment_line(line: str) -> bool:
+    return re.compile("-->$").match(line.strip()) and not is_comment_line(line)
+
+  file_lines = list()
+  with open(path, 'r') as f:
+    file_lines = f.readlines()
+
+  beginning_of_content_index = 0
+  is_inside_multiline_comment = False
+  for line in file_lines:
+      if is_opening_comment_line(line):
+        is_inside_multiline_comment = True
+      elif is_closing_comment_line(line):
+        is_inside_multiline_comment = False
+      elif line.strip() != "" and not is_inside_multiline_comment and not is_comment_line(line):
+        break
+      beginning_of_content_index += 1
+
+  if is_inside_multiline_comment:
+    raise MultilineCommentIsOpenException(f"The file {path} has multiline comments in it that are not closed.")
+
+  file_lines.insert(beginning_of_content_index, header)
+  with open(path, "w") as f:
+    f.writelines(file_lines)
+  return (file_lines, beginning_of_content_index)
+
+def inject_default_parents(path: str, default_parents_cfg: List[ParentCfg]):
+  file_dir = f"{os.path.dirname(os.path.abspath(path))}"
+  for parent_cfg in default_parents_cfg:
+    if parent_cfg.is_directory_included(file_dir) and not begins_with_mark_space_header(path):
+      header = parent_cfg.get_header()
+      with open(path, 'r') as f:
+        file_content = f.read()
+      file_content = f"{header}{file_content}"
+      with open(path, "w") as f:
+        f.write(file_content)
+      return
+
+
+def per_step(paths: list, default_parents: list, header: str):
+  for path in paths:
+    if begins_with_mark_headers(path):
+      inject_default_parents(path, default_parents)
+      inject_header_before_first_line_of_content(path, header)
+
+
+def single_pass(paths: list, default_parents: list, header: str):
+  for path in paths:
+    document = main.MarkdownDocument.load(path)
+    if document.begins_with_mark_headers():
+      document.inject_default_parents(default_parents)
+      document.inject_header(header)
+      document.save()
+
+
+def run(count: int):
+  header = main.DEFAULT_INPUTS["HEADER_TEMPLATE"]
+  for name, pipeline in [("baseline helpers", per_step), ("MarkdownDocument", single_pass)]:
+    workspace = tempfile.mkdtemp()
+    try:
+      main.cfg = dot.dotify({"github": {"WORKSPACE": workspace}})
+      default_parents = main.get_default_parents("docs/*=DOCS->Root\ndocs/section-1/=DOCS->Root->One")
+      paths = generate(workspace, count)
+      start = time.perf_counter()
+      pipeline(paths, default_parents, header)
+      elapsed = time.perf_counter() - start
+      print(f"{name:<18} {count} files in {elapsed:.3f}s ({count / elapsed:,.0f} files/s)")
+    finally:
+      shutil.rmtree(workspace)
+
+
+if __name__ == "__main__":
+  run(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
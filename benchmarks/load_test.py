@@ -0,0 +1,90 @@
+"""Load test of the publish path against the local fake Confluence server.
+
+Publishes a synthetic tree through main() with CONFLUENCE_BASE_URL pointing to
+tests/fake_confluence.py, optionally injecting latency, 429 and 503 responses,
+and reports the throughput, the API calls per page and the retries.
+Uses the mark emulator of the fake server unless --real-mark is given.
+
+  PYTHONPATH=. python benchmarks/load_test.py --files 1000 --latency 0.005 --throttle-rate 0.01 --concurrency 8
+"""
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+from loguru import logger
+
+from benchmarks.run import parse_inputs, run_main
+from benchmarks.synthetic import generate_tree, get_default_parents
+from tests.fake_confluence import FakeConfluence, install_mark_emulator
+
+
+def load_test(args) -> dict:
+  workspace = tempfile.mkdtemp(prefix="mark2confluence-load-")
+  try:
+    generate_tree(workspace, args.files, args.seed)
+    if not args.real_mark:
+      bin_dir = os.path.join(workspace, "bin")
+      install_mark_emulator(bin_dir)
+      os.environ["PATH"] = f"{bin_dir}{os.pathsep}{os.environ['PATH']}"
+
+    with FakeConfluence(spaces=["DOCS"], latency=args.latency, throttle_rate=args.throttle_rate,
+                        error_rate=args.error_rate, seed=args.seed, password="token") as confluence:
+      started = time.perf_counter()
+      lines = run_main(workspace, {
+        "DOC_DIR": "docs",
+        "ACTION": "publish",
+        "DEFAULT_PARENTS": get_default_parents(),
+        "CONFLUENCE_BASE_URL": confluence.url,
+        "CONFLUENCE_PASSWORD": "token",
+        "CONCURRENCY": str(args.concurrency),
+        "STAGING": "true",
+        "RETRY_BACKOFF": "0.1",
+        **parse_inputs(args.input),
+      })
+      duration = time.perf_counter() - started
+  finally:
+    shutil.rmtree(workspace, ignore_errors=True)
+
+  files = [line for line in lines if line["type"] == "file" and line["outcome"] in ("success", "failure")]
+  per_page = [count for title, count in confluence.requests_per_page().items() if title.startswith("page-")]
+  return {
+    "published": sum(line["outcome"] == "success" for line in files),
+    "failed": sum(line["outcome"] == "failure" for line in files),
+    "retries": sum(line["retries"] for line in files),
+    "duration": duration,
+    "publish": lines[-1]["phases"].get("publish", 0),
+    "calls": len(confluence.calls),
+    "statuses": dict(sorted(confluence.statuses().items())),
+    "per_page_mean": statistics.mean(per_page) if per_page else 0,
+    "per_page_max": max(per_page, default=0),
+  }
+
+
+def main_load_test():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--files", type=int, default=500)
+  parser.add_argument("--latency", type=float, default=0, help="seconds added to each API response")
+  parser.add_argument("--throttle-rate", type=float, default=0, help="share of the API calls answered with 429")
+  parser.add_argument("--error-rate", type=float, default=0, help="share of the API calls answered with 503")
+  parser.add_argument("--concurrency", type=int, default=8)
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--real-mark", action="store_true", help="use the mark binary found on PATH")
+  parser.add_argument("--input", action="append", default=[], metavar="NAME=VALUE", help="extra action input, e.g. RETRIES=5")
+  args = parser.parse_args()
+
+  logger.remove()
+  logger.add(sys.stderr, level="ERROR")
+
+  result = load_test(args)
+  publish = result["publish"]
+  print(f"published: {result['published']} | failed: {result['failed']} | retries: {result['retries']}")
+  print(f"publish phase: {publish:.1f}s ({result['published'] / publish if publish else 0:,.1f} pages/s) | total: {result['duration']:.1f}s")
+  print(f"API calls: {result['calls']} | per page: {result['per_page_mean']:.1f} mean, {result['per_page_max']} max | statuses: {result['statuses']}")
+
+
+if __name__ == "__main__":
+  main_load_test()
@@ -0,0 +1,127 @@
+"""End to end benchmark of main() against synthetic trees and a stub mark.
+
+Runs offline: mark is replaced by a shell script sleeping --latency seconds.
+Reports the files per second of discovery, preprocessing (header injection,
+template and mermaid rendering, cache lookup) and publish orchestration, and the
+delay before the first page is published.
+
+  PYTHONPATH=. python benchmarks/run.py --sizes 100 10000 100000 --latency 0.01 --concurrency 8
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from loguru import logger
+from supermutes import dot
+
+import mark2confluence.main as main
+from benchmarks.synthetic import generate_tree, get_default_parents, install_stub_mark
+
+PREPROCESSING_PHASES = ["header injection", "template rendering", "mermaid rendering", "cache lookup"]
+
+
+def rate(count: int, seconds: float) -> str:
+  return f"{count / seconds:,.0f}" if seconds > 0 else "-"
+
+
+def run_main(workspace: str, inputs: dict) -> list:
+  """Run main() in process with the given inputs, return the lines of the report, the summary last."""
+  report_path = os.path.join(workspace, "report.jsonl")
+  environ = dict(os.environ)
+  try:
+    for key in [key for key in os.environ if key.startswith(("INPUT_", "GITHUB_"))]:
+      del os.environ[key]
+    os.environ["GITHUB_WORKSPACE"] = workspace
+    os.environ["INPUT_REPORT_PATH"] = "report.jsonl"
+    for key, value in inputs.items():
+      os.environ[f"INPUT_{key}"] = value
+    main.cfg = dot.dotify({
+      "inputs": dict(main.DEFAULT_INPUTS),
+      "github": dict(main.DEFAULT_GITHUB),
+      "actions": {},
+      "runner": {},
+    })
+    main.main()
+  finally:
+    os.environ.clear()
+    os.environ.update(environ)
+  with open(report_path) as f:
+    return [json.loads(line) for line in f]
+
+
+def benchmark(size: int, latency: float, concurrency: int, extra_inputs: dict) -> dict:
+  workspace = tempfile.mkdtemp(prefix="mark2confluence-bench-")
+  # the stub mark is found on PATH, restored for the next scenario
+  environ = dict(os.environ)
+  try:
+    started = time.perf_counter()
+    with_headers = generate_tree(workspace, size)
+    generation = time.perf_counter() - started
+
+    os.environ["PATH"] = f"{os.path.join(workspace, 'bin')}{os.pathsep}{os.environ['PATH']}"
+    install_stub_mark(os.path.join(workspace, "bin"))
+    os.environ["STUB_MARK_LATENCY"] = str(latency)
+
+    summary = run_main(workspace, {
+      "DOC_DIR": "docs",
+      "ACTION": "publish",
+      "DEFAULT_PARENTS": get_default_parents(),
+      "CONCURRENCY": str(concurrency),
+      "STAGING": "true",
+      **extra_inputs,
+    })[-1]
+  finally:
+    os.environ.clear()
+    os.environ.update(environ)
+    shutil.rmtree(workspace, ignore_errors=True)
+
+  phases = summary["phases"]
+  counters = summary["counters"]
+  processed = counters["success"] + counters["failure"] + counters["unchanged"]
+  return {
+    "size": size,
+    "generation": generation,
+    "with_headers": with_headers,
+    "discovery": rate(size, phases.get("discovery", 0)),
+    "preprocessing": rate(processed, sum(phases.get(phase, 0) for phase in PREPROCESSING_PHASES)),
+    "publish": rate(counters["success"] + counters["failure"], phases.get("publish", 0)),
+    "first_publish": summary.get("first_publish", 0),
+    "duration": summary["duration"],
+    "counters": counters,
+  }
+
+
+def parse_inputs(values: list) -> dict:
+  inputs = {}
+  for value in values:
+    key, _, input_value = value.partition("=")
+    inputs[key.upper()] = input_value
+  return inputs
+
+
+def main_benchmark():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--sizes", type=int, nargs="+", default=[100, 10000])
+  parser.add_argument("--latency", type=float, default=0, help="seconds spent by the stub mark for each invocation")
+  parser.add_argument("--concurrency", type=int, default=8)
+  parser.add_argument("--input", action="append", default=[], metavar="NAME=VALUE", help="extra action input, e.g. BATCH_SIZE=10")
+  args = parser.parse_args()
+
+  logger.remove()
+  logger.add(sys.stderr, level="WARNING")
+
+  print(f"{'files':>8} {'with headers':>12} {'discovery/s':>12} {'preprocess/s':>13} {'publish/s':>10} {'first publish':>14} {'total':>9}")
+  for size in args.sizes:
+    result = benchmark(size, args.latency, args.concurrency, parse_inputs(args.input))
+    print(
+      f"{result['size']:>8} {result['with_headers']:>12} {result['discovery']:>12} "
+      f"{result['preprocessing']:>13} {result['publish']:>10} {result['first_publish']:>13.2f}s {result['duration']:>8.1f}s"
+    )
+
+
+if __name__ == "__main__":
+  main_benchmark()
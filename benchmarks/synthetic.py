@@ -0,0 +1,120 @@
+"""Synthetic documentation trees and a stub mark executable for the benchmarks."""
+import os
+import random
+import stat
+
+SECTIONS = 20
+FILES_PER_DIRECTORY = 50
+
+HEADERS_WITH_SPACE = """<!-- Space: DOCS -->
+<!-- Parent: Handbook -->
+<!-- Parent: {section} -->
+<!-- Title: {title} -->
+"""
+
+HEADERS_WITH_TITLE = """<!-- Title: {title} -->
+"""
+
+MACRO = """
+<!-- Macro: <warning>\\s*(.+)\\s*</warning>
+     Template: ac:box
+     Name: note
+     Icon: true
+     Body: ${{1}}
+-->
+<!-- Include: ac:toc -->
+"""
+
+MERMAID = """
+```mermaid
+graph TD
+  A[{title}] --> B[Section]
+  B --> C[Page]
+```
+"""
+
+PARAGRAPH = "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore.\n\n"
+
+STUB_MARK = """#!/bin/sh
+if [ "$1" = "--version" ]; then
+  echo "mark version 0.0.0-stub"
+  exit 0
+fi
+if [ -n "$STUB_MARK_LATENCY" ]; then
+  sleep "$STUB_MARK_LATENCY"
+fi
+exit 0
+"""
+
+
+def get_default_parents() -> str:
+  """DEFAULT_PARENTS mapping every section of the generated tree, plus a nested override per section."""
+  mappings = []
+  for section in range(SECTIONS):
+    mappings.append(f"docs/section-{section}/*=DOCS->Handbook->Section {section}")
+    mappings.append(f"docs/section-{section}/topic-0/*=DOCS->Handbook->Section {section}->Topic 0")
+  return "\n".join(mappings)
+
+
+def generate_page(rnd: random.Random, section: int, title: str) -> str:
+  kind = rnd.random()
+  if kind < 0.10:
+    # no mark headers, skipped by the action
+    return f"# {title}\n\n" + PARAGRAPH * rnd.randint(1, 10)
+  if kind < 0.25:
+    content = HEADERS_WITH_SPACE.format(section=f"Section {section}", title=title)
+  else:
+    content = HEADERS_WITH_TITLE.format(title=title)
+  if rnd.random() < 0.2:
+    content += MACRO
+  content += f"\n# {title}\n\n"
+  if rnd.random() < 0.3:
+    content += f"![diagram](images/{title}.png)\n\n"
+  if rnd.random() < 0.1:
+    content += MERMAID.format(title=title)
+  return content + PARAGRAPH * rnd.randint(1, 100)
+
+
+def generate_tree(workspace: str, files: int, seed: int = 0) -> int:
+  """Generate about `files` markdown files under workspace/docs, return how many have mark headers."""
+  rnd = random.Random(seed)
+  with_headers = 0
+  for index in range(files):
+    section = index % SECTIONS
+    directory = os.path.join(workspace, "docs", f"section-{section}", f"topic-{index // (SECTIONS * FILES_PER_DIRECTORY)}")
+    if index < SECTIONS * FILES_PER_DIRECTORY * 3:
+      os.makedirs(os.path.join(directory, "images"), exist_ok=True)
+    else:
+      os.makedirs(directory, exist_ok=True)
+    title = f"page-{index}"
+    content = generate_page(rnd, section, title)
+    with_headers += content.startswith("<!--")
+    with open(os.path.join(directory, f"{title}.md"), "w") as f:
+      f.write(content)
+    if f"](images/{title}.png)" in content:
+      # published as an attachment
+      os.makedirs(os.path.join(directory, "images"), exist_ok=True)
+      with open(os.path.join(directory, "images", f"{title}.png"), "wb") as f:
+        f.write(b"\x89PNG")
+    if index % 10 == 0:
+      with open(os.path.join(directory, f"{title}.png"), "wb") as f:
+        f.write(b"\x89PNG")
+
+  # trees the discovery is expected to prune
+  for pruned in [".git", "node_modules/package"]:
+    directory = os.path.join(workspace, "docs", pruned)
+    os.makedirs(directory, exist_ok=True)
+    for index in range(max(1, files // 100)):
+      with open(os.path.join(directory, f"README-{index}.md"), "w") as f:
+        f.write(HEADERS_WITH_TITLE.format(title=f"pruned-{index}"))
+  return with_headers
+
+
+def install_stub_mark(bin_dir: str) -> str:
+  """Write a mark executable answering immediately, or after $STUB_MARK_LATENCY seconds."""
+  os.makedirs(bin_dir, exist_ok=True)
+  path = os.path.join(bin_dir, "mark")
+  with open(path, "w") as f:
+    f.write(STUB_MARK)
+  os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+  return path
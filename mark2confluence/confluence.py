@@ -0,0 +1,328 @@
+"""Native publisher: markdown converted in process and sent to the Confluence REST API.
+
+An alternative to running mark for each page, selected with BACKEND: native. The
+pages are converted with the same headers as mark (Space, Parent, Title,
+Include, Attachment), and every worker shares one pool of keep-alive connections
+and the ids of the spaces and parent pages already resolved during the run.
+"""
+import base64
+import html
+import http.client
+import json
+import mimetypes
+import os
+import queue
+import re
+import ssl
+import threading
+import uuid
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlencode, urlsplit
+
+import markdown
+
+API_PREFIX = "/rest/api"
+MARKDOWN_EXTENSIONS = ["tables", "fenced_code", "sane_lists"]
+
+HEADER_LINE_REGEX = re.compile(r"^<!--\s*([^:]+?):\s*(.*?)\s*-->$")
+INCLUDE_REGEX = re.compile(r"<!--\s*Include:\s*(.+?)\s*-->", re.IGNORECASE)
+CODE_BLOCK_REGEX = re.compile(r'<pre><code(?: class="language-([^"]+)")?>(.*?)</code></pre>', re.DOTALL)
+IMAGE_REGEX = re.compile(r'<img alt="([^"]*)" src="([^"]+)"(?: title="[^"]*")? />')
+VOID_TAG_REGEX = re.compile(r"<(br|hr)(\s[^>]*?)?\s*(?<!/)>", re.IGNORECASE)
+REMOTE_URL_REGEX = re.compile(r"^[a-z]+://", re.IGNORECASE)
+
+
+class ConfluenceError(Exception):
+  """A failed API call or an invalid page. status is None for the network errors and the invalid pages."""
+
+  def __init__(self, message: str, status: Optional[int] = None):
+    super().__init__(message)
+    self.status = status
+
+
+@dataclass
+class Page():
+  """A markdown file converted to the Confluence storage format."""
+  path: str
+  space: str
+  parents: List[str]
+  title: str
+  body: str
+  # absolute paths of the local images and Attachment headers
+  attachments: List[str] = field(default_factory=list)
+
+
+_converters = threading.local()
+
+def _markdown_to_storage(text: str) -> str:
+  converter = getattr(_converters, "markdown", None)
+  if converter is None:
+    converter = _converters.markdown = markdown.Markdown(extensions=MARKDOWN_EXTENSIONS, output_format="xhtml")
+  try:
+    return converter.convert(text)
+  finally:
+    converter.reset()
+
+def _code_macro(match: re.Match) -> str:
+  language, code = match.group(1), html.unescape(match.group(2))
+  parameter = f'<ac:parameter ac:name="language">{language}</ac:parameter>' if language else ""
+  code = code.replace("]]>", "]]]]><![CDATA[>")
+  return f'<ac:structured-macro ac:name="code">{parameter}<ac:plain-text-body><![CDATA[{code}]]></ac:plain-text-body></ac:structured-macro>'
+
+def _include(name: str, directory: str) -> str:
+  """A Confluence macro for the ac: names, like ac:toc, otherwise the storage markup of the file."""
+  if name.startswith("ac:"):
+    return f'<ac:structured-macro ac:name="{html.escape(name[3:])}" />'
+  path = os.path.join(directory, name)
+  try:
+    with open(path, "r") as f:
+      return f.read()
+  except OSError as e:
+    raise ConfluenceError(f"Unable to include {name}: {e}")
+
+def load_page(path: str) -> Page:
+  """Read a markdown file, its mark headers and its body converted to the storage format."""
+  with open(path, "r") as f:
+    lines = f.readlines()
+
+  headers = []
+  beginning_of_content = 0
+  for line in lines:
+    stripped = line.strip()
+    header = HEADER_LINE_REGEX.match(stripped)
+    if stripped and not header:
+      break
+    # the includes of the header block are part of the body
+    if header and header.group(1).lower() != "include":
+      headers.append((header.group(1).lower(), header.group(2)))
+      lines[beginning_of_content] = ""
+    beginning_of_content += 1
+
+  def values(name: str) -> List[str]:
+    return [value for key, value in headers if key == name]
+
+  space, title = values("space")[:1], values("title")[:1]
+  if not space or not title:
+    raise ConfluenceError(f"{path}: the Space and Title headers are required")
+
+  directory = os.path.dirname(os.path.abspath(path))
+  attachments = [os.path.join(directory, name) for name in values("attachment")]
+
+  def image(match: re.Match) -> str:
+    alt, source = html.unescape(match.group(1)), html.unescape(match.group(2))
+    if REMOTE_URL_REGEX.match(source):
+      return f'<ac:image ac:alt="{html.escape(alt)}"><ri:url ri:value="{html.escape(source)}" /></ac:image>'
+    attachment = os.path.normpath(os.path.join(directory, source))
+    if attachment not in attachments:
+      attachments.append(attachment)
+    return f'<ac:image ac:alt="{html.escape(alt)}"><ri:attachment ri:filename="{html.escape(os.path.basename(attachment))}" /></ac:image>'
+
+  body = _markdown_to_storage("".join(lines))
+  body = CODE_BLOCK_REGEX.sub(_code_macro, body)
+  body = IMAGE_REGEX.sub(image, body)
+  body = VOID_TAG_REGEX.sub(lambda match: f"<{match.group(1)}{match.group(2) or ''} />", body)
+  body = INCLUDE_REGEX.sub(lambda match: _include(match.group(1), directory), body)
+  return Page(path, space[0], values("parent"), title[0], body, attachments)
+
+
+class ConnectionPool():
+  """Up to size keep-alive connections to the Confluence host, shared by the workers."""
+
+  def __init__(self, base_url: str, size: int = 1, timeout: float = 120):
+    parts = urlsplit(base_url)
+    if parts.scheme not in ["http", "https"] or not parts.hostname:
+      raise ConfluenceError(f"Invalid Confluence base url: {base_url}")
+    self.scheme = parts.scheme
+    self.host = parts.hostname
+    self.port = parts.port
+    self.prefix = parts.path.rstrip("/")
+    self.size = size
+    self.timeout = timeout
+    self.idle = queue.LifoQueue()
+    self.slots = threading.BoundedSemaphore(size)
+    self.opened = 0
+    self.lock = threading.Lock()
+
+  def _connect(self) -> http.client.HTTPConnection:
+    with self.lock:
+      self.opened += 1
+    if self.scheme == "https":
+      return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout, context=ssl.create_default_context())
+    return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+  def request(self, method: str, path: str, body: Optional[bytes] = None, headers: Optional[dict] = None, timeout: Optional[float] = None) -> Tuple[int, bytes]:
+    """Send the request on an idle connection, or a new one, and return the status and the body of the response."""
+    with self.slots:
+      return self._request(method, path, body, headers, timeout)
+
+  def _request(self, method: str, path: str, body: Optional[bytes], headers: Optional[dict], timeout: Optional[float]) -> Tuple[int, bytes]:
+    for attempt in [1, 2]:
+      try:
+        connection = self.idle.get_nowait()
+        reused = True
+      except queue.Empty:
+        connection = self._connect()
+        reused = False
+      try:
+        connection.timeout = timeout or self.timeout
+        if connection.sock:
+          connection.sock.settimeout(connection.timeout)
+        connection.request(method, f"{self.prefix}{path}", body, headers or {})
+        response = connection.getresponse()
+        data = response.read()
+      except (http.client.HTTPException, OSError) as e:
+        connection.close()
+        # the server may close an idle connection at any time, it is retried once on a new one
+        if reused and attempt == 1 and isinstance(e, (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)):
+          continue
+        raise ConfluenceError(f"Connection error: {method} {path}: {e}")
+      if response.will_close:
+        connection.close()
+      else:
+        self.idle.put(connection)
+      return response.status, data
+
+  def close(self):
+    while True:
+      try:
+        self.idle.get_nowait().close()
+      except queue.Empty:
+        return
+
+
+class ConfluenceClient():
+  """The REST calls publishing a page, caching the ids of the spaces and parent pages for the whole run."""
+
+  def __init__(self, base_url: str, username: str, password: str, pool_size: int = 1, timeout: float = 120):
+    self.pool = ConnectionPool(base_url, pool_size, timeout)
+    if username:
+      self.authorization = f"Basic {base64.b64encode(f'{username}:{password}'.encode()).decode()}"
+    else:
+      self.authorization = f"Bearer {password}"
+    # space key -> homepage id, (space key, title) -> page id
+    self.homepages: Dict[str, str] = {}
+    self.page_ids: Dict[Tuple[str, str], str] = {}
+    self.lock = threading.Lock()
+    self.key_locks: Dict[tuple, threading.Lock] = {}
+
+  def call(self, method: str, path: str, query: Optional[dict] = None, data=None, body: Optional[bytes] = None,
+           headers: Optional[dict] = None, timeout: Optional[float] = None) -> Optional[dict]:
+    headers = {"Authorization": self.authorization, "Accept": "application/json", **(headers or {})}
+    if data is not None:
+      body = json.dumps(data).encode()
+      headers["Content-Type"] = "application/json"
+    url = f"{API_PREFIX}{path}{'?' + urlencode(query) if query else ''}"
+    status, payload = self.pool.request(method, url, body, headers, timeout)
+    if status >= 400:
+      try:
+        message = json.loads(payload).get("message", "")
+      except (ValueError, AttributeError):
+        message = payload.decode(errors="replace")[:200]
+      raise ConfluenceError(f"{method} {path}: {status} {http.client.responses.get(status, '')}: {message}", status)
+    return json.loads(payload) if payload else None
+
+  def _key_lock(self, key: tuple) -> threading.Lock:
+    with self.lock:
+      return self.key_locks.setdefault(key, threading.Lock())
+
+  def get_current_user(self, timeout: Optional[float] = None) -> dict:
+    """The user of the credentials, ConfluenceError when they are not accepted."""
+    try:
+      user = self.call("GET", "/user/current", timeout=timeout)
+    except ValueError:
+      raise ConfluenceError("GET /user/current: not a Confluence REST API answer")
+    if not isinstance(user, dict) or user.get("type") == "anonymous":
+      raise ConfluenceError("GET /user/current: the credentials are not accepted, answered as an anonymous user", 401)
+    return user
+
+  def get_homepage(self, space: str, timeout: Optional[float] = None) -> str:
+    with self._key_lock(("space", space)):
+      if space not in self.homepages:
+        self.homepages[space] = str(self.call("GET", f"/space/{space}", {"expand": "homepage"}, timeout=timeout)["homepage"]["id"])
+      return self.homepages[space]
+
+  def find_page(self, space: str, title: str, timeout: Optional[float] = None) -> Optional[dict]:
+    results = self.call("GET", "/content", {"spaceKey": space, "title": title, "type": "page", "expand": "version,ancestors"}, timeout=timeout)["results"]
+    return results[0] if results else None
+
+  def create_page(self, space: str, title: str, parent_id: str, body: str, timeout: Optional[float] = None) -> dict:
+    return self.call("POST", "/content", data={
+      "type": "page",
+      "title": title,
+      "space": {"key": space},
+      "ancestors": [{"id": parent_id}],
+      "body": {"storage": {"value": body, "representation": "storage"}},
+    }, timeout=timeout)
+
+  def update_page(self, page: dict, parent_id: str, body: str, timeout: Optional[float] = None) -> dict:
+    return self.call("PUT", f"/content/{page['id']}", data={
+      "type": "page",
+      "title": page["title"],
+      "version": {"number": page["version"]["number"] + 1},
+      "ancestors": [{"id": parent_id}],
+      "body": {"storage": {"value": body, "representation": "storage"}},
+    }, timeout=timeout)
+
+  def ensure_ancestry(self, space: str, parents: List[str], dry_run: bool = False, timeout: Optional[float] = None) -> Optional[str]:
+    """The id of the last parent page, creating the missing ones unless dry_run, None if they do not exist yet."""
+    parent_id = self.get_homepage(space, timeout)
+    for title in parents:
+      # one worker at a time resolves a given parent, the others reuse its id
+      with self._key_lock((space, title)):
+        page_id = self.page_ids.get((space, title))
+        if page_id is None:
+          page = self.find_page(space, title, timeout)
+          if page is None and dry_run:
+            return None
+          if page is None:
+            page = self.create_page(space, title, parent_id, "", timeout)
+          page_id = self.page_ids[(space, title)] = str(page["id"])
+      parent_id = page_id
+    return parent_id
+
+  def upload_attachments(self, page_id: str, paths: List[str], timeout: Optional[float] = None):
+    existing = {
+      attachment["title"]: attachment["id"]
+      for attachment in self.call("GET", f"/content/{page_id}/child/attachment", timeout=timeout)["results"]
+    }
+    for path in paths:
+      name = os.path.basename(path)
+      try:
+        with open(path, "rb") as f:
+          content = f.read()
+      except OSError as e:
+        raise ConfluenceError(f"Unable to attach {path}: {e}")
+      boundary = uuid.uuid4().hex
+      mime_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+      body = (
+        f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{name}"\r\n'
+        f"Content-Type: {mime_type}\r\n\r\n"
+      ).encode() + content + f"\r\n--{boundary}--\r\n".encode()
+      headers = {"Content-Type": f"multipart/form-data; boundary={boundary}", "X-Atlassian-Token": "no-check"}
+      path = f"/content/{page_id}/child/attachment"
+      if name in existing:
+        path = f"{path}/{existing[name]}/data"
+      self.call("POST", path, body=body, headers=headers, timeout=timeout)
+
+  def publish(self, page: Page, dry_run: bool = False, timeout: Optional[float] = None) -> Optional[str]:
+    """Create or update the page under its parents, return its web link, None in dry run."""
+    parent_id = self.ensure_ancestry(page.space, page.parents, dry_run, timeout)
+    if dry_run:
+      # the same lookups as mark, nothing is written
+      if parent_id:
+        self.find_page(page.space, page.title, timeout)
+      return None
+    existing = self.find_page(page.space, page.title, timeout)
+    if existing:
+      published = self.update_page(existing, parent_id, page.body, timeout)
+    else:
+      published = self.create_page(page.space, page.title, parent_id, page.body, timeout)
+    with self.lock:
+      self.page_ids[(page.space, page.title)] = str(published["id"])
+    if page.attachments:
+      self.upload_attachments(str(published["id"]), page.attachments, timeout)
+    return published.get("_links", {}).get("webui", "")
+
+  def close(self):
+    self.pool.close()
@@ -1,21 +1,44 @@
 import os
-import shlex
+import json
+import ctypes
+import ctypes.util
+import queue
+import random
+import time
+import hashlib
+import heapq
+import shutil
+import signal
 import sys
+import tempfile
 import re
+import select
+import shlex
+import struct
 import subprocess
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from contextlib import contextmanager
 from datetime import datetime,timedelta
-from fnmatch import fnmatch
-from typing import List, Tuple
+from fnmatch import fnmatch, translate
+from functools import lru_cache
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 import jinja2
+import jinja2.meta
 from loguru import logger
 from supermutes import dot
 from pprint import pformat
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 ACTION_PUBLISH = "publish"
 ACTION_DRY_RUN = "dry-run"
 ACTION_VERIFY = "verify"
 
+BACKEND_MARK = "mark"
+BACKEND_NATIVE = "native"
+BACKENDS = [BACKEND_MARK, BACKEND_NATIVE]
+
 ENV_PREFIXES = {
   "inputs": "INPUT_",
   "github": "GITHUB_",
@@ -38,6 +61,38 @@ DEFAULT_INPUTS = {
   "CONFLUENCE_BASE_URL": "",
   "MERMAID_PROVIDER": "",
   "DEFAULT_PARENTS": "",
+  "CONCURRENCY": "1",
+  "CACHE_DIR": "",
+  "FORCE_REFRESH": "false",
+  "BASE_REF": "",
+  "STAGING": "false",
+  "STAGING_DIR": "",
+  "EXCLUDE_DIRS": ".git node_modules",
+  "RESPECT_GITIGNORE": "false",
+  "BATCH_SIZE": "1",
+  "TIMEOUT": "120",
+  "TIMEOUT_PER_KB": "0",
+  "TIMEOUT_PER_ATTACHMENT": "0",
+  "MARK_LOG_DIR": "",
+  "RETRIES": "2",
+  "RETRY_BACKOFF": "2",
+  "RATE_LIMIT": "0",
+  "REPORT_PATH": "",
+  "MERMAID_CACHE_DIR": "",
+  "MERMAID_RENDERER": "mmdc --input {input} --output {output}",
+  "WATCH": "false",
+  "WATCH_DEBOUNCE": "1",
+  "SHARD_INDEX": "0",
+  "SHARD_COUNT": "1",
+  "TIME_BUDGET": "0",
+  "FAIL_FAST": "0",
+  "ON_CONFLICT": "warn",
+  "BACKEND": BACKEND_MARK,
+  "PREFLIGHT": "true",
+  "JOURNAL_PATH": "",
+  "RESUME": "false",
+  "PROFILE": "false",
+  "PROFILE_DIR": "mark2confluence-profile",
 }
 
 DEFAULT_GITHUB = {
@@ -47,6 +102,38 @@ DEFAULT_GITHUB = {
   "WORKSPACE": ".",
 }
 
+CACHE_FILE_NAME = "publish-cache.json"
+# lines of mark stderr kept in memory to report a failure
+OUTPUT_TAIL_LINES = 50
+# log lines of a file kept by a parallel worker until the file is done, the older ones are dropped
+BUFFERED_LOG_LINES = 500
+# files listed in the step summary
+REPORT_SLOWEST_FILES = 10
+REPORT_NOT_ATTEMPTED_FILES = 20
+REPORT_FAILED_FILES = 20
+# files handed over between the stages of the pipeline
+PIPELINE_QUEUE_SIZE = 64
+
+OUTCOME_SUCCESS = "success"
+OUTCOME_FAILURE = "failure"
+OUTCOME_UNCHANGED = "unchanged"
+OUTCOME_SKIPPED = "skipped"
+OUTCOME_NOT_ATTEMPTED = "not attempted"
+
+# the status codes are only recognized after "status code:", "HTTP" or the request line of the native backend,
+# other numbers of the output are line numbers, page ids or sizes
+HTTP_STATUS_PREFIX = rb"(?:\bstatus(?: code)?:?|\bHTTP(?:/\d(?:\.\d)?)?|\b(?:GET|POST|PUT|DELETE) \S+:)\s*"
+# mark errors worth a retry: throttling, server side and network failures
+TRANSIENT_ERROR_REGEX = re.compile(
+  HTTP_STATUS_PREFIX + rb"(?:429|500|502|503|504)\b"
+  rb"|too many requests|rate limit|internal server error|service unavailable|bad gateway|gateway timeout"
+  rb"|timeout|timed out|connection reset|connection refused|connection error|broken pipe|unexpected eof|temporar",
+  re.IGNORECASE,
+)
+PERMANENT_ERROR_REGEX = re.compile(HTTP_STATUS_PREFIX + rb"(?:400|401|403|404)\b|unauthorized|forbidden", re.IGNORECASE)
+# appended by publish() when mark is killed, a hanging page would hang again
+EXEC_TIMEOUT_MESSAGE = "Exec timeout after"
+
 cfg =dot.dotify({
   "inputs": DEFAULT_INPUTS,
   "github": DEFAULT_GITHUB,
@@ -72,8 +159,302 @@ def load_vars():
     logger.add(sys.stderr, level=os.getenv['LOGURU_LEVEL'])
 
 
-def publish(path: str)-> tuple:
+@dataclass
+class RetryPolicy():
+  """Retries of the transient failures, with exponential backoff and full jitter."""
+  retries: int = 0
+  backoff: float = 2
+  max_backoff: float = 60
+
+  def get_delay(self, attempt: int) -> float:
+    return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+
+class RateLimiter():
+  """Token bucket limiting how many mark invocations start per second, shared by all the workers."""
+
+  def __init__(self, rate: float):
+    self.rate = rate
+    self.capacity = max(1.0, rate)
+    self.tokens = self.capacity
+    self.updated = time.monotonic()
+    self.lock = threading.Lock()
+
+  def acquire(self):
+    if self.rate <= 0:
+      return
+    while True:
+      with self.lock:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+          self.tokens -= 1
+          return
+        wait = (1 - self.tokens) / self.rate
+      time.sleep(wait)
+
+
+class RunBudget():
+  """Wall-clock budget of the run and limit of consecutive failures, shared by all the workers."""
+
+  def __init__(self, time_budget: float = 0, fail_fast: int = 0):
+    self.deadline = time.monotonic() + time_budget if time_budget > 0 else None
+    self.fail_fast = fail_fast
+    self.consecutive_failures = 0
+    self.stop_reason = None
+    self.lock = threading.Lock()
+
+  @property
+  def is_limited(self) -> bool:
+    return self.deadline is not None or self.fail_fast > 0
+
+  def remaining(self) -> Optional[float]:
+    return None if self.deadline is None else max(0.0, self.deadline - time.monotonic())
+
+  def is_exhausted(self) -> bool:
+    if self.stop_reason is None and self.deadline is not None and time.monotonic() >= self.deadline:
+      self.stop_reason = "TIME_BUDGET exhausted"
+    return self.stop_reason is not None
+
+  def cap_timeout(self, timeout: float) -> float:
+    remaining = self.remaining()
+    return timeout if remaining is None else min(timeout, remaining)
+
+  def stop(self, reason: str):
+    """Stop starting files, the remaining ones are reported as not attempted."""
+    with self.lock:
+      if self.stop_reason is None:
+        self.stop_reason = reason
+        logger.error(f"Stopping, {reason}")
+
+  def record(self, success: bool):
+    with self.lock:
+      self.consecutive_failures = 0 if success else self.consecutive_failures + 1
+      if self.fail_fast and self.consecutive_failures >= self.fail_fast and self.stop_reason is None:
+        self.stop_reason = f"FAIL_FAST after {self.consecutive_failures} consecutive failures"
+        logger.error(f"Stopping, {self.stop_reason}")
+
+  def not_attempted(self) -> "PublishResult":
+    return PublishResult(False, f"Not attempted, {self.stop_reason}".encode(), attempts=0)
+
+
+retry_policy = RetryPolicy()
+rate_limiter = RateLimiter(0)
+run_budget = RunBudget()
+# shared by the workers with the native backend
+confluence_client = None
+
+
+def is_transient_failure(errs: Optional[bytes]) -> bool:
+  if not errs or EXEC_TIMEOUT_MESSAGE.encode() in errs or PERMANENT_ERROR_REGEX.search(errs):
+    return False
+  return TRANSIENT_ERROR_REGEX.search(errs) is not None
+
+
+@dataclass
+class PublishResult():
+  success: bool
+  errors: Optional[bytes] = None
+  # 0 when the file was not attempted
+  attempts: int = 1
+  # seconds spent by mark, retries and backoff included
+  duration: float = 0
+
+  def as_status(self) -> tuple:
+    return self.success, self.errors
+
+  @property
+  def attempted(self) -> bool:
+    return self.attempts > 0
+
+
+def get_log_min_level() -> int:
+  """The lowest level emitted by the loguru handlers, which loguru does not expose publicly."""
+  return getattr(getattr(logger, "_core", None), "min_level", 0)
+
+
+class BufferedLog():
+  """Collects log messages so the ones of a single file can be emitted together.
+
+  The messages below the level of the loguru handlers are not kept, and only
+  the last maxlen ones are, the number of dropped ones is logged instead.
+  """
+
+  def __init__(self, maxlen: Optional[int] = None):
+    min_level = get_log_min_level()
+    self.levels = {level for level in ("DEBUG", "INFO", "WARNING", "ERROR") if logger.level(level).no >= min_level}
+    self.records = deque(maxlen=maxlen or BUFFERED_LOG_LINES)
+    self.dropped = 0
+
+  def _append(self, level: str, message: str):
+    if level not in self.levels:
+      return
+    if len(self.records) == self.records.maxlen:
+      self.dropped += 1
+    self.records.append((level, message))
+
+  def debug(self, message: str):
+    self._append("DEBUG", message)
+
+  def info(self, message: str):
+    self._append("INFO", message)
+
+  def warning(self, message: str):
+    self._append("WARNING", message)
+
+  def error(self, message: str):
+    self._append("ERROR", message)
+
+  def flush(self):
+    if self.dropped:
+      logger.warning(f"{self.dropped} log lines dropped, only the last {self.records.maxlen} are kept when publishing in parallel, set MARK_LOG_DIR to keep the whole mark output")
+    for level, message in self.records:
+      logger.log(level, message)
+    self.records.clear()
+    self.dropped = 0
+
+
+_END = object()
+
+def prefetch(iterable: Iterable, maxsize: int = PIPELINE_QUEUE_SIZE) -> Iterator:
+  """Iterate in a background thread, handing the items over through a bounded queue.
+
+  The producer runs at most maxsize items ahead of the consumer, its exceptions
+  are raised in the consumer. Closing the iterator stops the producer.
+  """
+  items = queue.Queue(maxsize)
+  stopped = threading.Event()
+
+  def put(item) -> bool:
+    while not stopped.is_set():
+      try:
+        items.put(item, timeout=0.1)
+        return True
+      except queue.Full:
+        continue
+    return False
+
+  def produce():
+    iterator = iter(iterable)
+    try:
+      for item in iterator:
+        if not put((item, None)):
+          break
+      else:
+        put((_END, None))
+    except BaseException as e:
+      put((_END, e))
+    finally:
+      if hasattr(iterator, "close"):
+        iterator.close()
+
+  producer = threading.Thread(target=produce, daemon=True)
+  producer.start()
+  try:
+    while True:
+      item, error = items.get()
+      if error is not None:
+        raise error
+      if item is _END:
+        return
+      yield item
+  finally:
+    stopped.set()
+    producer.join()
+
+
+def run_mark(args: List[str], cwd: str, timeout: float, log = logger, output_path: Optional[str] = None, on_stderr = None) -> Tuple[Optional[int], bytes]:
+  """Run mark streaming its output line by line to the log, or to output_path when given.
+
+  Only the last OUTPUT_TAIL_LINES lines of stderr are kept in memory, on_stderr
+  is called with every line when given. The return code is None when mark has
+  been killed because of the timeout.
+  """
+  global cfg
+  tail = deque(maxlen=OUTPUT_TAIL_LINES)
+  output_file = None
+  if output_path:
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    output_file = open(output_path, "w")
+  output_lock = threading.Lock()
+
+  def pump(stream, is_stderr: bool):
+    for raw_line in iter(stream.readline, b""):
+      if is_stderr:
+        tail.append(raw_line)
+        if on_stderr:
+          on_stderr(raw_line)
+      line = raw_line.decode(errors="replace").rstrip("\n")
+      if output_file:
+        with output_lock:
+          output_file.write(f"{line}\n")
+      elif not is_stderr and cfg.inputs.ACTION == ACTION_VERIFY:
+        log.info(f"Verify: {line}")
+      else:
+        log.debug(f"mark: {line}")
+    stream.close()
+
+  rate_limiter.acquire()
+  # in its own session, so that the browsers started for mermaid are killed with mark
+  proc = subprocess.Popen(args, shell=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd, start_new_session=True)
+  readers = [
+    threading.Thread(target=pump, args=(proc.stdout, False), daemon=True),
+    threading.Thread(target=pump, args=(proc.stderr, True), daemon=True),
+  ]
+  for reader in readers:
+    reader.start()
+  try:
+    returncode = proc.wait(timeout=timeout)
+  except subprocess.TimeoutExpired:
+    try:
+      os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+      pass
+    proc.wait()
+    returncode = None
+  for reader in readers:
+    reader.join()
+  if output_file:
+    output_file.close()
+  return returncode, b"".join(tail)
+
+
+def publish_native(path: str, log = logger, timeout: float = 120, output_path: Optional[str] = None) -> tuple:
+  """publish() in process: the page is converted here and sent with the shared confluence_client."""
   global cfg
+  from mark2confluence import confluence
+
+  rate_limiter.acquire()
+  try:
+    page = confluence.load_page(path)
+    if cfg.inputs.ACTION == ACTION_VERIFY:
+      output = page.body
+    else:
+      link = confluence_client.publish(page, dry_run=cfg.inputs.ACTION == ACTION_DRY_RUN, timeout=timeout)
+      output = f"page published: {link}" if link is not None else f"dry run: {page.title}"
+  except confluence.ConfluenceError as e:
+    log.debug(f"native: {e}")
+    return False, f"ERROR: {e}".encode()
+
+  if output_path:
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with open(output_path, "w") as f:
+      f.write(f"{output}\n")
+  else:
+    for line in output.splitlines():
+      if cfg.inputs.ACTION == ACTION_VERIFY:
+        log.info(f"Verify: {line}")
+      else:
+        log.debug(f"native: {line}")
+  return True, None
+
+
+def publish(path: str, log = logger, cwd: Optional[str] = None, timeout: float = 120, output_path: Optional[str] = None, on_stderr = None)-> tuple:
+  global cfg
+
+  if cfg.inputs.BACKEND == BACKEND_NATIVE:
+    return publish_native(path if cwd is None else os.path.join(cwd, path), log, timeout, output_path)
 
   other_args = ""
   if cfg.inputs.ACTION == ACTION_DRY_RUN:
@@ -119,32 +500,919 @@ def publish(path: str)-> tuple:
   # Add file path
   cmd_parts.extend(['-f', path])
 
-  cmd_line = ' '.join(cmd_parts)
-  args = shlex.split(cmd_line)
-  proc = subprocess.Popen(args, shell=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd = os.path.dirname(path))
-
-  try:
-    out, errs = proc.communicate(timeout=120)
-    if cfg.inputs.ACTION == ACTION_VERIFY:
-      logger.info(f"Verify: mark compiled html: {out}")
-  except subprocess.TimeoutExpired:
-    proc.kill()
-    _, errs = proc.communicate()
-    logger.error(f"Exec timeout: {errs}")
-    return False, errs
-  if proc.returncode != 0:
+  # the arguments are passed as they are, paths and globs may contain spaces or backslashes
+  returncode, errs = run_mark(cmd_parts, cwd or os.path.dirname(path), timeout, log, output_path, on_stderr)
+  if returncode is None:
+    log.error(f"{EXEC_TIMEOUT_MESSAGE} {timeout:.0f}s: {errs}")
+    return False, errs + f"{EXEC_TIMEOUT_MESSAGE} {timeout:.0f}s".encode()
+  if returncode != 0:
     return False, errs
   return True, None
 
 
-def begins_with_mark_headers(path: str, headers: List[str] = ["Space", "Parent", "Title"]) -> bool:
-  with open(path, 'r+') as f:
-    first_row = f.readline()
-    for header in headers:
-      regex = re.compile(f"^<!--.?{header}:.*-->", re.IGNORECASE)
-      if regex.match(first_row):
+def publish_with_retries(path: str, log = logger, **kwargs) -> PublishResult:
+  """Call publish(), retrying the transient failures as configured by retry_policy, within the run_budget."""
+  if run_budget.is_exhausted():
+    return run_budget.not_attempted()
+  attempt = 1
+  started = time.perf_counter()
+  timeout = kwargs.pop("timeout", 120)
+  while True:
+    success, errs = publish(path, log, timeout=run_budget.cap_timeout(timeout), **kwargs)
+    if success or attempt > retry_policy.retries or not is_transient_failure(errs):
+      return PublishResult(success, errs, attempt, time.perf_counter() - started)
+    delay = retry_policy.get_delay(attempt)
+    if run_budget.is_exhausted() or delay >= (run_budget.remaining() or float("inf")):
+      log.warning(f"No time left to retry {path}: {errs}")
+      return PublishResult(success, errs, attempt, time.perf_counter() - started)
+    log.warning(f"Transient failure publishing {path}, retry {attempt}/{retry_policy.retries} in {delay:.1f}s: {errs}")
+    time.sleep(delay)
+    attempt += 1
+
+
+GLOB_SPECIAL_CHARS_REGEX = re.compile(r"([\\*?\[\]{},])")
+# logged by mark, at info level, before publishing each file of its -f glob
+MARK_PROCESSING_REGEX = re.compile(rb"\bprocessing (\S.*?)\s*$")
+
+class BatchProgress():
+  """The files of a batch mark started, from its "processing <file>" lines, per mark run."""
+
+  def __init__(self, names: List[str]):
+    self.names = set(names)
+    self.runs: List[List[str]] = []
+
+  def on_stderr(self, line: bytes):
+    match = MARK_PROCESSING_REGEX.search(line)
+    if not match:
+      return
+    name = os.path.basename(match.group(1).decode(errors="replace"))
+    if name not in self.names:
+      return
+    # mark processes each file once, seeing a file again means the batch is retried
+    if not self.runs or name in self.runs[-1]:
+      self.runs.append([])
+    self.runs[-1].append(name)
+
+  def get_published(self) -> set:
+    """The files followed by another one in a run: mark stops at the first failing file."""
+    return {name for run in self.runs for name in run[:-1]}
+
+  def get_failed(self) -> Optional[str]:
+    """The file being published when the last run failed, None if unknown."""
+    return self.runs[-1][-1] if self.runs else None
+
+
+def publish_batch(paths: List[str], log = logger, timeouts: Optional[List[float]] = None, output_paths: Optional[List[Optional[str]]] = None) -> List[PublishResult]:
+  """Publish files of the same directory with a single mark invocation.
+
+  mark expands the glob given to -f, the files are listed as alternatives so
+  none of their siblings is published. When the batch fails, the files mark
+  published before the failing one are kept, the failing one is published on
+  its own and the ones not reached as a new batch. Without the "processing"
+  lines of mark, e.g. with a MARK_LOG_LEVEL above info, each file is published
+  on its own. The time left of the batch timeouts bounds the fallback.
+  """
+  timeouts = timeouts or [120] * len(paths)
+  output_paths = output_paths or [None] * len(paths)
+  directory = os.path.dirname(paths[0])
+  names = [GLOB_SPECIAL_CHARS_REGEX.sub(r"\\\1", os.path.basename(path)) for path in paths]
+  batch_output_path = f"{output_paths[0][:-len('.log')]}.batch.log" if output_paths[0] else None
+  progress = BatchProgress([os.path.basename(path) for path in paths])
+  result = publish_with_retries(f"{{{','.join(names)}}}", log, cwd=directory, timeout=sum(timeouts), output_path=batch_output_path, on_stderr=progress.on_stderr)
+  if not result.attempted:
+    return [result for _ in paths]
+  if result.success:
+    # the time is split evenly among the files of the batch
+    return [PublishResult(True, None, result.attempts, result.duration / len(paths)) for _ in paths]
+
+  time_left = sum(timeouts) - result.duration
+  def publish_fallback(path: str, timeout: float, output_path: Optional[str]) -> PublishResult:
+    nonlocal time_left
+    if time_left <= 0:
+      return PublishResult(False, f"Not attempted, the batch timeout of {sum(timeouts):.0f}s is spent: {result.errors}".encode(), attempts=0)
+    fallback = publish_with_retries(path, log, timeout=min(timeout, time_left), output_path=output_path)
+    time_left -= fallback.duration
+    return fallback
+
+  failed = progress.get_failed()
+  if failed is None:
+    log.warning(f"Batch of {len(paths)} files in {directory} failed, publishing them one by one: {result.errors}")
+    return [publish_fallback(*args) for args in zip(paths, timeouts, output_paths)]
+
+  published = progress.get_published()
+  share = result.duration / max(1, len(published))
+  results = {path: PublishResult(True, None, result.attempts, share) for path in paths if os.path.basename(path) in published}
+  rest = [(path, timeout, output_path) for path, timeout, output_path in zip(paths, timeouts, output_paths) if path not in results]
+  failed_path = next((path for path, _, _ in rest if os.path.basename(path) == failed), None)
+  not_reached = [args for args in rest if args[0] != failed_path]
+  log.warning(
+    f"Batch of {len(paths)} files in {directory} failed at {failed} after publishing {len(results)} of them, "
+    f"publishing the {len(not_reached)} files not reached again: {result.errors}"
+  )
+  if failed_path:
+    args = next(args for args in rest if args[0] == failed_path)
+    if EXEC_TIMEOUT_MESSAGE.encode() in (result.errors or b""):
+      # mark hung on it, it would hang again
+      results[failed_path] = PublishResult(False, result.errors, result.attempts, result.duration)
+    else:
+      results[failed_path] = publish_fallback(*args)
+  if len(not_reached) == 1:
+    results[not_reached[0][0]] = publish_fallback(*not_reached[0])
+  elif not_reached:
+    if time_left <= 0:
+      results.update((args[0], publish_fallback(*args)) for args in not_reached)
+    else:
+      batch_paths = [args[0] for args in not_reached]
+      # the time left is shared by the files not reached, in proportion to their timeouts
+      scale = min(1, time_left / sum(args[1] for args in not_reached))
+      results.update(zip(batch_paths, publish_batch(batch_paths, log, [args[1] * scale for args in not_reached], [args[2] for args in not_reached])))
+  return [results[path] for path in paths]
+
+
+def group_batches(files: Dict[str, str], spaces: Dict[str, str], batch_size: int) -> List[List[str]]:
+  """Group the files published from the same directory into the same space, up to batch_size files per group."""
+  groups = {}
+  for path, target in files.items():
+    groups.setdefault((os.path.dirname(target), spaces.get(path)), []).append(path)
+  return [paths[i:i + batch_size] for paths in groups.values() for i in range(0, len(paths), batch_size)]
+
+
+def plan_waves(pages: Dict[str, Tuple[Optional[str], List[str], Optional[str]]]) -> List[List[str]]:
+  """Split the files in waves published one after the other, so parent pages exist before their children.
+
+  pages maps each file to its space, parents and title. A file waits for the
+  files providing its parent pages. Each parent page that no file provides is
+  created by mark: the shallowest file needing it is published first, so its
+  siblings do not race to create the same page.
+  """
+  providers = {(space, title): path for path, (space, _, title) in pages.items() if title}
+  pioneers = {}
+  dependencies = {path: set() for path in pages}
+  # the pioneers are the shallowest files, a file providing a deeper parent comes after them
+  for path, (space, parents, _) in sorted(pages.items(), key=lambda page: len(page[1][1])):
+    for parent in parents:
+      provider = providers.get((space, parent)) or pioneers.setdefault((space, parent), path)
+      if provider != path:
+        dependencies[path].add(provider)
+
+  waves = []
+  published = set()
+  while dependencies:
+    wave = [path for path, paths in dependencies.items() if paths <= published]
+    if not wave:
+      logger.warning(f"Circular parents between {', '.join(dependencies)}, publishing them together")
+      wave = list(dependencies)
+    for path in wave:
+      del dependencies[path]
+    published.update(wave)
+    waves.append(wave)
+  return waves
+
+
+ON_CONFLICT_VALUES = ["warn", "fail"]
+
+def get_header_conflict(headers: List[Tuple[str, str]]) -> Optional[str]:
+  """Why the mark headers of a file are ambiguous, if they are."""
+  reason = None
+  for name in ["Space", "Title"]:
+    values = {value for key, value in headers if key.lower() == name.lower()}
+    if len(values) > 1:
+      reason = f"Conflicting {name} headers: {', '.join(sorted(values))}"
+  return reason
+
+def get_conflicts(pages: Dict[str, Tuple[Optional[str], List[str], Optional[str]]], headers: Dict[str, List[Tuple[str, str]]]) -> Dict[str, str]:
+  """The files that would collide once published, with the reason.
+
+  pages maps each file to its space, parents and title, headers to its mark
+  headers. Confluence titles are unique within a space: files resolving to the
+  same space and title, whatever their parents, publish the same page. A file
+  declaring several spaces or titles is ambiguous.
+  """
+  conflicts = {}
+  for path, file_headers in headers.items():
+    reason = get_header_conflict(file_headers)
+    if reason:
+      conflicts[path] = reason
+
+  sources = {}
+  for path, (space, _, title) in pages.items():
+    if title:
+      sources.setdefault((space, title), []).append(path)
+  for (space, title), paths in sources.items():
+    if len(paths) > 1:
+      relative_paths = [os.path.relpath(path, cfg.github.WORKSPACE) for path in paths]
+      for path in paths:
+        location = f" of space {space}" if space else ""
+        conflicts.setdefault(path, f"Page '{title}'{location} is published by {', '.join(relative_paths)}")
+  return conflicts
+
+
+class PageIndex():
+  """The pages seen so far, reporting the conflicts of get_conflicts() as the files come."""
+
+  def __init__(self):
+    self.sources: Dict[Tuple[Optional[str], str], str] = {}
+
+  def add(self, path: str, page: Tuple[Optional[str], List[str], Optional[str]], headers: List[Tuple[str, str]]) -> Optional[str]:
+    space, _, title = page
+    reason = get_header_conflict(headers)
+    if title:
+      first = self.sources.setdefault((space, title), path)
+      if first != path and reason is None:
+        location = f" of space {space}" if space else ""
+        reason = f"Page '{title}'{location} is also published by {os.path.relpath(first, cfg.github.WORKSPACE)}"
+    return reason
+
+
+def get_mark_log_path(path: str) -> Optional[str]:
+  """The file where the mark output for the given source file is written, if MARK_LOG_DIR is set."""
+  global cfg
+  if not cfg.inputs.MARK_LOG_DIR:
+    return None
+  relative_path = os.path.relpath(os.path.abspath(path), os.path.abspath(cfg.github.WORKSPACE))
+  return os.path.join(cfg.github.WORKSPACE, cfg.inputs.MARK_LOG_DIR, f"{relative_path}.log")
+
+
+def publish_group(paths: List[str], files: Dict[str, str], timeouts: Dict[str, float], log = logger) -> Dict[str, PublishResult]:
+  """Publish the given source paths with a single mark invocation, or one invocation when alone."""
+  if len(paths) == 1:
+    results = {paths[0]: publish_with_retries(files[paths[0]], log, timeout=timeouts.get(paths[0], 120), output_path=get_mark_log_path(paths[0]))}
+  else:
+    results = dict(zip(paths, publish_batch(
+      [files[path] for path in paths],
+      log,
+      [timeouts.get(path, 120) for path in paths],
+      [get_mark_log_path(path) for path in paths],
+    )))
+  for result in results.values():
+    if result.attempted:
+      run_budget.record(result.success)
+  return results
+
+
+def publish_files(files: Dict[str, str], concurrency: int, batches: Optional[List[List[str]]] = None, timeouts: Optional[Dict[str, float]] = None) -> dict:
+  """Publish the files, mapping each source path to the path given to mark.
+
+  The files of each of the batches, when given, are published by a single
+  mark invocation. Returns the PublishResult of each source path.
+  """
+  if batches is None:
+    batches = [[path] for path in files]
+  timeouts = timeouts or {}
+
+  results = {}
+  if concurrency <= 1:
+    for batch in batches:
+      results.update(publish_group(batch, files, timeouts, logger))
+  else:
+    def publish_buffered(paths: List[str]) -> Tuple[dict, BufferedLog]:
+      log = BufferedLog()
+      return publish_group(paths, files, timeouts, log), log
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+      futures = [executor.submit(publish_buffered, batch) for batch in batches]
+      for future in as_completed(futures):
+        batch_results, log = future.result()
+        results.update(batch_results)
+        log.flush()
+  # keep the status ordered as the files were processed
+  return {path: results[path] for path in files}
+
+
+@dataclass
+class PreparedFile():
+  """A file whose headers are injected, with what is needed to publish it and to report its outcome."""
+  path: str
+  # the path given to mark, in the staging area or the source path
+  target: str
+  size: int
+  space: Optional[str]
+  parents: List[str]
+  title: Optional[str]
+  headers: List[Tuple[str, str]]
+  timeout: float = 120
+  digest: Optional[str] = None
+  unchanged: bool = False
+
+  @property
+  def page(self) -> Tuple[Optional[str], List[str], Optional[str]]:
+    return self.space, self.parents, self.title
+
+
+@dataclass(eq=False)
+class ScheduledBatch():
+  """A batch of publish_stream() with the batches it waits for."""
+  items: List[PreparedFile]
+  done: threading.Event = field(default_factory=threading.Event)
+  dependencies: List["ScheduledBatch"] = field(default_factory=list)
+  # (space, title) of the parent pages no file provides yet: held until it is found
+  held_for: set = field(default_factory=set)
+  submitted: bool = False
+
+  def depends_on(self, other: "ScheduledBatch") -> bool:
+    seen = set()
+    stack = list(self.dependencies)
+    while stack:
+      batch = stack.pop()
+      if batch is other:
         return True
-  return False
+      if id(batch) not in seen:
+        seen.add(id(batch))
+        stack.extend(batch.dependencies)
+    return False
+
+  def wait_for(self, other: "ScheduledBatch"):
+    # a circular dependency would never be published, the parents are circular anyway
+    if other is not self and other not in self.dependencies and not other.depends_on(self):
+      self.dependencies.append(other)
+
+
+def publish_stream(prepared: Iterable[PreparedFile], concurrency: int, batch_size: int = 1) -> Iterator[Tuple[PreparedFile, PublishResult]]:
+  """Publish the files as they come, yielding each of them with its result once known.
+
+  Consecutive files of the same directory and space are published together, up
+  to batch_size. In parallel, a batch waits for the batches providing its parent
+  pages or, when no file provides them, for the first batch needing them, as
+  plan_waves() orders the files known upfront. A batch that would create a parent
+  page is held until the file providing that page is found, for up to
+  PIPELINE_QUEUE_SIZE batches or until the files run out; a provider found after
+  it is published after it, updating the page it created. A batch is only
+  submitted after the batches it waits for, so they are already running, and at
+  most 2 * concurrency batches are in flight.
+  """
+  def publish_items(batch: List[PreparedFile], log) -> Dict[str, PublishResult]:
+    files = {item.path: item.target for item in batch}
+    timeouts = {item.path: item.timeout for item in batch}
+    return publish_group(list(files), files, timeouts, log)
+
+  def batches() -> Iterator[List[PreparedFile]]:
+    batch = []
+    for item in prepared:
+      if batch and (len(batch) >= batch_size or (os.path.dirname(item.target), item.space) != (os.path.dirname(batch[0].target), batch[0].space)):
+        yield batch
+        batch = []
+      batch.append(item)
+    if batch:
+      yield batch
+
+  if concurrency <= 1:
+    for batch in batches():
+      results = publish_items(batch, logger)
+      for item in batch:
+        yield item, results[item.path]
+    return
+
+  # (space, title) of the pages -> batch publishing them, or first needing them when no file provides them
+  providers: Dict[Tuple[Optional[str], str], ScheduledBatch] = {}
+  pioneers: Dict[Tuple[Optional[str], str], ScheduledBatch] = {}
+  # (space, title) of the pages no file provides yet -> batches needing them, the pioneer first
+  held: Dict[Tuple[Optional[str], str], List[ScheduledBatch]] = {}
+  # not submitted yet, in order
+  pending: List[ScheduledBatch] = []
+  in_flight = set()
+
+  def resolve(key: Tuple[Optional[str], str], owner: ScheduledBatch):
+    """The batches held for the page wait for its owner, found or the pioneer."""
+    for scheduled in held.pop(key, []):
+      scheduled.held_for.discard(key)
+      scheduled.wait_for(owner)
+
+  def release(scheduled: ScheduledBatch):
+    """Stop waiting for the files providing the parent pages, the batch creates them."""
+    for key in list(scheduled.held_for):
+      if pioneers.get(key) is scheduled:
+        resolve(key, scheduled)
+
+  def schedule(batch: List[PreparedFile]) -> ScheduledBatch:
+    scheduled = ScheduledBatch(batch)
+    for item in batch:
+      for parent in item.parents:
+        key = (item.space, parent)
+        if key in providers:
+          scheduled.wait_for(providers[key])
+        elif key in held:
+          held[key].append(scheduled)
+          scheduled.held_for.add(key)
+        elif key in pioneers:
+          scheduled.wait_for(pioneers[key])
+        else:
+          pioneers[key] = scheduled
+          held[key] = [scheduled]
+          scheduled.held_for.add(key)
+    for item in batch:
+      key = (item.space, item.title)
+      if not item.title or key in providers:
+        continue
+      providers[key] = scheduled
+      pioneer = pioneers.get(key)
+      if key in held and scheduled.depends_on(pioneer):
+        # the pioneer creates the page, the provider updates it after
+        resolve(key, pioneer)
+      elif key in held:
+        resolve(key, scheduled)
+      elif pioneer is not None:
+        # found too late, the page created by the pioneer is updated after it
+        scheduled.wait_for(pioneer)
+    return scheduled
+
+  def publish_after(scheduled: ScheduledBatch) -> Tuple[List[PreparedFile], dict, BufferedLog]:
+    try:
+      for dependency in scheduled.dependencies:
+        dependency.done.wait()
+      log = BufferedLog()
+      return scheduled.items, publish_items(scheduled.items, log), log
+    finally:
+      scheduled.done.set()
+
+  def submit_ready(executor):
+    submitted = True
+    while submitted:
+      submitted = False
+      for scheduled in list(pending):
+        if not scheduled.held_for and all(dependency.submitted for dependency in scheduled.dependencies):
+          pending.remove(scheduled)
+          scheduled.submitted = submitted = True
+          in_flight.add(executor.submit(publish_after, scheduled))
+
+  def completed(futures) -> Iterator[Tuple[PreparedFile, PublishResult]]:
+    for future in futures:
+      batch, results, log = future.result()
+      log.flush()
+      for item in batch:
+        yield item, results[item.path]
+
+  with ThreadPoolExecutor(max_workers=concurrency) as executor:
+    for batch in batches():
+      pending.append(schedule(batch))
+      if len(pending) > PIPELINE_QUEUE_SIZE:
+        # waited long enough for the files providing the parent pages
+        for scheduled in pending:
+          if scheduled.held_for:
+            release(scheduled)
+            break
+      submit_ready(executor)
+      while len(in_flight) >= 2 * concurrency:
+        finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+        yield from completed(finished)
+    for scheduled in list(pending):
+      release(scheduled)
+    submit_ready(executor)
+    while in_flight:
+      finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+      yield from completed(finished)
+
+
+class RunReport():
+  """Time spent in each phase of the run and outcome of each file.
+
+  Each file is written to the JSON lines report, and to the journal of the run if
+  any, as soon as it is recorded; only the counters, the slowest files and bounded
+  samples of the failures and of the files not attempted are kept in memory.
+  """
+
+  def __init__(self, path: Optional[str] = None, journal: Optional["ProgressJournal"] = None):
+    self.started = time.perf_counter()
+    self.phases = {}
+    self.counters = dict.fromkeys([OUTCOME_SUCCESS, OUTCOME_FAILURE, OUTCOME_NOT_ATTEMPTED, OUTCOME_UNCHANGED, OUTCOME_SKIPPED], 0)
+    # min heap of (duration, -sequence, file): the fastest, then the latest, of the slowest files on top
+    self.slowest = []
+    self.failures = []
+    self.not_attempted = []
+    # seconds until the first publish outcome
+    self.first_publish = None
+    # why the files not attempted were left out
+    self.stop_reason = None
+    self.lock = threading.Lock()
+    self.journal = journal
+    self.output = None
+    if path:
+      os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+      self.output = open(path, "w")
+
+  @contextmanager
+  def timed(self, phase: str):
+    """Add the time spent in the block to the phase."""
+    started = time.perf_counter()
+    try:
+      yield
+    finally:
+      elapsed = time.perf_counter() - started
+      with self.lock:
+        self.phases[phase] = self.phases.get(phase, 0) + elapsed
+
+  def timed_iter(self, phase: str, iterable: Iterable) -> Iterator:
+    """Iterate, adding the time spent producing each item to the phase."""
+    iterator = iter(iterable)
+    while True:
+      with self.timed(phase):
+        item = next(iterator, _END)
+      if item is _END:
+        return
+      yield item
+
+  def record_file(self, path: str, outcome: str, size: int = 0, result: Optional[PublishResult] = None, digest: Optional[str] = None):
+    global cfg
+    file = {
+      "path": os.path.relpath(path, cfg.github.WORKSPACE),
+      "outcome": outcome,
+      "bytes": size,
+      "duration": round(result.duration, 3) if result else 0,
+      "retries": max(0, result.attempts - 1) if result else 0,
+    }
+    with self.lock:
+      self.counters[outcome] += 1
+      if self.output:
+        self.output.write(json.dumps({"type": "file", **file}) + "\n")
+      if outcome in [OUTCOME_SUCCESS, OUTCOME_FAILURE]:
+        if self.first_publish is None:
+          self.first_publish = time.perf_counter() - self.started
+        entry = (file["duration"], -sum(self.counters.values()), file)
+        if len(self.slowest) < REPORT_SLOWEST_FILES:
+          heapq.heappush(self.slowest, entry)
+        else:
+          heapq.heappushpop(self.slowest, entry)
+      if outcome == OUTCOME_FAILURE and len(self.failures) < REPORT_FAILED_FILES:
+        errors = (result.errors or b"").decode(errors="replace").strip().splitlines() if result else []
+        self.failures.append((file["path"], errors[-1] if errors else ""))
+      if outcome == OUTCOME_NOT_ATTEMPTED and len(self.not_attempted) < REPORT_NOT_ATTEMPTED_FILES:
+        self.not_attempted.append(file["path"])
+    if self.journal:
+      self.journal.record(file["path"], outcome, digest)
+
+  def get_counters(self) -> dict:
+    return dict(self.counters)
+
+  def get_summary(self) -> dict:
+    summary = {
+      "duration": round(time.perf_counter() - self.started, 3),
+      "phases": {phase: round(seconds, 3) for phase, seconds in self.phases.items()},
+      "counters": self.get_counters(),
+    }
+    if self.first_publish is not None:
+      summary["first_publish"] = round(self.first_publish, 3)
+    if self.stop_reason:
+      summary["stop_reason"] = self.stop_reason
+    return summary
+
+  def close(self):
+    """Write the summary line after the files, if writing a report."""
+    if self.output:
+      self.output.write(json.dumps({"type": "summary", **self.get_summary()}) + "\n")
+      self.output.close()
+      self.output = None
+
+  def write_step_summary(self, path: str):
+    summary = self.get_summary()
+    counters = summary["counters"]
+    lines = [
+      "### mark2confluence",
+      "",
+      "| Success | Failures | Not attempted | Unchanged | Skipped | Duration |",
+      "| ---: | ---: | ---: | ---: | ---: | ---: |",
+      f"| {counters[OUTCOME_SUCCESS]} | {counters[OUTCOME_FAILURE]} | {counters[OUTCOME_NOT_ATTEMPTED]} | {counters[OUTCOME_UNCHANGED]} | {counters[OUTCOME_SKIPPED]} | {summary['duration']:.1f}s |",
+      "",
+      "| Phase | Duration |",
+      "| --- | ---: |",
+    ]
+    lines += [f"| {phase} | {seconds:.1f}s |" for phase, seconds in summary["phases"].items()]
+    slowest = [file for _, _, file in sorted(self.slowest, key=lambda entry: entry[:2], reverse=True)]
+    if slowest:
+      lines += [
+        "",
+        "| Slowest files | Outcome | Duration | Size | Retries |",
+        "| --- | --- | ---: | ---: | ---: |",
+      ]
+      lines += [
+        f"| {file['path']} | {file['outcome']} | {file['duration']:.1f}s | {file['bytes'] / 1024:.1f} KB | {file['retries']} |"
+        for file in slowest
+      ]
+    if self.failures:
+      lines += ["", f"**{counters[OUTCOME_FAILURE]} files failed**:", ""]
+      lines += [f"- {path}: `{error}`" if error else f"- {path}" for path, error in self.failures]
+      if counters[OUTCOME_FAILURE] > len(self.failures):
+        lines.append(f"- and {counters[OUTCOME_FAILURE] - len(self.failures)} more")
+    if self.not_attempted:
+      lines += ["", f"**{counters[OUTCOME_NOT_ATTEMPTED]} files not attempted** ({self.stop_reason}):", ""]
+      lines += [f"- {path}" for path in self.not_attempted]
+      if counters[OUTCOME_NOT_ATTEMPTED] > len(self.not_attempted):
+        lines.append(f"- and {counters[OUTCOME_NOT_ATTEMPTED] - len(self.not_attempted)} more")
+    with open(path, "a") as f:
+      f.write("\n".join(lines) + "\n")
+
+
+def get_report_path() -> Optional[str]:
+  global cfg
+  return os.path.join(cfg.github.WORKSPACE, cfg.inputs.REPORT_PATH) if cfg.inputs.REPORT_PATH else None
+
+
+def get_mark_version() -> str:
+  try:
+    out = subprocess.run(["mark", "--version"], capture_output=True, text=True, timeout=30).stdout
+  except (OSError, subprocess.TimeoutExpired) as e:
+    logger.warning(f"Unable to get the mark version: {e}")
+    return "unknown"
+  return out.strip() or "unknown"
+
+
+def get_native_version() -> str:
+  from mark2confluence import confluence
+  return f"native {confluence.markdown.__version__}"
+
+
+class PublishCache():
+  """Content digests of the last successful publish of each file.
+
+  The digest covers the final content sent to mark (source, injected parents
+  and rendered header template) plus a fingerprint of the mark version and the
+  run configuration, so any of them changing invalidates the entry.
+  """
+
+  def __init__(self, directory: str, fingerprint: str):
+    self.directory = directory
+    self.fingerprint = fingerprint
+    self.path = os.path.join(directory, CACHE_FILE_NAME)
+    self.entries = {}
+    # DEFAULT_PARENTS of the last run without failures, used to select the
+    # files whose parents changed in incremental mode
+    self.default_parents = None
+    if os.path.exists(self.path):
+      try:
+        with open(self.path, "r") as f:
+          data = json.load(f)
+        self.entries = data.get("files", {})
+        self.default_parents = data.get("default_parents")
+      except (OSError, ValueError, AttributeError) as e:
+        logger.warning(f"Ignoring unreadable cache {self.path}: {e}")
+        self.entries = {}
+
+  def digest(self, content: str, references: str = "") -> str:
+    """Digest of the content, and of the local files it references when given, see get_references_digest()."""
+    if references:
+      content = f"{content}\0{references}"
+    return hashlib.sha256(f"{self.fingerprint}\0{content}".encode()).hexdigest()
+
+  def is_unchanged(self, key: str, digest: str) -> bool:
+    entry = self.entries.get(key)
+    return entry is not None and entry.get("digest") == digest
+
+  def record(self, key: str, digest: str, duration: Optional[float] = None):
+    self.entries[key] = {
+      "digest": digest,
+      "published_at": datetime.now().isoformat(timespec="seconds"),
+    }
+    if duration is not None:
+      self.entries[key]["duration"] = round(duration, 3)
+
+  def get_priority(self, key: str, digest: str) -> Tuple[bool, float]:
+    """Sort key publishing the changed files first, then the longest ones according to the last publish."""
+    entry = self.entries.get(key) or {}
+    return (entry.get("digest") == digest, -entry.get("duration", 0))
+
+  def save(self):
+    os.makedirs(self.directory, exist_ok=True)
+    tmp_path = f"{self.path}.tmp"
+    with open(tmp_path, "w") as f:
+      json.dump({"files": self.entries, "default_parents": self.default_parents}, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, self.path)
+
+
+# the local files a page references: images, Attachment headers and Include templates
+LOCAL_IMAGE_LINK_REGEX = re.compile(r"!\[[^\]]*\]\((?![a-z]+://)([^)\s#?]+)")
+REFERENCE_HEADER_REGEX = re.compile(r"^\s*<!--\s*(?:Attachment|Include):\s*(?!ac:)(.+?)\s*-->", re.IGNORECASE | re.MULTILINE)
+
+@lru_cache(maxsize=4096)
+def _get_file_digest(path: str, size: int, mtime_ns: int) -> str:
+  """Digest of the content of a file, memoized while its size and modification time do not change."""
+  sha = hashlib.sha256()
+  with open(path, "rb") as f:
+    for chunk in iter(lambda: f.read(1 << 20), b""):
+      sha.update(chunk)
+  return sha.hexdigest()
+
+def get_references_digest(content: str, directory: str) -> str:
+  """The local files referenced by the page, as they are written, with the digest of their content.
+
+  mark uploads the images and attachments and renders the includes, so a page
+  changes when they do. A missing file is recorded as such, to notice when it
+  appears. The content is hashed rather than the modification time, which every
+  checkout resets.
+  """
+  references = set(LOCAL_IMAGE_LINK_REGEX.findall(content)) | set(REFERENCE_HEADER_REGEX.findall(content))
+  lines = []
+  for reference in sorted(references):
+    path = os.path.join(directory, reference)
+    try:
+      stat = os.stat(path)
+      digest = _get_file_digest(os.path.abspath(path), stat.st_size, stat.st_mtime_ns) if os.path.isfile(path) else "not a file"
+    except OSError:
+      digest = "missing"
+    lines.append(f"{reference}\0{digest}")
+  return "\n".join(lines)
+
+def get_publish_cache() -> Optional[PublishCache]:
+  global cfg
+  if not cfg.inputs.CACHE_DIR:
+    return None
+  fingerprint = "\0".join([
+    get_mark_version() if cfg.inputs.BACKEND == BACKEND_MARK else get_native_version(),
+    cfg.inputs.ACTION,
+    cfg.inputs.CONFLUENCE_BASE_URL,
+    cfg.inputs.MERMAID_PROVIDER,
+  ])
+  return PublishCache(os.path.join(cfg.github.WORKSPACE, cfg.inputs.CACHE_DIR), fingerprint)
+
+
+# inputs changing how the run goes but not what it publishes, a resumed run may raise a timeout or the budget
+JOURNAL_IGNORED_INPUTS = [
+  "CONFLUENCE_PASSWORD", "RESUME", "JOURNAL_PATH", "REPORT_PATH", "MARK_LOG_DIR", "PROFILE", "PROFILE_DIR",
+  "LOGURU_LEVEL", "MARK_LOG_LEVEL", "CONCURRENCY", "BATCH_SIZE", "TIMEOUT", "TIMEOUT_PER_KB", "TIMEOUT_PER_ATTACHMENT",
+  "RETRIES", "RETRY_BACKOFF", "RATE_LIMIT", "TIME_BUDGET", "FAIL_FAST", "PREFLIGHT", "STAGING_DIR",
+]
+JOURNAL_PUBLISHED_OUTCOMES = [OUTCOME_SUCCESS, OUTCOME_UNCHANGED]
+
+class ProgressJournal():
+  """Outcome of each file, appended and fsync'd as soon as it is known, to resume an interrupted run.
+
+  Every line holds the key of the run, a digest of the commit and of the inputs,
+  and the digest of the content published. A resumed run only trusts the lines
+  of the same key, and skips the files whose content is the one already published.
+  """
+
+  def __init__(self, path: str, key: str, resume: bool = False):
+    self.path = path
+    self.key = key
+    # relative path -> digest of the content published
+    self.published: Dict[str, str] = {}
+    lines = []
+    if resume and os.path.exists(path):
+      with open(path, "r") as f:
+        for line in f:
+          try:
+            entry = json.loads(line)
+          except ValueError:
+            # the last line of a killed run may be truncated
+            continue
+          if not isinstance(entry, dict) or entry.get("key") != key:
+            continue
+          lines.append(line if line.endswith("\n") else f"{line}\n")
+          if entry.get("outcome") in JOURNAL_PUBLISHED_OUTCOMES and entry.get("digest"):
+            self.published[entry["path"]] = entry["digest"]
+          elif entry.get("outcome") == OUTCOME_FAILURE:
+            self.published.pop(entry.get("path"), None)
+    # the lines of other runs are dropped
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+      f.writelines(lines)
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    self.output = open(path, "a")
+    self.lock = threading.Lock()
+
+  def digest(self, content: str, references: str = "") -> str:
+    if references:
+      content = f"{content}\0{references}"
+    return hashlib.sha256(content.encode()).hexdigest()
+
+  def is_published(self, path: str, digest: str) -> bool:
+    return self.published.get(path) == digest
+
+  def record(self, path: str, outcome: str, digest: Optional[str] = None):
+    line = json.dumps({
+      "key": self.key,
+      "path": path,
+      "outcome": outcome,
+      "digest": digest,
+      "time": datetime.now().isoformat(timespec="seconds"),
+    })
+    with self.lock:
+      if self.output:
+        self.output.write(f"{line}\n")
+        self.output.flush()
+        os.fsync(self.output.fileno())
+
+  def close(self):
+    with self.lock:
+      if self.output:
+        self.output.close()
+        self.output = None
+
+
+def get_commit_sha() -> str:
+  global cfg
+  if cfg.github.get("SHA"):
+    return cfg.github.SHA
+  try:
+    return subprocess.run(["git", "rev-parse", "HEAD"], cwd=cfg.github.WORKSPACE, capture_output=True, text=True, timeout=30).stdout.strip()
+  except (OSError, subprocess.TimeoutExpired):
+    return ""
+
+def get_journal_key() -> str:
+  """Digest of the commit and of the inputs, the secrets and the inputs in JOURNAL_IGNORED_INPUTS excluded."""
+  global cfg
+  inputs = {key: value for key, value in cfg.inputs.items() if key not in JOURNAL_IGNORED_INPUTS}
+  return hashlib.sha256(json.dumps({"commit": get_commit_sha(), "inputs": inputs}, sort_keys=True).encode()).hexdigest()[:16]
+
+def get_progress_journal() -> Optional[ProgressJournal]:
+  global cfg
+  resume = is_enabled(cfg.inputs.RESUME)
+  if not cfg.inputs.JOURNAL_PATH:
+    if resume:
+      logger.error("Setup error, RESUME: needs a JOURNAL_PATH")
+      exit(1)
+    return None
+  journal = ProgressJournal(os.path.join(cfg.github.WORKSPACE, cfg.inputs.JOURNAL_PATH), get_journal_key(), resume)
+  if resume:
+    logger.info(f"Resuming the run recorded in {journal.path}: {len(journal.published)} files already published")
+  return journal
+
+
+MERMAID_FENCE_REGEX = re.compile(r"^```mermaid\s*$")
+MERMAID_RENDER_TIMEOUT = 120
+
+class MermaidCache():
+  """Mermaid diagrams rendered once and stored by the digest of their source, reused across runs.
+
+  Diagrams missing from the cache are rendered with the MERMAID_RENDERER command;
+  when it fails the diagram is left to mark and MERMAID_PROVIDER.
+  """
+
+  def __init__(self, directory: str, renderer: str):
+    self.directory = directory
+    self.renderer = renderer
+    self.images: Dict[str, Optional[str]] = {}
+    self.counters = {"cached": 0, "rendered": 0, "failed": 0}
+    os.makedirs(self.directory, exist_ok=True)
+
+  def get_image(self, source: str) -> Optional[str]:
+    digest = hashlib.sha256(f"{self.renderer}\0{source}".encode()).hexdigest()
+    if digest in self.images:
+      return self.images[digest]
+    path = os.path.join(self.directory, f"{digest}.png")
+    if os.path.isfile(path):
+      self.counters["cached"] += 1
+    elif self._render(source, path):
+      self.counters["rendered"] += 1
+    else:
+      self.counters["failed"] += 1
+      path = None
+    self.images[digest] = path
+    return path
+
+  def _render(self, source: str, path: str) -> bool:
+    with tempfile.TemporaryDirectory(dir=self.directory) as tmp_dir:
+      input_path = os.path.join(tmp_dir, "diagram.mmd")
+      output_path = os.path.join(tmp_dir, "diagram.png")
+      with open(input_path, "w") as f:
+        f.write(source)
+      args = [arg.format(input=input_path, output=output_path) for arg in shlex.split(self.renderer)]
+      try:
+        proc = subprocess.run(args, capture_output=True, timeout=MERMAID_RENDER_TIMEOUT)
+      except (OSError, subprocess.TimeoutExpired) as e:
+        logger.warning(f"Unable to render a mermaid diagram, leaving it to mark: {e}")
+        return False
+      if proc.returncode != 0 or not os.path.isfile(output_path):
+        logger.warning(f"Unable to render a mermaid diagram, leaving it to mark: {proc.stderr.decode().strip()}")
+        return False
+      os.replace(output_path, path)
+    return True
+
+
+def get_mermaid_cache() -> Optional[MermaidCache]:
+  global cfg
+  if not cfg.inputs.MERMAID_CACHE_DIR:
+    return None
+  renderer = cfg.inputs.MERMAID_RENDERER
+  try:
+    arguments = shlex.split(renderer)
+  except ValueError as e:
+    logger.error(f"Setup error, MERMAID_RENDERER: {e}")
+    exit(1)
+  if not any("{input}" in arg for arg in arguments) or not any("{output}" in arg for arg in arguments):
+    logger.error("Setup error, MERMAID_RENDERER must contain the {input} and {output} placeholders")
+    exit(1)
+  return MermaidCache(os.path.join(cfg.github.WORKSPACE, cfg.inputs.MERMAID_CACHE_DIR), renderer)
+
+
+def is_enabled(value: str) -> bool:
+  return str(value).strip().lower() in ["true", "yes", "1"]
+
+
+MARK_HEADERS = ["Space", "Parent", "Title"]
+COMMENT_LINE_REGEX = re.compile("^<!--.*-->$")
+OPENING_COMMENT_REGEX = re.compile("^<!--")
+CLOSING_COMMENT_REGEX = re.compile("-->$")
+HEADER_LINE_REGEX = re.compile(r"^<!--\s*([^:]+?):\s*(.*?)\s*-->$")
+
+@lru_cache(maxsize=None)
+def _mark_headers_regex(headers: Tuple[str, ...]) -> re.Pattern:
+  return re.compile(f"^<!--.?({'|'.join(headers)}):.*-->", re.IGNORECASE)
+
+def begins_with_mark_headers(path: str, headers: List[str] = MARK_HEADERS) -> bool:
+  with open(path, 'r') as f:
+    first_row = f.readline()
+  return _mark_headers_regex(tuple(headers)).match(first_row) is not None
 
 def begins_with_mark_space_header(path: str):
   return begins_with_mark_headers(path, ["Space"])
@@ -152,71 +1420,712 @@ def begins_with_mark_space_header(path: str):
 class MultilineCommentIsOpenException(Exception):
     pass
 
-def inject_header_before_first_line_of_content(path: str, header: str) -> Tuple[List[str], int]:
-  def is_comment_line(line: str) -> bool:
-    return re.compile("^<!--.*-->$").match(line.strip())
-  def is_opening_comment_line(line: str) -> bool:
-    return re.compile("^<!--").match(line.strip()) and not is_comment_line(line)
-  def is_closing_comment_line(line: str) -> bool:
-    return re.compile("-->$").match(line.strip()) and not is_comment_line(line)
-
-  file_lines = list()
-  with open(path, 'r') as f:
-    file_lines = f.readlines()
+class MarkdownDocument():
+  """A markdown file read once, transformed in memory and written at most once."""
+
+  def __init__(self, path: str, lines: List[str]):
+    self.path = path
+    self.lines = lines
+    self.modified = False
+    # (beginning of content index, mark headers), computed on demand
+    self._header_block = None
+
+  @classmethod
+  def load(cls, path: str) -> "MarkdownDocument":
+    with open(path, 'r') as f:
+      return cls(path, f.readlines())
+
+  @property
+  def content(self) -> str:
+    return "".join(self.lines)
+
+  def begins_with_mark_headers(self, headers: List[str] = MARK_HEADERS) -> bool:
+    return bool(self.lines) and _mark_headers_regex(tuple(headers)).match(self.lines[0]) is not None
 
-  beginning_of_content_index = 0
-  is_inside_multiline_comment = False
-  for line in file_lines:
-      if is_opening_comment_line(line):
+  def begins_with_mark_space_header(self) -> bool:
+    return self.begins_with_mark_headers(["Space"])
+
+  def get_header(self, name: str) -> Optional[str]:
+    """The value of the first mark header with the given name, case insensitive."""
+    return next((value for key, value in self.headers if key.lower() == name.lower()), None)
+
+  def get_headers(self, name: str) -> List[str]:
+    """The values of all the mark headers with the given name, in order, case insensitive."""
+    return [value for key, value in self.headers if key.lower() == name.lower()]
+
+  def _parse_header_block(self) -> Tuple[int, List[Tuple[str, str]]]:
+    if self._header_block is not None:
+      return self._header_block
+
+    beginning_of_content_index = 0
+    is_inside_multiline_comment = False
+    headers = []
+    for line in self.lines:
+      stripped = line.strip()
+      is_comment_line = COMMENT_LINE_REGEX.match(stripped) is not None
+      if not is_comment_line and OPENING_COMMENT_REGEX.match(stripped):
         is_inside_multiline_comment = True
-      elif is_closing_comment_line(line):
+      elif not is_comment_line and CLOSING_COMMENT_REGEX.match(stripped):
         is_inside_multiline_comment = False
-      elif line.strip() != "" and not is_inside_multiline_comment and not is_comment_line(line):
+      elif stripped != "" and not is_inside_multiline_comment and not is_comment_line:
         break
+      elif is_comment_line and not is_inside_multiline_comment:
+        header = HEADER_LINE_REGEX.match(stripped)
+        if header:
+          headers.append((header.group(1), header.group(2)))
       beginning_of_content_index += 1
 
-  if is_inside_multiline_comment:
-    raise MultilineCommentIsOpenException(f"The file {path} has multiline comments in it that are not closed.")
+    if is_inside_multiline_comment:
+      raise MultilineCommentIsOpenException(f"The file {self.path} has multiline comments in it that are not closed.")
 
-  file_lines.insert(beginning_of_content_index, header)
-  with open(path, "w") as f:
-    f.writelines(file_lines)
-  return (file_lines, beginning_of_content_index)
+    self._header_block = (beginning_of_content_index, headers)
+    return self._header_block
 
+  @property
+  def headers(self) -> List[Tuple[str, str]]:
+    """The `<!-- Key: Value -->` comments before the beginning of the content."""
+    return self._parse_header_block()[1]
 
-def get_files_by_doc_dir_pattern() -> list():
+  def inject_default_parents(self, default_parents_cfg: "List[ParentCfg] | DefaultParentsIndex") -> Optional["ParentCfg"]:
+    if self.begins_with_mark_space_header():
+      return None
+    parent_cfg = get_default_parent(os.path.dirname(os.path.abspath(self.path)), default_parents_cfg)
+    if parent_cfg:
+      self.lines[0:0] = parent_cfg.get_header().splitlines(keepends=True)
+      self.modified = True
+      self._header_block = None
+    return parent_cfg
+
+  def inject_header(self, header: str) -> int:
+    beginning_of_content_index, _ = self._parse_header_block()
+    # the header is kept as a single element; the parsed header block above it stays valid
+    self.lines.insert(beginning_of_content_index, header)
+    self.modified = True
+    return beginning_of_content_index
+
+  def replace_mermaid_blocks(self, mermaid_cache: "MermaidCache", published_path: Optional[str] = None) -> int:
+    """Replace the mermaid code blocks rendered by the cache with images, return how many were replaced.
+
+    The images are linked relatively to published_path, where the document is
+    written for mark, its own path by default.
+    """
+    directory = os.path.dirname(os.path.abspath(published_path or self.path))
+    replaced = 0
+    index = 0
+    while index < len(self.lines):
+      if MERMAID_FENCE_REGEX.match(self.lines[index]) is None:
+        index += 1
+        continue
+      end = next((i for i in range(index + 1, len(self.lines)) if self.lines[i].strip() == "```"), None)
+      if end is None:
+        break
+      image = mermaid_cache.get_image("".join(self.lines[index + 1:end]))
+      if image is None:
+        index = end + 1
+        continue
+      self.lines[index:end + 1] = [f"![mermaid diagram]({os.path.relpath(image, directory)})\n"]
+      self.modified = True
+      self._header_block = None
+      replaced += 1
+      index += 1
+    return replaced
+
+  def save(self, path: Optional[str] = None) -> bool:
+    """Write the document to its own path, or to another one if its content differs."""
+    if path is None:
+      if not self.modified:
+        return False
+      path = self.path
+    elif os.path.islink(path):
+      # never write through a link to the workspace
+      os.unlink(path)
+    elif os.path.isfile(path):
+      with open(path, 'r') as f:
+        if f.read() == self.content:
+          return False
+    with open(path, "w") as f:
+      f.writelines(self.lines)
+    if path == self.path:
+      self.modified = False
+    return True
+
+class StagingArea():
+  """Mirror of the workspace where the transformed documents are written.
+
+  The directories leading to a staged document are real directories whose
+  other entries are symlinks to the workspace, so relative images and
+  includes resolve as they would in the workspace, which is never written.
+  """
+
+  def __init__(self, workspace: str, directory: str):
+    self.workspace = os.path.abspath(workspace)
+    self.directory = os.path.abspath(directory)
+    self._materialized = set()
+
+  def _materialize(self, relative_dir: str) -> str:
+    target = os.path.join(self.directory, relative_dir)
+    if relative_dir in self._materialized:
+      return target
+    if relative_dir:
+      self._materialize(os.path.dirname(relative_dir))
+    if os.path.islink(target):
+      os.unlink(target)
+    os.makedirs(target, exist_ok=True)
+    with os.scandir(os.path.join(self.workspace, relative_dir)) as entries:
+      for entry in entries:
+        link = os.path.join(target, entry.name)
+        # a STAGING_DIR in the workspace is not mirrored into itself
+        if entry.path != self.directory and not os.path.lexists(link):
+          os.symlink(entry.path, link)
+    self._materialized.add(relative_dir)
+    return target
+
+  def refresh(self):
+    """Link the workspace entries created since the directories were mirrored, on their next use."""
+    self._materialized.clear()
+
+  def get_path(self, path: str) -> str:
+    """Path of the staged copy of a file of the workspace."""
+    relative_path = os.path.relpath(os.path.abspath(path), self.workspace)
+    if relative_path.startswith(f"..{os.sep}"):
+      raise ValueError(f"The file {path} is outside of the workspace {self.workspace}")
+    return os.path.join(self.directory, relative_path)
+
+  def stage(self, document: MarkdownDocument) -> str:
+    relative_path = os.path.relpath(self.get_path(document.path), self.directory)
+    staged_path = os.path.join(self._materialize(os.path.dirname(relative_path)), os.path.basename(relative_path))
+    document.save(staged_path)
+    return staged_path
+
+def get_staging_dir() -> Optional[str]:
+  """The STAGING_DIR directory, relative to the workspace, when STAGING is enabled."""
   global cfg
+  if not is_enabled(cfg.inputs.STAGING) or not cfg.inputs.STAGING_DIR:
+    return None
+  return os.path.abspath(os.path.join(cfg.github.WORKSPACE, cfg.inputs.STAGING_DIR))
 
+def get_staging_area() -> Tuple[Optional[StagingArea], Optional[str]]:
+  """Return the staging area and the temporary directory to remove once done, if any."""
+  global cfg
+  if not is_enabled(cfg.inputs.STAGING):
+    return None, None
+  staging_dir = get_staging_dir()
+  if staging_dir:
+    workspace = os.path.abspath(cfg.github.WORKSPACE)
+    if os.path.commonpath([staging_dir, workspace]) == staging_dir:
+      logger.error(f"Setup error, STAGING_DIR must not contain the workspace, provided: {cfg.inputs.STAGING_DIR}")
+      exit(1)
+    return StagingArea(workspace, staging_dir), None
+  # prefer tmpfs
+  base_dir = "/dev/shm" if os.access("/dev/shm", os.W_OK) else tempfile.gettempdir()
+  directory = tempfile.mkdtemp(prefix="mark2confluence-", dir=base_dir)
+  return StagingArea(cfg.github.WORKSPACE, directory), directory
+
+def inject_header_before_first_line_of_content(path: str, header: str) -> Tuple[List[str], int]:
+  document = MarkdownDocument.load(path)
+  beginning_of_content_index = document.inject_header(header)
+  document.save()
+  return (document.lines, beginning_of_content_index)
+
+
+def check_doc_dir_pattern(doc_dir_pattern: str) -> re.Pattern:
   try:
-    pattern = re.compile(cfg.inputs.DOC_DIR_PATTERN)
+    return re.compile(doc_dir_pattern)
   except re.error as e:
     logger.error(f"Setup error, DOC_DIR_PATTERN: {e}")
     exit(1)
 
+def is_excluded_directory(relative_dir: str, exclude_dirs: List[str]) -> bool:
+  """Whether the directory name or its path relative to the workspace matches one of the EXCLUDE_DIRS globs."""
+  name = os.path.basename(relative_dir)
+  return any(fnmatch(name, glob) or fnmatch(relative_dir, glob.rstrip("/")) for glob in exclude_dirs)
+
+def get_exclude_dirs() -> List[str]:
+  """The EXCLUDE_DIRS globs, plus STAGING_DIR when it is in the workspace so the staged copies are never found."""
+  global cfg
+  exclude_dirs = cfg.inputs.EXCLUDE_DIRS.split()
+  staging_dir = get_staging_dir()
+  if staging_dir:
+    relative_dir = os.path.relpath(staging_dir, cfg.github.WORKSPACE)
+    if not relative_dir.startswith(f"..{os.sep}") and relative_dir != "..":
+      # escaped, and with a trailing slash so that only this path matches and not every directory of the same name
+      exclude_dirs.append(re.sub(r"([*?[])", r"[\1]", relative_dir) + "/")
+  return exclude_dirs
+
+def is_in_excluded_directory(path: str, exclude_dirs: List[str]) -> bool:
+  global cfg
+  relative_dir = os.path.dirname(os.path.relpath(path, cfg.github.WORKSPACE))
+  while relative_dir:
+    if is_excluded_directory(relative_dir, exclude_dirs):
+      return True
+    relative_dir = os.path.dirname(relative_dir)
+  return False
+
+def get_git_ignored_paths(directory: str) -> set:
+  """Paths under the directory ignored by git, ignored directories are reported once without their content."""
+  args = ["git", "-C", directory, "ls-files", "-z", "--others", "--ignored", "--exclude-standard", "--directory"]
+  try:
+    proc = subprocess.run(args, capture_output=True, timeout=120)
+  except (OSError, subprocess.TimeoutExpired) as e:
+    logger.warning(f"Unable to list the files ignored by git: {e}")
+    return set()
+  if proc.returncode != 0:
+    logger.debug(f"Unable to list the files ignored by git: {proc.stderr.decode().strip()}")
+    return set()
+  return {os.path.join(directory, name.rstrip("/")) for name in proc.stdout.decode().split("\0") if name}
+
+def get_files_by_doc_dir_pattern() -> list():
+  return list(iter_files_by_doc_dir_pattern())
+
+def iter_files_by_doc_dir_pattern() -> Iterator[str]:
+  """The markdown files under DOC_DIR, yielded as the directories are scanned."""
+  global cfg
+
+  pattern = check_doc_dir_pattern(cfg.inputs.DOC_DIR_PATTERN)
+  exclude_dirs = get_exclude_dirs()
+  modified_interval = int(cfg.inputs.MODIFIED_INTERVAL)
+  min_mtime = None
+  if modified_interval > 0:
+    min_mtime = (datetime.now() - timedelta(minutes=modified_interval)).timestamp()
+
   topdir = os.path.join(cfg.github.WORKSPACE, cfg.inputs.DOC_DIR)
   logger.info(f"Searching into {topdir}")
+  ignored = get_git_ignored_paths(topdir) if is_enabled(cfg.inputs.RESPECT_GITIGNORE) else set()
+
+  skipped = {
+    "non markdown": 0,
+    "not matching DOC_DIR_PATTERN": 0,
+    "too old": 0,
+    "ignored by git": 0,
+    "excluded directories": 0,
+  }
+  found = 0
+  directories = [topdir]
+  while directories:
+    directory = directories.pop()
+    try:
+      with os.scandir(directory) as it:
+        entries = sorted(it, key=lambda entry: entry.name)
+    except OSError as e:
+      logger.warning(f"Unable to list {directory}: {e}")
+      continue
 
-  filtered_files = []
-  for root, dirs, files in os.walk( topdir ,topdown=True, followlinks=False):
-
-    for file in files:
-      # validate regexp on filepath
-      path = os.path.join(root,file)
-      if pattern.match(path) is None:
-        logger.info(f"Doesn't match DOC_DIR_PATTERN, skipping {path}")
-
-      ## validate modified time
-      elif int(cfg.inputs.MODIFIED_INTERVAL) > 0:
-        mtime: datetime = datetime.fromtimestamp(os.stat(path).st_mtime)
-        diff = (datetime.now() -
-                timedelta(minutes=int(cfg.inputs.MODIFIED_INTERVAL)))
-        if mtime < diff:
-          logger.info(f"Is too old, skipping ({mtime}) {path}")
+    subdirectories = []
+    for entry in entries:
+      path = entry.path
+      if entry.is_dir(follow_symlinks=False):
+        if path in ignored:
+          skipped["ignored by git"] += 1
+        elif exclude_dirs and is_excluded_directory(os.path.relpath(path, cfg.github.WORKSPACE), exclude_dirs):
+          skipped["excluded directories"] += 1
+        else:
+          subdirectories.append(path)
+      elif not entry.name.endswith(".md"):
+        skipped["non markdown"] += 1
+      elif entry.is_dir():
+        # symlinks to directories are not followed
+        continue
+      elif path in ignored:
+        skipped["ignored by git"] += 1
+      elif pattern.match(path) is None:
+        skipped["not matching DOC_DIR_PATTERN"] += 1
+      elif min_mtime is not None and entry.stat().st_mtime < min_mtime:
+        skipped["too old"] += 1
       else:
+        found += 1
+        yield path
+    # depth first, in name order
+    directories.extend(reversed(subdirectories))
+
+  logger.info(f"Found {found} files, skipped: {', '.join(f'{count} {reason}' for reason, count in skipped.items())}")
+
+def get_files_changed_since_base_ref(default_parents: "DefaultParentsIndex", previous_default_parents: Optional[str]) -> list:
+  """Select the files changed between BASE_REF and HEAD with a single git diff.
+
+  When the DEFAULT_PARENTS mapping differs from the one of the last run, the
+  files whose resolved parents changed are selected too. Without a mapping
+  recorded by a previous run, e.g. without CACHE_DIR, every file covered by
+  DEFAULT_PARENTS is selected. Falls back to the DOC_DIR discovery when the
+  diff cannot be computed.
+  """
+  global cfg
+
+  base_ref = cfg.inputs.BASE_REF
+  if re.fullmatch("0+", base_ref):
+    logger.info(f"BASE_REF {base_ref} has no history, processing every file")
+    return get_files_by_doc_dir_pattern()
+
+  pattern = check_doc_dir_pattern(cfg.inputs.DOC_DIR_PATTERN)
+  args = [
+    "git", "-C", cfg.github.WORKSPACE, "diff", "--name-only", "-z", "--relative",
+    "--diff-filter=d", f"{base_ref}...HEAD",
+  ]
+  if cfg.inputs.DOC_DIR:
+    args.extend(["--", cfg.inputs.DOC_DIR])
+  try:
+    proc = subprocess.run(args, capture_output=True, timeout=120)
+  except (OSError, subprocess.TimeoutExpired) as e:
+    logger.warning(f"Unable to diff against BASE_REF {base_ref}, processing every file: {e}")
+    return get_files_by_doc_dir_pattern()
+  if proc.returncode != 0:
+    logger.warning(f"Unable to diff against BASE_REF {base_ref}, processing every file: {proc.stderr.decode().strip()}")
+    return get_files_by_doc_dir_pattern()
+
+  changed_files = [os.path.join(cfg.github.WORKSPACE, name) for name in proc.stdout.decode().split("\0") if name]
+  exclude_dirs = get_exclude_dirs()
+  filtered_files = [
+    path for path in changed_files
+    if path.endswith(".md") and pattern.match(path) and not is_in_excluded_directory(path, exclude_dirs)
+  ]
+  logger.info(f"{len(filtered_files)} of {len(changed_files)} files changed since {base_ref} match DOC_DIR_PATTERN")
+
+  if previous_default_parents is None and cfg.inputs.DEFAULT_PARENTS:
+    logger.warning(
+      "DEFAULT_PARENTS of the last run unknown, set CACHE_DIR to record it; "
+      "selecting every file covered by DEFAULT_PARENTS"
+    )
+    previous_default_parents = ""
+  if previous_default_parents is not None and previous_default_parents != cfg.inputs.DEFAULT_PARENTS:
+    previous = DefaultParentsIndex(get_default_parents(previous_default_parents))
+    selected = set(filtered_files)
+    for path in get_files_by_doc_dir_pattern():
+      if path in selected or not path.endswith(".md"):
+        continue
+      file_dir = os.path.dirname(os.path.abspath(path))
+      if get_default_parent(file_dir, previous) != get_default_parent(file_dir, default_parents):
         filtered_files.append(path)
+        selected.add(path)
+    logger.info(f"DEFAULT_PARENTS changed since the last run, {len(filtered_files)} files selected")
 
   return filtered_files
 
+GIT_METADATA_VARIABLES = ["last_commit_sha", "last_commit_author", "last_commit_date", "last_commit_subject"]
+GIT_LOG_FORMAT = "%x1e%H%x1f%an%x1f%aI%x1f%s"
+
+class GitMetadataProvider():
+  """Last commit of the selected files, read incrementally from a single streamed git log pass.
+
+  The log is consumed only as far as needed to resolve the requested path, and
+  git is stopped once every selected file has been found. Without a selection,
+  when the files are discovered while processing them, every file of the log is
+  a candidate.
+  """
+
+  def __init__(self, workspace: str, paths: Optional[List[str]], pathspec: str = ""):
+    self.workspace = workspace
+    self.pending = None if paths is None else {os.path.relpath(path, workspace) for path in paths}
+    self.commits: Dict[str, dict] = {}
+    self.pathspec = pathspec
+    self.proc = None
+    self.entries = None
+
+  def _start(self):
+    args = ["git", "-C", self.workspace, "log", "--name-only", "-z", "--relative", f"--format={GIT_LOG_FORMAT}"]
+    if self.pathspec:
+      args.extend(["--", self.pathspec])
+    try:
+      self.proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except OSError as e:
+      logger.warning(f"Unable to read the git history, the commit variables of HEADER_TEMPLATE are empty: {e}")
+      return iter(())
+    return self._read_entries()
+
+  def _read_entries(self):
+    commit = None
+    buffer = b""
+    while True:
+      chunk = self.proc.stdout.read(65536)
+      if not chunk:
+        break
+      tokens = (buffer + chunk).split(b"\0")
+      buffer = tokens.pop()
+      for token in tokens:
+        token = token.lstrip(b"\n")
+        if token.startswith(b"\x1e"):
+          sha, author, date, subject = token[1:].decode(errors="replace").split("\x1f", 3)
+          commit = dict(zip(GIT_METADATA_VARIABLES, [sha, author, date, subject]))
+        elif token and commit:
+          yield os.fsdecode(token), commit
+    self.close()
+
+  def get_variables(self, path: str) -> dict:
+    key = os.path.relpath(path, self.workspace)
+    if self.entries is None:
+      self.entries = self._start()
+    while key not in self.commits and self.pending != set():
+      entry = next(self.entries, None)
+      if entry is None:
+        self.pending = set()
+        break
+      name, commit = entry
+      # the log is newest first, the first commit seen for a file is the last one touching it
+      if self.pending is None:
+        self.commits.setdefault(name, commit)
+      elif name in self.pending:
+        self.pending.discard(name)
+        self.commits[name] = commit
+    if self.pending == set():
+      self.close()
+    return self.commits.get(key, dict.fromkeys(GIT_METADATA_VARIABLES, ""))
+
+  def close(self):
+    if self.proc and self.proc.poll() is None:
+      self.proc.kill()
+    if self.proc:
+      self.proc.wait()
+      self.proc.stdout.close()
+
+def get_git_metadata_provider(template_source: str, files: Optional[List[str]]) -> Optional[GitMetadataProvider]:
+  """A provider of the commit variables, only when the header template uses them.
+
+  files is None when they are not known upfront.
+  """
+  global cfg
+
+  variables = jinja2.meta.find_undeclared_variables(jinja2.Environment().parse(template_source))
+  if not variables.intersection(GIT_METADATA_VARIABLES):
+    return None
+  return GitMetadataProvider(cfg.github.WORKSPACE, files, cfg.inputs.DOC_DIR)
+
+SHARD_PAGE_OVERHEAD_BYTES = 8192
+
+def get_subtree_key(path: str, default_parents: "DefaultParentsIndex") -> Tuple[str, str]:
+  """The space and the top level page of the page tree the file belongs to."""
+  document = MarkdownDocument.load(path) if path.endswith(".md") and os.path.isfile(path) else None
+  if not document or not document.begins_with_mark_headers():
+    return ("", path)
+  # in memory only, the file is written by the preparation
+  document.inject_default_parents(default_parents)
+  parents = document.get_headers("Parent")
+  return (document.get_header("Space") or "", parents[0] if parents else document.get_header("Title") or path)
+
+def get_shard(files: List[str], shard_index: int, shard_count: int, default_parents: "DefaultParentsIndex") -> List[str]:
+  """The files of one of shard_count shards, keeping each page tree in a single shard.
+
+  The page trees are assigned from the heaviest, by size plus a fixed cost per
+  page, to the least loaded shard. Every job of a matrix computes the same
+  assignment from the same checkout.
+  """
+  subtrees = {}
+  weights = {}
+  for path in files:
+    key = get_subtree_key(path, default_parents)
+    subtrees.setdefault(key, []).append(path)
+    weights[key] = weights.get(key, 0) + SHARD_PAGE_OVERHEAD_BYTES + (os.path.getsize(path) if os.path.isfile(path) else 0)
+
+  loads = [0] * shard_count
+  shards = {}
+  for key in sorted(subtrees, key=lambda key: (-weights[key], key)):
+    shard = min(range(shard_count), key=lambda index: (loads[index], index))
+    shards[key] = shard
+    loads[shard] += weights[key]
+
+  selected = {path for key, paths in subtrees.items() if shards[key] == shard_index for path in paths}
+  logger.info(
+    f"Shard {shard_index + 1}/{shard_count}: {len(selected)} of {len(files)} files, "
+    f"{sum(1 for shard in shards.values() if shard == shard_index)} of {len(subtrees)} page trees, "
+    f"load {loads[shard_index]} of {sum(loads)}"
+  )
+  return [path for path in files if path in selected]
+
+def check_backend(backend: str) -> str:
+  value = backend.strip().lower()
+  if value not in BACKENDS:
+    logger.error(f"Setup error, BACKEND: must be one of {', '.join(BACKENDS)}, provided: {backend}")
+    exit(1)
+  return value
+
+def get_confluence_client(pool_size: int):
+  """The client of the native backend, with a connection per worker, when it talks to Confluence."""
+  global cfg
+  if cfg.inputs.BACKEND != BACKEND_NATIVE:
+    return None
+  try:
+    from mark2confluence import confluence
+  except ImportError as e:
+    logger.error(f"Setup error, BACKEND: the native backend needs the markdown package: {e}")
+    exit(1)
+  if cfg.inputs.MERMAID_PROVIDER:
+    logger.warning("MERMAID_PROVIDER is not supported by the native backend, use MERMAID_CACHE_DIR to render the diagrams")
+  if cfg.inputs.ACTION == ACTION_VERIFY:
+    return None
+  try:
+    return confluence.ConfluenceClient(cfg.inputs.CONFLUENCE_BASE_URL, cfg.inputs.CONFLUENCE_USERNAME, cfg.inputs.CONFLUENCE_PASSWORD, pool_size)
+  except confluence.ConfluenceError as e:
+    logger.error(f"Setup error, CONFLUENCE_BASE_URL: {e}")
+    exit(1)
+
+PREFLIGHT_TIMEOUT = 30
+
+class Preflight():
+  """Checks of the Confluence access made once per run, instead of failing in every mark process.
+
+  The base URL and the credentials are checked before discovering the files, the
+  target spaces of the discovered files before publishing any of them. A space
+  only found while publishing, e.g. in a file saved in WATCH mode, is checked
+  before its first file.
+  """
+
+  def __init__(self, client, owns_client: bool = False):
+    self.client = client
+    self.owns_client = owns_client
+    # space key -> error, None when accessible
+    self.spaces: Dict[str, Optional[str]] = {}
+    self.lock = threading.Lock()
+
+  def _call(self, function, *args):
+    """Call the client, retrying the transient failures as configured by retry_policy, return the error if any."""
+    from mark2confluence.confluence import ConfluenceError
+
+    attempt = 1
+    while True:
+      try:
+        function(*args, timeout=PREFLIGHT_TIMEOUT)
+        return None
+      except ConfluenceError as e:
+        error = str(e)
+      if attempt > retry_policy.retries or not is_transient_failure(error.encode()):
+        return error
+      delay = retry_policy.get_delay(attempt)
+      logger.warning(f"Transient failure of the pre-flight check, retry {attempt}/{retry_policy.retries} in {delay:.1f}s: {error}")
+      time.sleep(delay)
+      attempt += 1
+
+  def check_credentials(self) -> Optional[str]:
+    return self._call(self.client.get_current_user)
+
+  def check_space(self, space: str) -> Optional[str]:
+    with self.lock:
+      if space not in self.spaces:
+        error = self._call(self.client.get_homepage, space)
+        self.spaces[space] = f"space {space} is not accessible: {error}" if error else None
+      return self.spaces[space]
+
+  def check_spaces(self, spaces: Iterable[str]) -> Optional[str]:
+    """Check every space, return the errors of the inaccessible ones if any."""
+    errors = [error for error in map(self.check_space, spaces) if error]
+    return "; ".join(errors) if errors else None
+
+  def close(self):
+    if self.owns_client:
+      self.client.close()
+
+def get_preflight(client) -> Optional[Preflight]:
+  """Check the base URL and the credentials once, exit when they are wrong.
+
+  The native backend shares its client, so that the spaces checked are not looked
+  up again. Skipped in verify mode, and without CONFLUENCE_BASE_URL as mark may
+  read it from its own configuration file.
+  """
+  global cfg
+  if cfg.inputs.ACTION == ACTION_VERIFY or not is_enabled(cfg.inputs.PREFLIGHT):
+    return None
+  if not cfg.inputs.CONFLUENCE_BASE_URL:
+    logger.info("CONFLUENCE_BASE_URL is not set, skipping the pre-flight check")
+    return None
+  owns_client = client is None
+  if owns_client:
+    try:
+      from mark2confluence import confluence
+    except ImportError as e:
+      logger.error(f"Setup error, PREFLIGHT: the pre-flight check needs the markdown package: {e}")
+      exit(1)
+    try:
+      client = confluence.ConfluenceClient(cfg.inputs.CONFLUENCE_BASE_URL, cfg.inputs.CONFLUENCE_USERNAME, cfg.inputs.CONFLUENCE_PASSWORD)
+    except confluence.ConfluenceError as e:
+      logger.error(f"Setup error, CONFLUENCE_BASE_URL: {e}")
+      exit(1)
+  preflight = Preflight(client, owns_client)
+  error = preflight.check_credentials()
+  if error:
+    preflight.close()
+    logger.error(f"Setup error, pre-flight check failed, check CONFLUENCE_BASE_URL, CONFLUENCE_USERNAME and CONFLUENCE_PASSWORD: {error}")
+    exit(1)
+  logger.info(f"Pre-flight check passed for {cfg.inputs.CONFLUENCE_BASE_URL}")
+  return preflight
+
+def get_target_spaces(files: Iterable[str], default_parents: "DefaultParentsIndex") -> List[str]:
+  """The distinct spaces the files publish to, from their headers and the injected DEFAULT_PARENTS."""
+  spaces = set()
+  for path in files:
+    try:
+      document = MarkdownDocument.load(path) if path[-3:] == '.md' else None
+    except (OSError, UnicodeDecodeError):
+      # reported when the file is prepared
+      continue
+    if not document or not document.begins_with_mark_headers():
+      continue
+    document.inject_default_parents(default_parents)
+    space = document.get_header("Space")
+    if space:
+      spaces.add(space)
+  return sorted(spaces)
+
+def check_on_conflict(on_conflict: str) -> str:
+  value = on_conflict.strip().lower()
+  if value not in ON_CONFLICT_VALUES:
+    logger.error(f"Setup error, ON_CONFLICT: must be one of {', '.join(ON_CONFLICT_VALUES)}, provided: {on_conflict}")
+    exit(1)
+  return value
+
+def check_int_input(name: str, minimum: int = 0) -> int:
+  global cfg
+  value = cfg.inputs[name]
+  try:
+    parsed = int(value)
+    if parsed < minimum:
+      raise ValueError
+    return parsed
+  except ValueError:
+    logger.error(f"Setup error, {name}: must be an integer >= {minimum}, provided: {value}")
+    exit(1)
+
+def check_float_input(name: str, minimum: float = 0) -> float:
+  global cfg
+  value = cfg.inputs[name]
+  try:
+    parsed = float(value)
+    if parsed < minimum:
+      raise ValueError
+    return parsed
+  except ValueError:
+    logger.error(f"Setup error, {name}: must be a number >= {minimum}, provided: {value}")
+    exit(1)
+
+LOCAL_IMAGE_REGEX = re.compile(r"!\[[^\]]*\]\((?![a-z]+://)[^)\s]+")
+ATTACHMENT_HEADER_REGEX = re.compile(r"^<!--\s*Attachment:", re.IGNORECASE | re.MULTILINE)
+MERMAID_BLOCK_REGEX = re.compile(r"^```mermaid", re.MULTILINE)
+
+@dataclass
+class TimeoutPolicy():
+  """Time allowed to mark for a page: a base plus allowances for its size and attachments."""
+  base: float
+  per_kb: float = 0
+  per_attachment: float = 0
+
+  def get_timeout(self, content: str) -> float:
+    timeout = self.base
+    if self.per_kb:
+      timeout += self.per_kb * len(content.encode()) / 1024
+    if self.per_attachment:
+      attachments = (
+        len(LOCAL_IMAGE_REGEX.findall(content))
+        + len(ATTACHMENT_HEADER_REGEX.findall(content))
+        + len(MERMAID_BLOCK_REGEX.findall(content))
+      )
+      timeout += self.per_attachment * attachments
+    return timeout
+
+def get_retry_policy() -> RetryPolicy:
+  return RetryPolicy(check_int_input("RETRIES"), check_float_input("RETRY_BACKOFF"))
+
+def get_timeout_policy() -> TimeoutPolicy:
+  return TimeoutPolicy(
+    check_float_input("TIMEOUT", minimum=1),
+    check_float_input("TIMEOUT_PER_KB"),
+    check_float_input("TIMEOUT_PER_ATTACHMENT"),
+  )
+
 def check_header_template(header_template: str):
   try:
     return jinja2.Template(header_template)
@@ -277,59 +2186,537 @@ def get_default_parents(parents_string: str) -> List[ParentCfg]:
   default_parents.sort(key=lambda cfg: len(cfg.directory), reverse=True)
   return default_parents
 
-def inject_default_parents(path: str, default_parents_cfg: List[ParentCfg]):
-  file_dir = f"{os.path.dirname(os.path.abspath(path))}"
+class DefaultParentsIndex():
+  """DEFAULT_PARENTS compiled into a single matcher and resolved once per directory.
+
+  The globs are tried in the order of the list, sorted by get_default_parents()
+  with the longest first, so the first match is the one
+  ParentCfg.is_directory_included() would select.
+  """
+
+  def __init__(self, default_parents_cfg: List[ParentCfg], workspace: Optional[str] = None):
+    global cfg
+    self.default_parents_cfg = default_parents_cfg
+    self.workspace = cfg.github.WORKSPACE if workspace is None else workspace
+    self._regex = None
+    if default_parents_cfg:
+      self._regex = re.compile("|".join(
+        f"(?P<parent{index}>{translate(parent_cfg.directory)})"
+        for index, parent_cfg in enumerate(default_parents_cfg)
+      ))
+    self._resolved = {}
+
+  def __len__(self) -> int:
+    return len(self.default_parents_cfg)
+
+  def resolve(self, directory: str) -> Optional[ParentCfg]:
+    if directory in self._resolved:
+      return self._resolved[directory]
+    parent_cfg = None
+    if self._regex:
+      sanitized_dir = directory.replace(f"{self.workspace}/", "")
+      if not sanitized_dir.endswith("/"):
+        sanitized_dir += "/"
+      match = self._regex.match(sanitized_dir)
+      if match:
+        parent_cfg = self.default_parents_cfg[int(match.lastgroup.replace("parent", ""))]
+    self._resolved[directory] = parent_cfg
+    return parent_cfg
+
+def get_default_parent(directory: str, default_parents_cfg: "List[ParentCfg] | DefaultParentsIndex") -> Optional[ParentCfg]:
+  if isinstance(default_parents_cfg, DefaultParentsIndex):
+    return default_parents_cfg.resolve(directory)
   for parent_cfg in default_parents_cfg:
-    if parent_cfg.is_directory_included(file_dir) and not begins_with_mark_space_header(path):
-      header = parent_cfg.get_header()
-      with open(path, 'r') as f:
-        file_content = f.read()
-      file_content = f"{header}{file_content}"
-      with open(path, "w") as f:
-        f.write(file_content)
-      return
+    if parent_cfg.is_directory_included(directory):
+      return parent_cfg
+  return None
+
+def inject_default_parents(path: str, default_parents_cfg: List[ParentCfg]):
+  document = MarkdownDocument.load(path)
+  document.inject_default_parents(default_parents_cfg)
+  document.save()
 
 
-def main()->int:
+WATCH_POLL_INTERVAL = 2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+INOTIFY_EVENT = struct.Struct("iIII")
+
+class InotifyWatcher():
+  """Markdown files written under a directory tree, reported by inotify through libc."""
+
+  def __init__(self, topdir: str, exclude_dirs: List[str]):
+    self.topdir = topdir
+    self.exclude_dirs = exclude_dirs
+    self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    self.directories: Dict[int, str] = {}
+    self.add_tree(topdir)
+
+  def add_tree(self, topdir: str) -> List[str]:
+    """Watch the directory and its subdirectories, return the markdown files already in them."""
+    files = []
+    for directory, subdirectories, names in os.walk(topdir):
+      subdirectories[:] = [
+        name for name in subdirectories
+        if not is_excluded_directory(os.path.relpath(os.path.join(directory, name), cfg.github.WORKSPACE), self.exclude_dirs)
+      ]
+      wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+      if wd < 0:
+        logger.warning(f"Unable to watch {directory}: {os.strerror(ctypes.get_errno())}")
+        continue
+      self.directories[wd] = directory
+      files.extend(os.path.join(directory, name) for name in names if name.endswith(".md"))
+    return files
+
+  def changes(self, timeout: Optional[float]) -> set:
+    readable, _, _ = select.select([self.fd], [], [], timeout)
+    if not readable:
+      return set()
+    buffer = os.read(self.fd, 65536)
+    changed = set()
+    offset = 0
+    while offset < len(buffer):
+      wd, mask, _, length = INOTIFY_EVENT.unpack_from(buffer, offset)
+      name = os.fsdecode(buffer[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + length].rstrip(b"\0"))
+      offset += INOTIFY_EVENT.size + length
+      if mask & IN_Q_OVERFLOW:
+        logger.warning("Too many changes at once, rescanning DOC_DIR")
+        changed.update(get_files_by_doc_dir_pattern())
+        continue
+      if mask & IN_IGNORED:
+        self.directories.pop(wd, None)
+        continue
+      if wd not in self.directories:
+        continue
+      path = os.path.join(self.directories[wd], name)
+      if mask & IN_ISDIR:
+        if mask & (IN_CREATE | IN_MOVED_TO) and not is_excluded_directory(os.path.relpath(path, cfg.github.WORKSPACE), self.exclude_dirs):
+          changed.update(self.add_tree(path))
+      elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+        changed.add(path)
+    return changed
+
+  def close(self):
+    os.close(self.fd)
+
+class PollingWatcher():
+  """Markdown files whose size or modification time changed between two scans of a directory tree."""
+
+  def __init__(self, topdir: str, exclude_dirs: List[str], interval: float = WATCH_POLL_INTERVAL):
+    self.topdir = topdir
+    self.exclude_dirs = exclude_dirs
+    self.interval = interval
+    self.snapshot = self._scan()
+
+  def _scan(self) -> Dict[str, Tuple[int, int]]:
+    snapshot = {}
+    directories = [self.topdir]
+    while directories:
+      try:
+        with os.scandir(directories.pop()) as entries:
+          for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+              if not is_excluded_directory(os.path.relpath(entry.path, cfg.github.WORKSPACE), self.exclude_dirs):
+                directories.append(entry.path)
+            elif entry.name.endswith(".md"):
+              stat = entry.stat()
+              snapshot[entry.path] = (stat.st_mtime_ns, stat.st_size)
+      except OSError:
+        continue
+    return snapshot
+
+  def changes(self, timeout: Optional[float]) -> set:
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+      time.sleep(self.interval if deadline is None else max(0, min(self.interval, deadline - time.monotonic())))
+      snapshot = self._scan()
+      changed = {path for path, state in snapshot.items() if self.snapshot.get(path) != state}
+      self.snapshot = snapshot
+      if changed or (deadline is not None and time.monotonic() >= deadline):
+        return changed
+
+  def close(self):
+    pass
+
+def get_watcher(topdir: str, exclude_dirs: List[str]):
+  if sys.platform.startswith("linux"):
+    try:
+      return InotifyWatcher(topdir, exclude_dirs)
+    except (OSError, AttributeError) as e:
+      logger.warning(f"inotify is not available, polling every {WATCH_POLL_INTERVAL}s instead: {e}")
+  return PollingWatcher(topdir, exclude_dirs)
+
+def wait_for_changes(watcher, debounce: float) -> set:
+  """Block until files change, then collect the following changes until none happened for `debounce` seconds."""
+  changed = set()
+  while not changed:
+    changed = watcher.changes(None)
+  while True:
+    more = watcher.changes(debounce)
+    if not more:
+      return changed
+    changed |= more
+
+
+@dataclass
+class RunContext():
+  """Inputs parsed once and state kept between the passes of a run."""
+  tpl: jinja2.Template
+  default_parents: "DefaultParentsIndex"
+  timeout_policy: TimeoutPolicy
+  concurrency: int
+  batch_size: int
+  force_refresh: bool
+  on_conflict: str = "warn"
+  cache: Optional[PublishCache] = None
+  mermaid_cache: Optional[MermaidCache] = None
+  staging_area: Optional[StagingArea] = None
+  preflight: Optional[Preflight] = None
+  journal: Optional[ProgressJournal] = None
+
+
+def prepare_files(files: Iterable[str], context: RunContext, report: "RunReport", git_metadata: Optional[GitMetadataProvider] = None) -> Iterator[PreparedFile]:
+  """Inject the headers of the files and write them, yielding them as they are ready.
+
+  The skipped files are recorded in the report. The unchanged ones are yielded
+  flagged, to account for their pages in the conflicts. Once the run_budget is
+  exhausted, the remaining files are recorded as not attempted.
+  """
   global cfg
-  load_vars()
 
-  tpl = check_header_template(cfg.inputs.HEADER_TEMPLATE)
+  try:
+    for path in files:
+      if run_budget.is_exhausted():
+        report.record_file(path, OUTCOME_NOT_ATTEMPTED)
+        continue
+      with report.timed("header injection"):
+        document = MarkdownDocument.load(path) if path[-3:] == '.md' else None
+        if not document or not document.begins_with_mark_headers():
+          logger.info(f"Skipping headerless or non md file {path}")
+          report.record_file(path, OUTCOME_SKIPPED)
+          continue
+        logger.info(f"Processing file {path}")
+        document.inject_default_parents(context.default_parents)
 
-  files = []
-  if cfg.inputs.FILES:
-    files = list(map(
-      lambda file: f"{cfg.github.WORKSPACE}/{file}",
-      cfg.inputs.FILES.split(" ")
-    ))
-  else:
-    files = get_files_by_doc_dir_pattern()
+      with report.timed("template rendering"):
+        source_link = f"{ cfg.github.SERVER_URL }/{ cfg.github.REPOSITORY }/blob/{ cfg.github.REF_NAME }/{ path.replace(cfg.github.WORKSPACE, '') }"
+        header = context.tpl.render(source_link=source_link, **(git_metadata.get_variables(path) if git_metadata else {}))
 
-  logger.info(f"Files to be processed: {', '.join(files)}")
+      with report.timed("header injection"):
+        document.inject_header(header)
+
+      if context.mermaid_cache:
+        with report.timed("mermaid rendering"):
+          # linked from the staged copy, when publishing from the staging area
+          document.replace_mermaid_blocks(context.mermaid_cache, context.staging_area.get_path(path) if context.staging_area else None)
+
+      with report.timed("header injection"):
+        content = document.content
+        item = PreparedFile(
+          path=path,
+          target=path,
+          size=len(content.encode()),
+          space=document.get_header("Space"),
+          parents=document.get_headers("Parent"),
+          title=document.get_header("Title"),
+          headers=document.headers,
+        )
+
+      if context.cache or context.journal:
+        key = os.path.relpath(path, cfg.github.WORKSPACE)
+        with report.timed("cache lookup"):
+          item.digest = (context.cache or context.journal).digest(content, get_references_digest(content, os.path.dirname(path)))
+          item.unchanged = not context.force_refresh and context.cache is not None and context.cache.is_unchanged(key, item.digest)
+          resumed = not item.unchanged and context.journal is not None and context.journal.is_published(key, item.digest)
+        if item.unchanged:
+          logger.info(f"Unchanged since the last publish, skipping {path}")
+          yield item
+          continue
+        if resumed:
+          logger.info(f"Already published by the resumed run, skipping {path}")
+          if context.cache:
+            # the interrupted run did not save its cache
+            context.cache.record(key, item.digest)
+          item.unchanged = True
+          yield item
+          continue
+
+      if context.preflight and item.space:
+        # memoized, only a space missed by the check before publishing is looked up
+        error = context.preflight.check_space(item.space)
+        if error:
+          run_budget.stop(f"pre-flight check failed for {path}, {error}")
+          report.record_file(path, OUTCOME_NOT_ATTEMPTED)
+          continue
+
+      with report.timed("header injection"):
+        item.timeout = context.timeout_policy.get_timeout(content)
+        if context.staging_area:
+          item.target = context.staging_area.stage(document)
+        else:
+          document.save()
+      yield item
+  finally:
+    if git_metadata:
+      git_metadata.close()
+
+
+def publish_prepared(prepared: Iterable[PreparedFile], context: RunContext, report: "RunReport") -> Iterator[Tuple[PreparedFile, PublishResult]]:
+  """Publish the files as they are prepared, warning about the conflicts with the previous ones."""
+  index = PageIndex()
+
+  def changed() -> Iterator[PreparedFile]:
+    for item in prepared:
+      reason = index.add(item.path, item.page, item.headers)
+      if reason:
+        logger.warning(f"{item.path}: {reason}")
+      if item.unchanged:
+        report.record_file(item.path, OUTCOME_UNCHANGED, item.size, digest=item.digest)
+        continue
+      yield item
+
+  return publish_stream(changed(), context.concurrency, context.batch_size)
+
+
+def publish_collected(prepared: Iterable[PreparedFile], context: RunContext, report: "RunReport") -> Iterator[Tuple[PreparedFile, PublishResult]]:
+  """Publish the files once all of them are prepared, for the decisions needing every file."""
+  global cfg
+
+  items = []
+  for item in prepared:
+    if item.unchanged:
+      report.record_file(item.path, OUTCOME_UNCHANGED, item.size, digest=item.digest)
+    items.append(item)
+  conflicts = get_conflicts({item.path: item.page for item in items}, {item.path: item.headers for item in items})
+  to_publish = []
+  for item in items:
+    reason = conflicts.get(item.path)
+    if reason and context.on_conflict == "fail" and not item.unchanged:
+      # rejected without running mark
+      yield item, PublishResult(False, reason.encode())
+      continue
+    if reason:
+      logger.warning(f"{item.path}: {reason}")
+    if not item.unchanged:
+      to_publish.append(item)
+
+  if context.cache:
+    # the files changed since their last publish first, then the longest ones, in case the run stops early;
+    # the largest first among the ones without a recorded duration
+    to_publish.sort(key=lambda item: (context.cache.get_priority(os.path.relpath(item.path, cfg.github.WORKSPACE), item.digest), -item.size))
+  elif run_budget.is_limited:
+    # without the durations of the last publish, the largest files are the longest ones
+    to_publish.sort(key=lambda item: -item.size)
+
+  items = {item.path: item for item in to_publish}
+  # in parallel, siblings would race to create their missing parents
+  waves = plan_waves({path: item.page for path, item in items.items()}) if context.concurrency > 1 else [list(items)]
+  if len(waves) > 1:
+    logger.info(f"Publishing the page tree in {len(waves)} waves: {', '.join(str(len(wave)) for wave in waves)} files")
+  for wave in waves:
+    wave_files = {path: items[path].target for path in wave}
+    spaces = {path: items[path].space for path in wave}
+    batches = group_batches(wave_files, spaces, context.batch_size) if context.batch_size > 1 else None
+    results = publish_files(wave_files, context.concurrency, batches, {path: items[path].timeout for path in wave})
+    for path, result in results.items():
+      yield items[path], result
 
-  default_parents = get_default_parents(cfg.inputs.DEFAULT_PARENTS)
-  status = {}
-  for path in files:
-    if path[-3:] == '.md' and begins_with_mark_headers(path):
-      logger.info(f"Processing file {path}")
-      inject_default_parents(path, default_parents)
 
-      source_link = f"{ cfg.github.SERVER_URL }/{ cfg.github.REPOSITORY }/blob/{ cfg.github.REF_NAME }/{ path.replace(cfg.github.WORKSPACE, '') }"
-      header = tpl.render(source_link=source_link)
-      inject_header_before_first_line_of_content(path, header)
+def process_files(files: Iterable[str], context: RunContext, report: "RunReport") -> int:
+  """Prepare and publish the files as they are discovered, return 1 when one failed or was not attempted.
 
-      status[path] = publish(path)
+  Discovery, preparation and publishing run concurrently, connected by bounded
+  queues. The files are collected before publishing only when a decision needs
+  all of them: failing the conflicts, or publishing the changed and longest
+  files first within a limited run_budget.
+  """
+  global cfg
+
+  # the files are known upfront unless they are discovered while processing them
+  git_metadata = get_git_metadata_provider(cfg.inputs.HEADER_TEMPLATE, files if isinstance(files, list) else None)
+  prepared = prefetch(prepare_files(prefetch(files), context, report, git_metadata))
+  collect = context.on_conflict == "fail" or run_budget.is_limited
+  results = (publish_collected if collect else publish_prepared)(prepared, context, report)
+  try:
+    with report.timed("publish"):
+      for item, result in results:
+        if not result.attempted:
+          report.record_file(item.path, OUTCOME_NOT_ATTEMPTED, item.size)
+          continue
+        report.record_file(item.path, OUTCOME_SUCCESS if result.success else OUTCOME_FAILURE, item.size, result, item.digest)
+        if not result.success:
+          logger.error(f"{item.path} {result.errors}")
+        elif context.cache:
+          context.cache.record(os.path.relpath(item.path, cfg.github.WORKSPACE), item.digest, result.duration)
+  finally:
+    results.close()
+    prepared.close()
+
+  counters = report.get_counters()
+  failures = counters[OUTCOME_FAILURE]
+  not_attempted = counters[OUTCOME_NOT_ATTEMPTED]
+  if context.cache:
+    if not failures and not not_attempted:
+      context.cache.default_parents = cfg.inputs.DEFAULT_PARENTS
+    context.cache.save()
+
+  if not_attempted:
+    report.stop_reason = run_budget.stop_reason
+    more = f" and {not_attempted - len(report.not_attempted)} more" if not_attempted > len(report.not_attempted) else ""
+    logger.error(f"{not_attempted} files not attempted, {run_budget.stop_reason}: {', '.join(report.not_attempted)}{more}")
+  total = counters[OUTCOME_SUCCESS] + failures + not_attempted + counters[OUTCOME_UNCHANGED]
+  logger.info(f"Success: {counters[OUTCOME_SUCCESS]} | Failures: {failures} | Not attempted: {not_attempted} | Unchanged: {counters[OUTCOME_UNCHANGED]} | Total: {total}")
+  if context.mermaid_cache:
+    logger.info(f"Mermaid diagrams: {' | '.join(f'{name}: {count}' for name, count in context.mermaid_cache.counters.items())}")
+  logger.info(f"Timings: {' | '.join(f'{phase}: {seconds:.2f}s' for phase, seconds in report.phases.items())}")
+  report.close()
+  if cfg.github.get("STEP_SUMMARY"):
+    report.write_step_summary(cfg.github.STEP_SUMMARY)
+  # an exit status, the counts would wrap modulo 256
+  return 1 if failures or not_attempted else 0
+
+
+def watch(context: RunContext, watcher, debounce: float):
+  """Publish again the markdown files written under DOC_DIR, until interrupted."""
+  global cfg, run_budget
+
+  pattern = check_doc_dir_pattern(cfg.inputs.DOC_DIR_PATTERN)
+  exclude_dirs = get_exclude_dirs()
+  logger.info(f"Watching {watcher.topdir} for changes, press Ctrl+C to stop")
+  try:
+    while True:
+      changed = wait_for_changes(watcher, debounce)
+      files = sorted(
+        path for path in changed
+        if path.endswith(".md") and os.path.isfile(path) and pattern.match(path) and not is_in_excluded_directory(path, exclude_dirs)
+      )
+      if not files:
+        continue
+      logger.info(f"Files changed: {', '.join(files)}")
+      if context.staging_area:
+        # pick up the images and includes created since the last pass
+        context.staging_area.refresh()
+      run_budget = RunBudget(fail_fast=run_budget.fail_fast)
+      process_files(files, context, RunReport(get_report_path(), context.journal))
+  except KeyboardInterrupt:
+    logger.info("Stopped watching")
+  finally:
+    watcher.close()
+
+
+def run()->int:
+  global cfg, retry_policy, rate_limiter, run_budget, confluence_client
+  cfg.inputs.BACKEND = check_backend(cfg.inputs.BACKEND)
+  # the budget covers the whole run
+  run_budget = RunBudget(check_float_input("TIME_BUDGET"), check_int_input("FAIL_FAST"))
+
+  watch_mode = is_enabled(cfg.inputs.WATCH)
+  if watch_mode and not is_enabled(cfg.inputs.STAGING):
+    # the headers must not be written into the watched files
+    logger.info("WATCH enables STAGING")
+    cfg.inputs.STAGING = "true"
+  debounce = check_float_input("WATCH_DEBOUNCE")
+  shard_count = check_int_input("SHARD_COUNT", minimum=1)
+  shard_index = check_int_input("SHARD_INDEX")
+  if shard_index >= shard_count:
+    logger.error(f"Setup error, SHARD_INDEX: must be lower than SHARD_COUNT {shard_count}, provided: {shard_index}")
+    exit(1)
+
+  context = RunContext(
+    tpl=check_header_template(cfg.inputs.HEADER_TEMPLATE),
+    default_parents=DefaultParentsIndex(get_default_parents(cfg.inputs.DEFAULT_PARENTS)),
+    timeout_policy=get_timeout_policy(),
+    concurrency=check_int_input("CONCURRENCY", minimum=1),
+    batch_size=check_int_input("BATCH_SIZE", minimum=1),
+    force_refresh=is_enabled(cfg.inputs.FORCE_REFRESH),
+    on_conflict=check_on_conflict(cfg.inputs.ON_CONFLICT),
+  )
+  retry_policy = get_retry_policy()
+  rate_limiter = RateLimiter(check_float_input("RATE_LIMIT"))
+  if cfg.inputs.BACKEND == BACKEND_NATIVE and context.batch_size > 1:
+    # the batches only save mark processes
+    logger.info("BATCH_SIZE is ignored by the native backend")
+    context.batch_size = 1
+  confluence_client = get_confluence_client(context.concurrency)
+  context.preflight = get_preflight(confluence_client)
+  context.cache = get_publish_cache()
+  context.mermaid_cache = get_mermaid_cache()
+  context.journal = get_progress_journal()
+  report = RunReport(get_report_path(), context.journal)
+
+  with report.timed("discovery"):
+    if cfg.inputs.FILES:
+      files = list(map(
+        lambda file: f"{cfg.github.WORKSPACE}/{file}",
+        cfg.inputs.FILES.split(" ")
+      ))
+    elif cfg.inputs.BASE_REF:
+      files = get_files_changed_since_base_ref(context.default_parents, context.cache.default_parents if context.cache else None)
+    elif shard_count > 1:
+      files = get_files_by_doc_dir_pattern()
     else:
-      logger.info(f"Skipping headerless or non md file {path}")
-
-  # Calculate counters and exit code
-  rc = 0
-  for k, v in status.items():
-    if not v[0]:
-      rc += 1
-      logger.error(f"{k} {v[1]}")
-  logger.info(f"Success: {len(status)-rc} | Failures: {rc} | Total: {len(status)}")
+      # discovered while the first files are already processed
+      files = report.timed_iter("discovery", iter_files_by_doc_dir_pattern())
+
+    if shard_count > 1:
+      files = get_shard(files, shard_index, shard_count, context.default_parents)
+  if isinstance(files, list):
+    logger.info(f"{len(files)} files to be processed")
+
+  if context.preflight:
+    # every target space is checked before publishing, the discovery is no longer streamed
+    files = list(files)
+    with report.timed("pre-flight"):
+      error = context.preflight.check_spaces(get_target_spaces(files, context.default_parents))
+    if error:
+      # the files are reported as not attempted, the cache and the report are still written
+      run_budget.stop(f"pre-flight check failed, {error}")
+    else:
+      logger.info("Pre-flight check passed for every target space")
+
+  # watching from now on, the files saved during the first pass are published again
+  watcher = get_watcher(os.path.join(cfg.github.WORKSPACE, cfg.inputs.DOC_DIR), get_exclude_dirs()) if watch_mode else None
+  context.staging_area, staging_tmp_dir = get_staging_area()
+  try:
+    rc = process_files(files, context, report)
+    if watcher:
+      watch(context, watcher, debounce)
+  finally:
+    if staging_tmp_dir:
+      shutil.rmtree(staging_tmp_dir, ignore_errors=True)
+    if context.preflight:
+      context.preflight.close()
+    if context.journal:
+      context.journal.close()
+    if confluence_client:
+      confluence_client.close()
   return rc
 
+def main()->int:
+  global cfg
+  load_vars()
+  if not is_enabled(cfg.inputs.PROFILE):
+    return run()
+
+  from mark2confluence.profiler import Profiler
+  profiler = Profiler(os.path.join(cfg.github.WORKSPACE, cfg.inputs.PROFILE_DIR))
+  try:
+    with profiler:
+      return run()
+  finally:
+    summary = profiler.get_summary()
+    logger.info(
+      f"Profile written to {profiler.output_dir}: {summary['wall']:.1f}s wall, {summary['cpu']['python']:.1f}s Python CPU, "
+      f"{summary['cpu']['children']:.1f}s child processes CPU, {summary['waiting']['child processes']:.1f}s of thread time "
+      f"waiting for child processes, {summary['waiting']['network']:.1f}s for the network"
+    )
+
 if __name__ == "__main__":
   exit(main())
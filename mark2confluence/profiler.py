@@ -0,0 +1,175 @@
+"""Profiling of a whole run, enabled with PROFILE: true.
+
+The profiler writes these files to its output directory:
+
+- profile.pstats: cProfile statistics of every thread, for pstats, snakeviz or gprof2dot
+- profile.txt: the functions with the highest cumulative time, from the same statistics
+- stacks.collapsed: wall clock stack samples of every thread, in the collapsed format
+  of flamegraph.pl and speedscope
+- memory.txt: peak traced memory and the lines holding the most memory at the end, from tracemalloc
+- summary.json: wall time, CPU time of the Python process and of the child processes,
+  and the thread time spent waiting for the child processes and the network
+
+This module is only imported when PROFILE is enabled.
+"""
+import cProfile
+import json
+import os
+import pstats
+import re
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from typing import Dict, List, Optional
+
+# seconds between two stack samples
+SAMPLE_INTERVAL = 0.01
+# functions listed in profile.txt and lines in memory.txt
+TOP_FUNCTIONS = 40
+TOP_ALLOCATIONS = 30
+# a thread sampled in one of these functions is waiting
+WAIT_FUNCTIONS = {
+  "child processes": ("Popen.wait", "Popen.communicate"),
+  "network": ("HTTPConnection.getresponse",),
+}
+THREAD_NUMBER_REGEX = re.compile(r"[-_]\d+")
+
+
+def get_frame_label(code) -> str:
+  """Function and file of a frame, without the line so that every call of the function is merged."""
+  filename = "/".join(code.co_filename.split(os.sep)[-2:])
+  return f"{code.co_qualname} ({filename})"
+
+
+class Profiler():
+  """Profile the block run in `with Profiler(output_dir):` and write the results when it exits."""
+
+  def __init__(self, output_dir: str, interval: float = SAMPLE_INTERVAL):
+    self.output_dir = output_dir
+    self.interval = interval
+    self.profiles: List[cProfile.Profile] = []
+    self.stacks = Counter()
+    self.waiting: Dict[str, float] = dict.fromkeys(WAIT_FUNCTIONS, 0.0)
+    self.lock = threading.Lock()
+    self.stopped = threading.Event()
+    self.sampler = threading.Thread(target=self._sample, name="profiler", daemon=True)
+    # the profiler of Python 3.11 and older only sees the thread enabling it, every new thread enables its own
+    self.per_thread = sys.version_info < (3, 12)
+
+  def __enter__(self) -> "Profiler":
+    self.start()
+    return self
+
+  def __exit__(self, *exc_info):
+    self.stop()
+    self.write()
+
+  def start(self):
+    tracemalloc.start()
+    self.started = time.perf_counter()
+    self.rusage_self = resource.getrusage(resource.RUSAGE_SELF)
+    self.rusage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    self.sampler.start()
+    if self.per_thread:
+      threading.setprofile(self._profile_thread)
+    self.profiles.append(cProfile.Profile())
+    self.profiles[0].enable()
+
+  def _profile_thread(self, *args):
+    sys.setprofile(None)
+    profile = cProfile.Profile()
+    with self.lock:
+      self.profiles.append(profile)
+    profile.enable()
+
+  def _sample(self):
+    own_id = threading.get_ident()
+    previous = time.perf_counter()
+    while not self.stopped.wait(self.interval):
+      now = time.perf_counter()
+      elapsed, previous = now - previous, now
+      names = {thread.ident: THREAD_NUMBER_REGEX.sub("", thread.name) for thread in threading.enumerate()}
+      for thread_id, frame in sys._current_frames().items():
+        if thread_id == own_id:
+          continue
+        labels = []
+        while frame is not None:
+          labels.append(get_frame_label(frame.f_code))
+          frame = frame.f_back
+        labels.append(names.get(thread_id, "thread"))
+        labels.reverse()
+        self.stacks[";".join(labels)] += 1
+        for kind, functions in WAIT_FUNCTIONS.items():
+          if any(label.startswith(functions) for label in labels):
+            self.waiting[kind] += elapsed
+
+  def stop(self):
+    self.profiles[0].disable()
+    if self.per_thread:
+      threading.setprofile(None)
+    self.stopped.set()
+    self.sampler.join()
+    self.wall = time.perf_counter() - self.started
+    rusage_self = resource.getrusage(resource.RUSAGE_SELF)
+    rusage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    self.cpu = {
+      "python": (rusage_self.ru_utime + rusage_self.ru_stime) - (self.rusage_self.ru_utime + self.rusage_self.ru_stime),
+      # the children already waited for, mark and the mermaid renderers
+      "children": (rusage_children.ru_utime + rusage_children.ru_stime) - (self.rusage_children.ru_utime + self.rusage_children.ru_stime),
+    }
+    self.memory_current, self.memory_peak = tracemalloc.get_traced_memory()
+    self.snapshot = tracemalloc.take_snapshot().filter_traces([
+      tracemalloc.Filter(False, tracemalloc.__file__),
+      tracemalloc.Filter(False, __file__),
+      tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+      tracemalloc.Filter(False, "<unknown>"),
+    ])
+    tracemalloc.stop()
+
+  def get_stats(self) -> pstats.Stats:
+    with self.lock:
+      profiles = list(self.profiles)
+    stats = pstats.Stats(profiles[0])
+    for profile in profiles[1:]:
+      stats.add(profile)
+    return stats
+
+  def get_summary(self) -> dict:
+    return {
+      "wall": round(self.wall, 3),
+      "cpu": {kind: round(seconds, 3) for kind, seconds in self.cpu.items()},
+      # thread seconds, the waits of parallel threads add up
+      "waiting": {kind: round(seconds, 3) for kind, seconds in self.waiting.items()},
+      "samples": sum(self.stacks.values()),
+      "sample_interval": self.interval,
+      "memory": {"peak": self.memory_peak, "end": self.memory_current},
+    }
+
+  def write(self, output_dir: Optional[str] = None) -> dict:
+    """Write the files listed in the module docstring, return the summary."""
+    output_dir = output_dir or self.output_dir
+    os.makedirs(output_dir, exist_ok=True)
+
+    stats = self.get_stats()
+    stats.dump_stats(os.path.join(output_dir, "profile.pstats"))
+    with open(os.path.join(output_dir, "profile.txt"), "w") as f:
+      stats.stream = f
+      stats.sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+
+    with open(os.path.join(output_dir, "stacks.collapsed"), "w") as f:
+      for stack, count in sorted(self.stacks.items()):
+        f.write(f"{stack} {count}\n")
+
+    with open(os.path.join(output_dir, "memory.txt"), "w") as f:
+      f.write(f"Peak traced memory: {self.memory_peak / 1024 / 1024:.1f} MiB, at the end: {self.memory_current / 1024 / 1024:.1f} MiB\n\n")
+      f.write(f"Top {TOP_ALLOCATIONS} lines holding memory at the end:\n")
+      for stat in self.snapshot.statistics("lineno")[:TOP_ALLOCATIONS]:
+        f.write(f"{stat}\n")
+
+    summary = self.get_summary()
+    with open(os.path.join(output_dir, "summary.json"), "w") as f:
+      json.dump(summary, f, indent=2)
+    return summary
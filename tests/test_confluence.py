@@ -0,0 +1,161 @@
+import os
+import pytest
+import threading
+from supermutes import dot
+
+import mark2confluence.main as main
+from mark2confluence import confluence
+from tests.fake_confluence import FakeConfluence
+
+@pytest.fixture
+def fake():
+    with FakeConfluence(spaces=["DOCS"]) as fake:
+        yield fake
+
+def test_load_page(tmp_path):
+    (tmp_path / "macro.xml").write_text('<ac:structured-macro ac:name="info" />')
+    page_path = tmp_path / "page.md"
+    page_path.write_text(
+        "<!-- Space: DOCS -->\n<!-- Parent: Guides -->\n<!-- Parent: Install -->\n<!-- Title: Linux -->\n"
+        "<!-- Attachment: files/setup.sh -->\n<!-- Include: ac:toc -->\n\n"
+        "# Linux\n\nline<br>\n\n![diagram](images/flow.png) ![logo](https://example.com/logo.png)\n\n"
+        "```python\nprint(\"<]]>\")\n```\n\n<!-- Include: macro.xml -->\n"
+    )
+
+    page = confluence.load_page(str(page_path))
+
+    assert (page.space, page.parents, page.title) == ("DOCS", ["Guides", "Install"], "Linux")
+    assert page.attachments == [str(tmp_path / "files/setup.sh"), str(tmp_path / "images/flow.png")]
+    assert "Space:" not in page.body
+    assert page.body.startswith('<ac:structured-macro ac:name="toc" />')
+    assert "<br />" in page.body
+    assert '<ri:attachment ri:filename="flow.png" />' in page.body
+    assert '<ri:url ri:value="https://example.com/logo.png" />' in page.body
+    assert '<ac:parameter ac:name="language">python</ac:parameter>' in page.body
+    assert 'print("<]]]]><![CDATA[>")' in page.body
+    assert page.body.rstrip().endswith('<ac:structured-macro ac:name="info" />')
+
+def test_load_page_requires_space_and_title(tmp_path):
+    page_path = tmp_path / "page.md"
+    page_path.write_text("<!-- Title: Foo -->\n\nbar\n")
+    with pytest.raises(confluence.ConfluenceError, match="Space and Title"):
+        confluence.load_page(str(page_path))
+
+def write_page(path, title, parents=()):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    headers = "".join(f"<!-- Parent: {parent} -->\n" for parent in parents)
+    with open(path, "w") as f:
+        f.write(f"<!-- Space: DOCS -->\n{headers}<!-- Title: {title} -->\n\n# {title}\n\n![image](image.png)\n")
+    with open(os.path.join(os.path.dirname(path), "image.png"), "wb") as f:
+        f.write(b"png")
+    return confluence.load_page(path)
+
+def test_confluence_client_publish(fake, tmp_path):
+    client = confluence.ConfluenceClient(fake.url, "", "token", pool_size=4)
+    pages = [write_page(str(tmp_path / f"{index}.md"), f"Page {index}", ["Guides", "Install"]) for index in range(8)]
+
+    threads = [threading.Thread(target=client.publish, args=(page,)) for page in pages]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    install = fake.find_page("DOCS", "Install")
+    assert fake.find_page("DOCS", "Page 7")["ancestors"][-1] == install["id"]
+    assert fake.find_page("DOCS", "Page 7")["attachments"]["image.png"]
+    # the parents and the space are resolved once for the whole run, on at most 4 connections
+    assert fake.count("POST", "/content$") == 2 + 8
+    assert fake.count("GET", "/space/DOCS") == 1
+    assert fake.requests_per_page()["Guides"] == 2
+    assert client.pool.opened <= 4
+
+    link = client.publish(pages[0])
+    assert link.endswith(f"pageId={fake.find_page('DOCS', 'Page 0')['id']}")
+    assert fake.find_page("DOCS", "Page 0")["version"]["number"] == 2
+    client.close()
+
+def test_confluence_client_dry_run(fake, tmp_path):
+    client = confluence.ConfluenceClient(fake.url, "", "token")
+    assert client.publish(write_page(str(tmp_path / "page.md"), "Page", ["Guides"]), dry_run=True) is None
+    assert fake.count("POST") == 0
+    assert fake.find_page("DOCS", "Guides") is None
+
+def test_publish_with_the_native_backend(fake, tmp_path, monkeypatch):
+    monkeypatch.setattr('mark2confluence.main.cfg', dot.dotify({"inputs": {
+        **main.DEFAULT_INPUTS, "ACTION": "publish", "BACKEND": "native",
+    }}))
+    monkeypatch.setattr(main, "confluence_client", confluence.ConfluenceClient(fake.url, "", "token"))
+    monkeypatch.setattr(main, "retry_policy", main.RetryPolicy(retries=2, backoff=0))
+    page_path = str(tmp_path / "page.md")
+    write_page(page_path, "Page")
+    fake.inject_error(503, method="POST", path="/content$")
+
+    result = main.publish_with_retries(page_path)
+
+    assert result.success
+    assert result.attempts == 2
+    assert fake.find_page("DOCS", "Page")["body"]["storage"]["value"].startswith("<h1>Page</h1>")
+
+    with open(page_path, "w") as f:
+        f.write("<!-- Space: OTHER -->\n<!-- Title: Page -->\n")
+    result = main.publish_with_retries(page_path)
+    assert result.as_status() == (False, b"ERROR: GET /space/OTHER: 404 Not Found: no space with key OTHER")
+    assert result.attempts == 1
+
+def preflight_inputs(monkeypatch, url, password="secret"):
+    monkeypatch.setattr('mark2confluence.main.cfg', dot.dotify({
+        "inputs": {
+            **main.DEFAULT_INPUTS, "ACTION": "publish", "CONFLUENCE_BASE_URL": url,
+            "CONFLUENCE_USERNAME": "bot", "CONFLUENCE_PASSWORD": password,
+        },
+        "github": {**main.DEFAULT_GITHUB, "WORKSPACE": "/"},
+    }))
+    monkeypatch.setattr(main, "retry_policy", main.RetryPolicy(retries=1, backoff=0))
+
+def test_preflight_rejects_wrong_credentials(monkeypatch):
+    with FakeConfluence(spaces=["DOCS"], username="bot", password="secret") as fake:
+        preflight_inputs(monkeypatch, fake.url, password="expired")
+        with pytest.raises(SystemExit):
+            main.get_preflight(None)
+        # not retried, not transient
+        assert fake.count("GET", "/user/current") == 1
+
+def test_preflight_retries_transient_failures(fake, monkeypatch):
+    preflight_inputs(monkeypatch, fake.url)
+    fake.inject_error(503, path="/user/current")
+    preflight = main.get_preflight(None)
+    assert fake.count("GET", "/user/current") == 2
+    preflight.close()
+
+def test_preflight_is_skipped_in_verify_mode_and_without_base_url(monkeypatch):
+    preflight_inputs(monkeypatch, "")
+    assert main.get_preflight(None) is None
+    preflight_inputs(monkeypatch, "http://127.0.0.1:1")
+    main.cfg.inputs.ACTION = "verify"
+    assert main.get_preflight(None) is None
+
+def test_preflight_checks_each_space_once(fake, monkeypatch, tmp_path):
+    preflight_inputs(monkeypatch, fake.url)
+    monkeypatch.setattr(main, "run_budget", main.RunBudget())
+    for name, space in [("a", "DOCS"), ("b", "DOCS"), ("c", "OTHER"), ("d", "DOCS")]:
+        (tmp_path / f"{name}.md").write_text(f"<!-- Space: {space} -->\n<!-- Title: {name} -->\n\n{name}\n")
+    context = main.RunContext(
+        tpl=main.check_header_template(""),
+        default_parents=main.DefaultParentsIndex([]),
+        timeout_policy=main.TimeoutPolicy(120),
+        concurrency=1,
+        batch_size=1,
+        force_refresh=False,
+        preflight=main.get_preflight(None),
+    )
+    report = main.RunReport()
+    prepared = main.prepare_files(sorted(str(path) for path in tmp_path.glob("*.md")), context, report)
+
+    # a space missed by the check before publishing stops the run at its first file
+    assert [item.title for item in prepared] == ["a", "b"]
+    assert report.get_counters()[main.OUTCOME_NOT_ATTEMPTED] == 2
+    assert main.run_budget.stop_reason.startswith(f"pre-flight check failed for {tmp_path}/c.md, space OTHER is not accessible")
+    assert context.preflight.check_spaces(["DOCS", "OTHER"]) == "space OTHER is not accessible: GET /space/OTHER: 404 Not Found: no space with key OTHER"
+    assert fake.count("GET", "/space/DOCS") == 1
+    assert fake.count("GET", "/space/OTHER") == 1
+    context.preflight.close()
@@ -0,0 +1,114 @@
+import json
+import os
+import pytest
+import shutil
+import subprocess
+import urllib.error
+import urllib.request
+from supermutes import dot
+
+import mark2confluence.main as main
+from tests.fake_confluence import FakeConfluence, install_mark_emulator
+
+@pytest.fixture
+def confluence():
+    with FakeConfluence(spaces=["DOCS"]) as fake:
+        yield fake
+
+def call(fake, method, path, data=None):
+    body = json.dumps(data).encode() if data is not None else None
+    request = urllib.request.Request(f"{fake.url}/rest/api{path}", body, method=method, headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+def test_fake_confluence_pages(confluence):
+    home = call(confluence, "GET", "/space/DOCS")["homepage"]["id"]
+    page = call(confluence, "POST", "/content", {"type": "page", "title": "Foo", "space": {"key": "DOCS"}, "ancestors": [{"id": home}]})
+    call(confluence, "PUT", f"/content/{page['id']}", {"title": "Foo", "version": {"number": 2}, "body": {"storage": {"value": "bar"}}})
+
+    found = call(confluence, "GET", "/content?spaceKey=DOCS&title=Foo")["results"]
+    assert [(result["id"], result["version"]["number"]) for result in found] == [(page["id"], 2)]
+    assert found[0]["ancestors"] == [{"id": home, "title": "DOCS Home"}]
+    assert confluence.requests_per_page()["Foo"] == 3
+    assert confluence.count("PUT") == 1
+
+    with pytest.raises(urllib.error.HTTPError) as e:
+        call(confluence, "PUT", f"/content/{page['id']}", {"title": "Foo", "version": {"number": 2}})
+    assert e.value.code == 409
+
+def test_fake_confluence_injected_errors(confluence):
+    confluence.inject_error(429, times=2, path="/user/current", retry_after=3)
+    for _ in range(2):
+        with pytest.raises(urllib.error.HTTPError) as e:
+            call(confluence, "GET", "/user/current")
+        assert e.value.code == 429
+        assert e.value.headers["Retry-After"] == "3"
+    assert call(confluence, "GET", "/user/current")["displayName"] == "Fake User"
+    assert confluence.statuses() == {429: 2, 200: 1}
+
+def test_fake_confluence_authentication():
+    with FakeConfluence(username="user", password="secret") as fake:
+        with pytest.raises(urllib.error.HTTPError) as e:
+            call(fake, "GET", "/user/current")
+        assert e.value.code == 401
+
+def test_publish_against_fake_confluence(confluence, tmp_path, monkeypatch):
+    install_mark_emulator(str(tmp_path / "bin"))
+    monkeypatch.setenv("PATH", f"{tmp_path / 'bin'}:{os.environ['PATH']}")
+    monkeypatch.setattr('mark2confluence.main.cfg', dot.dotify({"inputs": {
+        **main.DEFAULT_INPUTS, "ACTION": "publish", "CONFLUENCE_BASE_URL": confluence.url, "CONFLUENCE_PASSWORD": "token",
+    }}))
+    monkeypatch.setattr(main, "retry_policy", main.RetryPolicy(retries=2, backoff=0))
+    page = tmp_path / "page.md"
+    page.write_text("<!-- Space: DOCS -->\n<!-- Parent: Section -->\n<!-- Title: Page -->\n\n# Page\n")
+    confluence.inject_error(503, method="POST", path="/content$")
+
+    result = main.publish_with_retries(str(page))
+
+    assert result.success
+    assert result.attempts == 2
+    section = confluence.find_page("DOCS", "Section")
+    assert confluence.find_page("DOCS", "Page")["ancestors"][-1] == section["id"]
+    # the first attempt failed creating the parent, the second one looked the page up and created it
+    assert confluence.requests_per_page()["Page"] == 2
+    assert confluence.count("POST", "/content$") == 3
+
+def get_real_mark() -> str:
+    """The mark binary on PATH, unless it is missing or the emulator."""
+    path = shutil.which("mark")
+    if not path:
+        return ""
+    version = subprocess.run([path, "--version"], capture_output=True, text=True).stdout
+    return "" if "emulator" in version else path
+
+@pytest.mark.skipif(not get_real_mark(), reason="the real mark binary is not installed")
+def test_real_mark_against_fake_confluence(confluence, tmp_path, monkeypatch):
+    monkeypatch.setattr('mark2confluence.main.cfg', dot.dotify({"inputs": {
+        **main.DEFAULT_INPUTS, "ACTION": "publish", "CONFLUENCE_BASE_URL": confluence.url,
+        "CONFLUENCE_USERNAME": "bot", "CONFLUENCE_PASSWORD": "secret",
+    }}))
+    monkeypatch.setattr(main, "retry_policy", main.RetryPolicy(retries=0, backoff=0))
+    os.makedirs(tmp_path / "images")
+    (tmp_path / "images" / "flow.png").write_bytes(b"\x89PNG\r\n\x1a\n")
+    page = tmp_path / "page.md"
+    page.write_text(
+        "<!-- Space: DOCS -->\n<!-- Parent: Section -->\n<!-- Title: Page -->\n<!-- Label: generated -->\n\n"
+        "# Page\n\n![flow](images/flow.png)\n"
+    )
+
+    result = main.publish_with_retries(str(page))
+    assert result.success, result.errors
+    # published again, the page is updated
+    page.write_text(page.read_text() + "\nchanged\n")
+    result = main.publish_with_retries(str(page))
+    assert result.success, result.errors
+
+    # every call of mark is served by a route of the fake
+    assert all(call.status < 400 for call in confluence.calls), [(call.method, call.path, call.status) for call in confluence.calls if call.status >= 400]
+    section = confluence.find_page("DOCS", "Section")
+    published = confluence.find_page("DOCS", "Page")
+    assert published["ancestors"][-1] == section["id"]
+    assert published["version"]["number"] == 2
+    assert "changed" in published["body"]["storage"]["value"]
+    assert list(published["attachments"]) == ["flow.png"]
+    assert published["labels"] == ["generated"]
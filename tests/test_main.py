@@ -1,9 +1,12 @@
 import os
+import json
 import pytest
 import shutil
+import subprocess
 from supermutes import dot
 
 import mark2confluence.main as main
+from tests.fake_confluence import FakeConfluence
 
 RESOURCE_DIR = f"{os.path.dirname(os.path.abspath(__file__))}/resources"
 WORKSPACE = os.path.realpath(f"{os.path.dirname(os.path.abspath(__file__))}/..")
@@ -164,3 +167,1033 @@ def test_inject_default_parents(monkeypatch, tested_file_name, expected_file_nam
         assert parsed_file_content == expected_file_content
     finally:
         shutil.rmtree(parsed_file_dir)
+
+@pytest.mark.parametrize("concurrency", [1, 4])
+def test_publish_files(monkeypatch, concurrency):
+    def fake_publish(path, log=main.logger, **kwargs):
+        log.info(f"publishing {path}")
+        if path.endswith("fail.md"):
+            return False, b"error"
+        return True, None
+    monkeypatch.setattr(main, "publish", fake_publish)
+
+    paths = [f"/tmp/{i}.md" for i in range(10)] + ["/tmp/fail.md"]
+    status = {path: result.as_status() for path, result in main.publish_files({path: path for path in paths}, concurrency).items()}
+
+    assert list(status.keys()) == paths
+    assert status["/tmp/fail.md"] == (False, b"error")
+    assert all(status[path] == (True, None) for path in paths[:-1])
+
+def test_buffered_log(monkeypatch):
+    emitted = []
+    monkeypatch.setattr(main.logger, "log", lambda level, message: emitted.append((level, message)))
+    log = main.BufferedLog()
+    log.info("foo")
+    log.error("bar")
+    assert emitted == []
+    log.flush()
+    assert emitted == [("INFO", "foo"), ("ERROR", "bar")]
+    assert not log.records
+
+def test_buffered_log_is_bounded(monkeypatch, tmp_path):
+    emitted = []
+    monkeypatch.setattr(main.logger, "log", lambda level, message: emitted.append((level, message)))
+    monkeypatch.setattr(main.logger, "warning", lambda message: emitted.append(("WARNING", message)))
+    monkeypatch.setattr(main, "get_log_min_level", lambda: main.logger.level("INFO").no)
+    monkeypatch.setattr(main, "BUFFERED_LOG_LINES", 100)
+    monkeypatch.setattr('mark2confluence.main.cfg', dot.dotify({"inputs": {**main.DEFAULT_INPUTS, "ACTION": "verify"}}))
+    sizes = []
+    flush = main.BufferedLog.flush
+    def record_size(log):
+        sizes.append((len(log.records), log.dropped))
+        flush(log)
+    monkeypatch.setattr(main.BufferedLog, "flush", record_size)
+    bin_dir = tmp_path / "bin"
+    os.makedirs(bin_dir)
+    # a large compiled page on stdout, debug output on stderr
+    (bin_dir / "mark").write_text("#!/bin/sh\nseq 1 20000 | sed 's/^/<p>line /'\nseq 1 20000 >&2\n")
+    (bin_dir / "mark").chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}:{os.environ['PATH']}")
+
+    paths = [str(tmp_path / f"{name}.md") for name in "abcd"]
+    status = main.publish_files({path: path for path in paths}, 2)
+
+    assert all(result.success for result in status.values())
+    # the debug lines are not buffered, the verify output only up to the limit
+    assert sizes == [(100, 19900)] * 4
+    assert emitted.count(("INFO", "Verify: <p>line 20000")) == 4
+    assert not [message for level, message in emitted if level == "DEBUG"]
+    assert emitted[0][0] == "WARNING" and emitted[0][1].startswith("19900 log lines dropped")
+
+@pytest.mark.parametrize(
+    "value,expected,raises",
+    [
+        ("1", 1, False),
+        ("8", 8, False),
+        ("0", None, True),
+        ("foo", None, True),
+    ]
+)
+def test_check_int_input(monkeypatch, value, expected, raises):
+    monkeypatch.setattr('mark2confluence.main.cfg', dot.dotify({"inputs": {"CONCURRENCY": value}}))
+    if raises:
+        with pytest.raises(SystemExit, match="1"):
+            main.check_int_input("CONCURRENCY", minimum=1)
+    else:
+        assert main.check_int_input("CONCURRENCY", minimum=1) == expected
+
+def test_publish_cache(tmp_path):
+    cache = main.PublishCache(str(tmp_path), "mark 14.1.1\0publish")
+    digest = cache.digest("<!-- Space: FOO -->\ncontent")
+    assert not cache.is_unchanged("docs/foo.md", digest)
+
+    cache.record("docs/foo.md", digest)
+    cache.save()
+
+    reloaded = main.PublishCache(str(tmp_path), "mark 14.1.1\0publish")
+    assert reloaded.is_unchanged("docs/foo.md", digest)
+    assert not reloaded.is_unchanged("docs/foo.md", reloaded.digest("<!-- Space: FOO -->\nchanged"))
+
+    other_action = main.PublishCache(str(tmp_path), "mark 14.1.1\0dry-run")
+    assert not other_action.is_unchanged("docs/foo.md", other_action.digest("<!-- Space: FOO -->\ncontent"))
+
+def test_publish_cache_priority(tmp_path):
+    cache = main.PublishCache(str(tmp_path), "")
+    cache.record("short.md", "a", 1.0)
+    cache.record("long.md", "b", 9.0)
+    cache.record("changed.md", "c", 2.0)
+    digests = {"short.md": "a", "long.md": "b", "changed.md": "new", "new.md": "d"}
+    order = sorted(digests, key=lambda key: cache.get_priority(key, digests[key]))
+    assert order == ["changed.md", "new.md", "long.md", "short.md"]
+
+def test_progress_journal(tmp_path):
+    path = str(tmp_path / "journal" / "run.jsonl")
+    journal = main.ProgressJournal(path, "key")
+    journal.record("published.md", main.OUTCOME_SUCCESS, "a")
+    journal.record("failed.md", main.OUTCOME_FAILURE, "b")
+    journal.record("retried.md", main.OUTCOME_SUCCESS, "c")
+    journal.record("retried.md", main.OUTCOME_FAILURE, "c")
+    journal.record("resumed.md", main.OUTCOME_UNCHANGED, "d")
+    journal.close()
+    with open(path, "a") as f:
+        f.write(json.dumps({"key": "other", "path": "other.md", "outcome": "success", "digest": "e"}) + "\n")
+        # killed while writing
+        f.write('{"key": "key", "path": "trunc')
+
+    resumed = main.ProgressJournal(path, "key", resume=True)
+    assert resumed.published == {"published.md": "a", "resumed.md": "d"}
+    assert resumed.is_published("published.md", "a")
+    assert not resumed.is_published("published.md", "changed")
+    resumed.record("failed.md", main.OUTCOME_SUCCESS, "b")
+    resumed.close()
+    with open(path) as f:
+        lines = [json.loads(line) for line in f]
+    # the other runs and the truncated line are dropped
+    assert [line["path"] for line in lines] == ["published.md", "failed.md", "retried.md", "retried.md", "resumed.md", "failed.md"]
+
+    assert main.ProgressJournal(path, "key").published == {}
+    assert os.path.getsize(path) == 0
+
+def test_get_journal_key(monkeypatch):
+    def key(SHA="abc", **inputs):
+        monkeypatch.setattr('mark2confluence.main.cfg', dot.dotify({
+            "inputs": {**main.DEFAULT_INPUTS, **inputs},
+            "github": {**main.DEFAULT_GITHUB, "SHA": SHA},
+        }))
+        return main.get_journal_key()
+
+    assert key() == key(CONFLUENCE_PASSWORD="secret", TIMEOUT="600", RESUME="true")
+    assert key() != key(ACTION="publish")
+    assert key() != key(SHA="def")
+
+def test_publish_cache_ignores_corrupted_file(tmp_path):
+    (tmp_path / main.CACHE_FILE_NAME).write_text("{not json")
+    cache = main.PublishCache(str(tmp_path), "")
+    assert cache.entries == {}
+
+def git(workspace, *args):
+    subprocess.run(["git", "-C", str(workspace), *args], check=True, capture_output=True)
+
+@pytest.fixture
+def git_workspace(tmp_path):
+    git(tmp_path, "init", "-q")
+    git(tmp_path, "config", "user.email", "test@example.com")
+    git(tmp_path, "config", "user.name", "test")
+    for name in ["docs/a/one.md", "docs/a/two.md", "docs/b/three.md", "docs/b/image.png"]:
+        os.makedirs(tmp_path / os.path.dirname(name), exist_ok=True)
+        (tmp_path / name).write_text("<!-- Title: foo -->\n")
+    git(tmp_path, "add", "-A")
+    git(tmp_path, "commit", "-q", "-m", "base")
+    return tmp_path
+
+def incremental_cfg(workspace, base_ref, default_parents=""):
+    return dot.dotify({
+        "inputs": {**main.DEFAULT_INPUTS, "DOC_DIR": "docs", "BASE_REF": base_ref, "DEFAULT_PARENTS": default_parents},
+        "github": {"WORKSPACE": str(workspace)},
+    })
+
+def test_get_files_changed_since_base_ref(monkeypatch, git_workspace):
+    (git_workspace / "docs/a/two.md").write_text("<!-- Title: bar -->\n")
+    (git_workspace / "docs/b/image.png").write_text("binary")
+    os.remove(git_workspace / "docs/b/three.md")
+    git(git_workspace, "commit", "-q", "-am", "change")
+    monkeypatch.setattr('mark2confluence.main.cfg', incremental_cfg(git_workspace, "HEAD~1"))
+
+    files = main.get_files_changed_since_base_ref([], None)
+
+    assert files == [f"{git_workspace}/docs/a/two.md"]
+
+def test_get_files_changed_since_base_ref_with_changed_parents(monkeypatch, git_workspace):
+    monkeypatch.setattr('mark2confluence.main.cfg', incremental_cfg(git_workspace, "HEAD", "docs/b/=FOO->NEW"))
+    default_parents = main.get_default_parents("docs/b/=FOO->NEW")
+
+    assert main.get_files_changed_since_base_ref(default_parents, "docs/b/=FOO->NEW") == []
+    assert main.get_files_changed_since_base_ref(default_parents, "docs/b/=FOO->OLD") == [f"{git_workspace}/docs/b/three.md"]
+
+def test_get_files_changed_since_base_ref_without_previous_parents(monkeypatch, git_workspace):
+    monkeypatch.setattr('mark2confluence.main.cfg', incremental_cfg(git_workspace, "HEAD", "docs/b/=FOO->NEW"))
+    default_parents = main.get_default_parents("docs/b/=FOO->NEW")
+
+    # without the mapping of the last run, the files it may have moved are selected
+    assert main.get_files_changed_since_base_ref(default_parents, None) == [f"{git_workspace}/docs/b/three.md"]
+
+def test_get_files_changed_since_base_ref_fallback(monkeypatch, git_workspace):
+    monkeypatch.setattr('mark2confluence.main.cfg', incremental_cfg(git_workspace, "not-a-ref"))
+    files = main.get_files_changed_since_base_ref([], None)
+    assert f"{git_workspace}/docs/a/one.md" in files
+    assert f"{git_workspace}/docs/b/three.md" in files
+
+def test_git_metadata_provider(monkeypatch, git_workspace):
+    (git_workspace / "docs/a/two.md").write_text("<!-- Title: bar -->\n")
+    git(git_workspace, "commit", "-q", "-am", "change two")
+    (git_workspace / "docs/new.md").write_text("<!-- Title: new -->\n")
+    monkeypatch.setattr('mark2confluence.main.cfg', incremental_cfg(git_workspace, ""))
+    paths = [f"{git_workspace}/docs/{name}" for name in ["a/one.md", "a/two.md", "new.md"]]
+
+    assert main.get_git_metadata_provider("{{ source_link }}", paths) is None
+    provider = main.get_git_metadata_provider("{{ last_commit_author }} {{ last_commit_date }}", paths)
+
+    two = provider.get_variables(paths[1])
+    assert two["last_commit_subject"] == "change two"
+    assert two["last_commit_author"] == "test"
+    assert len(two["last_commit_sha"]) == 40
+    # only the history up to the latest commit is read so far
+    assert "docs/a/one.md" not in provider.commits
+    assert provider.get_variables(paths[0])["last_commit_subject"] == "base"
+    assert provider.get_variables(paths[2]) == dict.fromkeys(main.GIT_METADATA_VARIABLES, "")
+    provider.close()
+
+def test_markdown_document(monkeypatch, tmp_path):
+    monkeypatch.setattr('mark2confluence.main.cfg', dot.dotify({"github": {"WORKSPACE": str(tmp_path)}}))
+    path = tmp_path / "foo" / "doc.md"
+    os.makedirs(path.parent)
+    shutil.copy(f"{RESOURCE_DIR}/markdown/test_inject_header/with_macros.md", path)
+
+    document = main.MarkdownDocument.load(str(path))
+    assert document.begins_with_mark_headers()
+    assert document.begins_with_mark_space_header()
+
+    parent_cfg = document.inject_default_parents([main.ParentCfg(directory="foo/", space="FOO", parents=["BAR"])])
+    assert parent_cfg is None
+    assert document.headers == [
+        ("Space", "Japan"),
+        ("Parent", "Football"),
+        ("Parent", "New Team"),
+        ("Title", "I have Mark Lenders"),
+        ("Include", "ac:toc"),
+    ]
+    assert document.inject_header("HEADER\n") == 15
+    assert document.save()
+    assert not document.save()
+    with open(path) as f:
+        assert f.read() == document.content
+
+def test_markdown_document_injects_parents_in_memory(monkeypatch, tmp_path):
+    monkeypatch.setattr('mark2confluence.main.cfg', dot.dotify({"github": {"WORKSPACE": str(tmp_path)}}))
+    path = tmp_path / "foo" / "doc.md"
+    os.makedirs(path.parent)
+    path.write_text("<!-- Title: BIM -->\n\ncontent\n")
+
+    document = main.MarkdownDocument.load(str(path))
+    parent_cfg = document.inject_default_parents([main.ParentCfg(directory="foo/", space="FOO", parents=["BAR"])])
+    assert parent_cfg.space == "FOO"
+    assert document.inject_header("HEADER\n") == 4
+    assert document.headers == [("Space", "FOO"), ("Parent", "BAR"), ("Title", "BIM")]
+    assert path.read_text() == "<!-- Title: BIM -->\n\ncontent\n"
+
+    document.save()
+    assert path.read_text() == "<!-- Space: FOO -->\n<!-- Parent: BAR -->\n<!-- Title: BIM -->\n\nHEADER\ncontent\n"
+
+def test_mermaid_cache(monkeypatch, tmp_path):
+    monkeypatch.setattr('mark2confluence.main.cfg', dot.dotify({
+        "inputs": {**main.DEFAULT_INPUTS, "MERMAID_CACHE_DIR": ".mermaid", "MERMAID_RENDERER": "cp {input} {output}"},
+        "github": {"WORKSPACE": str(tmp_path)},
+    }))
+    os.makedirs(tmp_path / "docs")
+    diagram = "```mermaid\ngraph TD\n  A --> B\n```\n"
+    path = tmp_path / "docs/page.md"
+    path.write_text(f"<!-- Title: foo -->\n\n{diagram}\ntext\n{diagram}```python\npass\n```\n")
+
+    cache = main.get_mermaid_cache()
+    document = main.MarkdownDocument.load(str(path))
+    assert document.replace_mermaid_blocks(cache) == 2
+    assert cache.counters == {"cached": 0, "rendered": 1, "failed": 0}
+    image = next((tmp_path / ".mermaid").glob("*.png"))
+    assert image.read_text() == "graph TD\n  A --> B\n"
+    assert document.content == (
+        f"<!-- Title: foo -->\n\n![mermaid diagram](../.mermaid/{image.name})\n\ntext\n"
+        f"![mermaid diagram](../.mermaid/{image.name})\n```python\npass\n```\n"
+    )
+
+    # the next run reuses the rendered image
+    cache = main.get_mermaid_cache()
+    assert main.MarkdownDocument.load(str(path)).replace_mermaid_blocks(cache) == 2
+    assert cache.counters == {"cached": 1, "rendered": 0, "failed": 0}
+
+def test_mermaid_cache_links_from_the_staging_area(tmp_path):
+    cache = main.MermaidCache(str(tmp_path / "cache"), "cp {input} {output}")
+    workspace = tmp_path / "workspace"
+    os.makedirs(workspace / "docs")
+    source = workspace / "docs" / "page.md"
+    source.write_text("<!-- Title: foo -->\n\n```mermaid\ngraph TD\n```\n")
+    staging_area = main.StagingArea(str(workspace), str(tmp_path / "staging" / "mirror"))
+
+    document = main.MarkdownDocument.load(str(source))
+    assert document.replace_mermaid_blocks(cache, staging_area.get_path(str(source))) == 1
+    staged_path = staging_area.stage(document)
+
+    link = document.content.split("](")[1].split(")")[0]
+    assert os.path.isfile(os.path.join(os.path.dirname(staged_path), link))
+
+def test_mermaid_cache_render_failure(tmp_path):
+    cache = main.MermaidCache(str(tmp_path / "cache"), "false {input} {output}")
+    path = tmp_path / "page.md"
+    path.write_text("```mermaid\ngraph TD\n```\n")
+    document = main.MarkdownDocument.load(str(path))
+    assert document.replace_mermaid_blocks(cache) == 0
+    assert document.content == "```mermaid\ngraph TD\n```\n"
+    assert cache.counters["failed"] == 1
+
+def test_staging_area(tmp_path):
+    workspace = tmp_path / "workspace"
+    staging = tmp_path / "staging"
+    os.makedirs(workspace / "docs" / "images")
+    os.makedirs(workspace / "shared")
+    (workspace / "docs" / "images" / "foo.png").write_text("png")
+    (workspace / "shared" / "snippet.md").write_text("snippet")
+    source = workspace / "docs" / "page.md"
+    source.write_text("<!-- Title: foo -->\n\n![foo](images/foo.png)\n")
+
+    staging_area = main.StagingArea(str(workspace), str(staging))
+    document = main.MarkdownDocument.load(str(source))
+    document.inject_header("HEADER\n")
+    staged_path = staging_area.stage(document)
+
+    assert staged_path == str(staging / "docs" / "page.md")
+    assert not os.path.islink(staged_path)
+    with open(staged_path) as f:
+        assert f.read() == "<!-- Title: foo -->\n\nHEADER\n![foo](images/foo.png)\n"
+    assert source.read_text() == "<!-- Title: foo -->\n\n![foo](images/foo.png)\n"
+    assert (staging / "docs" / "images" / "foo.png").read_text() == "png"
+    assert (staging / "shared" / "snippet.md").read_text() == "snippet"
+
+    # unchanged content is not written again
+    assert not document.save(staged_path)
+
+def test_staging_area_rejects_files_outside_the_workspace(tmp_path):
+    os.makedirs(tmp_path / "workspace")
+    (tmp_path / "outside.md").write_text("<!-- Title: foo -->\n")
+    staging_area = main.StagingArea(str(tmp_path / "workspace"), str(tmp_path / "staging"))
+    with pytest.raises(ValueError):
+        staging_area.stage(main.MarkdownDocument.load(str(tmp_path / "outside.md")))
+
+def discovery_cfg(workspace, **inputs):
+    return dot.dotify({
+        "inputs": {**main.DEFAULT_INPUTS, "DOC_DIR": "docs", **inputs},
+        "github": {"WORKSPACE": str(workspace)},
+    })
+
+@pytest.fixture
+def docs_tree(tmp_path):
+    for name in [
+        "docs/a.md", "docs/b.txt", "docs/sub/c.md", "docs/sub/legacy/d.md",
+        "docs/node_modules/pkg/README.md", "docs/.git/e.md", "docs/build/f.md", "docs/sub/g.md",
+    ]:
+        os.makedirs(tmp_path / os.path.dirname(name), exist_ok=True)
+        (tmp_path / name).write_text("<!-- Title: foo -->\n")
+    os.symlink(tmp_path / "docs" / "sub", tmp_path / "docs" / "linked.md")
+    return tmp_path
+
+def test_get_files_by_doc_dir_pattern(monkeypatch, docs_tree):
+    monkeypatch.setattr('mark2confluence.main.cfg', discovery_cfg(docs_tree))
+    assert main.get_files_by_doc_dir_pattern() == [
+        f"{docs_tree}/docs/a.md",
+        f"{docs_tree}/docs/build/f.md",
+        f"{docs_tree}/docs/sub/c.md",
+        f"{docs_tree}/docs/sub/g.md",
+        f"{docs_tree}/docs/sub/legacy/d.md",
+    ]
+
+def test_get_files_by_doc_dir_pattern_filters(monkeypatch, docs_tree):
+    monkeypatch.setattr('mark2confluence.main.cfg', discovery_cfg(
+        docs_tree, DOC_DIR_PATTERN=".*/sub/.*", EXCLUDE_DIRS=".git node_modules docs/sub/legacy",
+    ))
+    assert main.get_files_by_doc_dir_pattern() == [f"{docs_tree}/docs/sub/c.md", f"{docs_tree}/docs/sub/g.md"]
+
+def test_staging_dir_in_the_workspace(monkeypatch, docs_tree):
+    monkeypatch.setattr('mark2confluence.main.cfg', discovery_cfg(
+        docs_tree, DOC_DIR="", STAGING="true", STAGING_DIR="docs/sub/staging", EXCLUDE_DIRS=".git node_modules build",
+    ))
+    staging_area, tmp_dir = main.get_staging_area()
+    assert staging_area.directory == f"{docs_tree}/docs/sub/staging"
+    assert tmp_dir is None
+    staging_area.stage(main.MarkdownDocument.load(str(docs_tree / "docs" / "sub" / "c.md")))
+    staging_area.stage(main.MarkdownDocument.load(str(docs_tree / "docs" / "a.md")))
+    # the staging directory is neither mirrored into itself nor searched
+    assert not os.path.lexists(docs_tree / "docs" / "sub" / "staging" / "docs" / "sub" / "staging")
+    assert main.get_files_by_doc_dir_pattern() == [
+        f"{docs_tree}/docs/a.md",
+        f"{docs_tree}/docs/sub/c.md",
+        f"{docs_tree}/docs/sub/g.md",
+        f"{docs_tree}/docs/sub/legacy/d.md",
+    ]
+
+    monkeypatch.setattr('mark2confluence.main.cfg', discovery_cfg(docs_tree, STAGING="true", STAGING_DIR=".."))
+    with pytest.raises(SystemExit):
+        main.get_staging_area()
+
+def test_get_files_by_doc_dir_pattern_modified_interval(monkeypatch, docs_tree):
+    os.utime(docs_tree / "docs" / "a.md", (0, 0))
+    monkeypatch.setattr('mark2confluence.main.cfg', discovery_cfg(docs_tree, DOC_DIR_PATTERN=".*/a.md|.*/c.md", MODIFIED_INTERVAL="10"))
+    assert main.get_files_by_doc_dir_pattern() == [f"{docs_tree}/docs/sub/c.md"]
+
+def test_get_files_by_doc_dir_pattern_respects_gitignore(monkeypatch, docs_tree):
+    git(docs_tree, "init", "-q")
+    (docs_tree / ".gitignore").write_text("build/\ng.md\n")
+    monkeypatch.setattr('mark2confluence.main.cfg', discovery_cfg(docs_tree, RESPECT_GITIGNORE="true"))
+    assert main.get_files_by_doc_dir_pattern() == [
+        f"{docs_tree}/docs/a.md",
+        f"{docs_tree}/docs/sub/c.md",
+        f"{docs_tree}/docs/sub/legacy/d.md",
+    ]
+
+def test_default_parents_index(monkeypatch):
+    monkeypatch.setattr('mark2confluence.main.cfg', dot.dotify({"github": {"WORKSPACE": WORKSPACE}}))
+    cfgs = main.get_default_parents("\n".join([
+        "tests/*=FOO->TESTS",
+        "tests/resources/*=FOO->RESOURCES",
+        "tests/resources/markdown/=FOO->MARKDOWN",
+        "mark2confluence/=BAR",
+        "*/[ab]*/=BAZ",
+        "tests/=FOO",
+    ]))
+    index = main.DefaultParentsIndex(cfgs)
+    directories = [
+        f"{WORKSPACE}/tests",
+        f"{WORKSPACE}/tests/resources",
+        f"{WORKSPACE}/tests/resources/markdown",
+        f"{WORKSPACE}/tests/resources/markdown/test_inject_header",
+        f"{WORKSPACE}/mark2confluence",
+        f"{WORKSPACE}/mark2confluence/sub",
+        f"{WORKSPACE}/other/bar",
+        f"{WORKSPACE}/other",
+    ]
+    for directory in directories:
+        expected = next((cfg for cfg in cfgs if cfg.is_directory_included(directory)), None)
+        assert index.resolve(directory) is expected
+
+    assert index.resolve(f"{WORKSPACE}/tests/resources/markdown").space == "FOO"
+    assert index.resolve(f"{WORKSPACE}/tests/resources/markdown").parents == ["MARKDOWN"]
+    assert index.resolve(f"{WORKSPACE}/other") is None
+    assert len(index._resolved) == len(directories)
+
+def test_default_parents_index_without_parents():
+    index = main.DefaultParentsIndex([], workspace=WORKSPACE)
+    assert index.resolve(f"{WORKSPACE}/tests") is None
+
+@pytest.mark.parametrize("watcher_class", [main.InotifyWatcher, main.PollingWatcher])
+def test_watcher(monkeypatch, docs_tree, watcher_class):
+    monkeypatch.setattr('mark2confluence.main.cfg', discovery_cfg(docs_tree))
+    if watcher_class is main.PollingWatcher:
+        watcher_class = lambda topdir, exclude_dirs: main.PollingWatcher(topdir, exclude_dirs, interval=0.05)
+    watcher = watcher_class(str(docs_tree / "docs"), ["node_modules"])
+    try:
+        (docs_tree / "docs/a.md").write_text("changed")
+        os.makedirs(docs_tree / "docs/new")
+        (docs_tree / "docs/new/d.md").write_text("new")
+        os.makedirs(docs_tree / "docs/node_modules/pkg", exist_ok=True)
+        (docs_tree / "docs/node_modules/pkg/e.md").write_text("excluded")
+
+        changed = main.wait_for_changes(watcher, 0.3)
+
+        assert f"{docs_tree}/docs/a.md" in changed
+        assert f"{docs_tree}/docs/new/d.md" in changed
+        assert not any("node_modules" in path for path in changed)
+        assert watcher.changes(0.1) == set()
+    finally:
+        watcher.close()
+
+@pytest.fixture
+def stub_mark(tmp_path, monkeypatch):
+    """A mark executable recording its -f argument, failing for the files containing FAIL."""
+    bin_dir = tmp_path / "bin"
+    os.makedirs(bin_dir)
+    calls = tmp_path / "calls"
+    stub = bin_dir / "mark"
+    stub.write_text(f"""#!/bin/sh
+while [ $# -gt 0 ]; do
+  if [ "$1" = "-f" ]; then echo "$2" >> {calls}; files="$2"; fi
+  shift
+done
+case "$files" in *fail*) echo "failed $files" >&2; exit 1;; esac
+exit 0
+""")
+    stub.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}:{os.environ['PATH']}")
+    monkeypatch.setattr('mark2confluence.main.cfg', dot.dotify({"inputs": {**main.DEFAULT_INPUTS, "ACTION": "dry-run"}}))
+    return calls
+
+def test_publish_batch(stub_mark, tmp_path):
+    paths = [str(tmp_path / name) for name in ["a.md", "b{1}.md"]]
+    assert [result.as_status() for result in main.publish_batch(paths)] == [(True, None), (True, None)]
+    assert stub_mark.read_text() == "{a.md,b\\{1\\}.md}\n"
+
+def test_publish_batch_falls_back_to_single_files(stub_mark, tmp_path):
+    paths = [str(tmp_path / name) for name in ["a.md", "fail.md"]]
+    results = main.publish_batch(paths)
+    assert results[0].as_status() == (True, None)
+    assert results[1].success is False
+    assert stub_mark.read_text().splitlines() == ["{a.md,fail.md}", paths[0], paths[1]]
+
+@pytest.fixture
+def processing_mark(stub_mark, tmp_path):
+    """A mark executable logging "processing <file>" for each file of its -f glob, stopping at the first failing one."""
+    (tmp_path / "bin" / "mark").write_text(f"""#!/bin/sh
+while [ $# -gt 0 ]; do
+  if [ "$1" = "-f" ]; then echo "$2" >> {stub_mark}; files="$2"; fi
+  shift
+done
+files=${{files#\\{{}}; files=${{files%\\}}}}
+IFS=,
+for file in $files; do
+  echo "2026-10-18 12:00:00.000 INFO  processing $file" >&2
+  case "$file" in *fail*) echo "ERROR failed $file" >&2; exit 1;; *hang*) sleep 10;; esac
+done
+exit 0
+""")
+    return stub_mark
+
+def test_publish_batch_retries_only_the_files_not_published(processing_mark, tmp_path):
+    paths = [str(tmp_path / name) for name in ["a.md", "b.md", "fail.md", "c.md", "d.md"]]
+    results = main.publish_batch(paths)
+    assert [result.success for result in results] == [True, True, False, True, True]
+    assert results[2].errors.endswith(f"ERROR failed {paths[2]}\n".encode())
+    # a and b are not published again
+    assert processing_mark.read_text().splitlines() == ["{a.md,b.md,fail.md,c.md,d.md}", paths[2], "{c.md,d.md}"]
+
+def test_publish_batch_fallback_is_bounded_by_the_batch_timeout(processing_mark, tmp_path):
+    paths = [str(tmp_path / name) for name in ["a.md", "hang.md", "c.md"]]
+    results = main.publish_batch(paths, timeouts=[0.5] * 3)
+    assert results[0].success
+    assert not results[1].success and main.EXEC_TIMEOUT_MESSAGE.encode() in results[1].errors
+    # the batch spent its timeout, neither the hanging file nor the next one run again
+    assert not results[2].attempted
+    assert processing_mark.read_text().splitlines() == ["{a.md,hang.md,c.md}"]
+
+def test_get_shard(monkeypatch, tmp_path):
+    monkeypatch.setattr('mark2confluence.main.cfg', dot.dotify({"github": {"WORKSPACE": str(tmp_path)}}))
+    pages = {
+        "guides/index.md": "<!-- Space: FOO -->\n<!-- Title: Guides -->\n",
+        "guides/install.md": "<!-- Title: Install -->\n" + "x" * 20000,
+        "guides/usage.md": "<!-- Title: Usage -->\n",
+        "api/one.md": "<!-- Space: FOO -->\n<!-- Parent: API -->\n<!-- Title: One -->\n",
+        "api/two.md": "<!-- Space: FOO -->\n<!-- Parent: API -->\n<!-- Title: Two -->\n",
+        "faq.md": "<!-- Space: FOO -->\n<!-- Title: FAQ -->\n",
+        "other.md": "<!-- Space: BAR -->\n<!-- Parent: Guides -->\n<!-- Title: Other -->\n",
+        "README.md": "# no headers\n",
+    }
+    files = []
+    for name, content in pages.items():
+        os.makedirs(tmp_path / os.path.dirname(name), exist_ok=True)
+        (tmp_path / name).write_text(content)
+        files.append(f"{tmp_path}/{name}")
+    default_parents = main.DefaultParentsIndex(main.get_default_parents("guides/=FOO->Guides"), workspace=str(tmp_path))
+
+    shards = [main.get_shard(files, index, 3, default_parents) for index in range(3)]
+
+    assert sorted(path for shard in shards for path in shard) == sorted(files)
+    # the heaviest page tree gets a shard for itself
+    assert shards[0] == [f"{tmp_path}/guides/index.md", f"{tmp_path}/guides/install.md", f"{tmp_path}/guides/usage.md"]
+    assert sum(f"{tmp_path}/api/one.md" in shard and f"{tmp_path}/api/two.md" in shard for shard in shards) == 1
+    assert shards == [main.get_shard(files, index, 3, default_parents) for index in range(3)]
+    assert main.get_shard(files, 0, 1, default_parents) == files
+
+def test_plan_waves():
+    pages = {
+        "a.md": ("FOO", ["Docs", "Guides"], "Install"),
+        "b.md": ("FOO", ["Docs", "Guides"], "Usage"),
+        "guides.md": ("FOO", ["Docs"], "Guides"),
+        "c.md": ("FOO", ["Docs"], "FAQ"),
+        "d.md": ("BAR", ["Docs"], "Other space"),
+        "e.md": ("BAR", ["Docs"], "Another"),
+        "f.md": ("FOO", [], "Top"),
+    }
+    # Docs is created by guides.md, the first file needing it in FOO, and by d.md in BAR
+    assert main.plan_waves(pages) == [["guides.md", "d.md", "f.md"], ["a.md", "b.md", "c.md", "e.md"]]
+
+def test_plan_waves_circular_parents():
+    pages = {"a.md": ("FOO", ["B"], "A"), "b.md": ("FOO", ["A"], "B"), "c.md": ("FOO", ["A"], "C")}
+    assert main.plan_waves(pages) == [["a.md", "b.md", "c.md"]]
+
+def prepared_file(path, space, parents, title):
+    return main.PreparedFile(path, path, 0, space, parents, title, [])
+
+def test_publish_stream_batches_consecutive_files(monkeypatch):
+    groups = []
+    def fake_publish_group(paths, files, timeouts, log=main.logger):
+        groups.append(paths)
+        return {path: main.PublishResult(True) for path in paths}
+    monkeypatch.setattr(main, "publish_group", fake_publish_group)
+    items = [prepared_file(path, "FOO", [], path) for path in ["/x/1.md", "/x/2.md", "/x/3.md", "/y/1.md"]]
+    items.append(prepared_file("/y/2.md", "BAR", [], "other"))
+
+    results = list(main.publish_stream(iter(items), 1, batch_size=2))
+
+    assert groups == [["/x/1.md", "/x/2.md"], ["/x/3.md"], ["/y/1.md"], ["/y/2.md"]]
+    assert [item.path for item, _ in results] == [item.path for item in items]
+
+def test_publish_stream_orders_parent_pages(monkeypatch):
+    spans = {}
+    def fake_publish(path, log=main.logger, **kwargs):
+        started = main.time.monotonic()
+        main.time.sleep(0.2)
+        spans[path] = (started, main.time.monotonic())
+        return True, None
+    monkeypatch.setattr(main, "publish", fake_publish)
+    monkeypatch.setattr('mark2confluence.main.cfg', dot.dotify({"inputs": {**main.DEFAULT_INPUTS}}))
+    items = [
+        prepared_file("/a.md", "FOO", ["Docs"], "Guides"),
+        prepared_file("/b.md", "FOO", ["Docs"], "FAQ"),
+        prepared_file("/c.md", "FOO", ["Docs", "Guides"], "Install"),
+        prepared_file("/d.md", "BAR", ["Docs"], "Other"),
+    ]
+
+    results = list(main.publish_stream(iter(items), 4))
+
+    assert sorted(item.path for item, result in results if result.success) == ["/a.md", "/b.md", "/c.md", "/d.md"]
+    # Docs of FOO is created by a.md, which provides Guides too; BAR is independent
+    assert spans["/b.md"][0] >= spans["/a.md"][1]
+    assert spans["/c.md"][0] >= spans["/a.md"][1]
+    assert spans["/d.md"][0] < spans["/a.md"][1]
+
+def test_publish_stream_waits_for_a_parent_found_after_its_children(monkeypatch):
+    spans = {}
+    def fake_publish(path, log=main.logger, **kwargs):
+        started = main.time.monotonic()
+        main.time.sleep(0.2)
+        spans[path] = (started, main.time.monotonic())
+        return True, None
+    monkeypatch.setattr(main, "publish", fake_publish)
+    monkeypatch.setattr('mark2confluence.main.cfg', dot.dotify({"inputs": {**main.DEFAULT_INPUTS}}))
+    # discovery sorts docs/guides/a.md before docs/guides/index.md
+    items = [
+        prepared_file("/guides/a.md", "FOO", ["Guides"], "A"),
+        prepared_file("/guides/b.md", "FOO", ["Guides"], "B"),
+        prepared_file("/guides/index.md", "FOO", [], "Guides"),
+    ]
+
+    results = list(main.publish_stream(iter(items), 4))
+
+    assert sorted(item.path for item, result in results if result.success) == ["/guides/a.md", "/guides/b.md", "/guides/index.md"]
+    assert spans["/guides/a.md"][0] >= spans["/guides/index.md"][1]
+    assert spans["/guides/b.md"][0] >= spans["/guides/index.md"][1]
+    # the siblings do not wait for each other
+    assert spans["/guides/b.md"][0] < spans["/guides/a.md"][1]
+
+def test_publish_stream_publishes_a_late_parent_after_its_pioneer(monkeypatch):
+    spans = {}
+    def fake_publish(path, log=main.logger, **kwargs):
+        started = main.time.monotonic()
+        main.time.sleep(0.05)
+        spans[path] = (started, main.time.monotonic())
+        return True, None
+    monkeypatch.setattr(main, "publish", fake_publish)
+    monkeypatch.setattr(main, "PIPELINE_QUEUE_SIZE", 2)
+    monkeypatch.setattr('mark2confluence.main.cfg', dot.dotify({"inputs": {**main.DEFAULT_INPUTS}}))
+    items = [prepared_file("/guides/a.md", "FOO", ["Guides"], "A")]
+    items += [prepared_file(f"/other/{index}.md", "FOO", ["Other"], str(index)) for index in range(4)]
+    items.append(prepared_file("/guides/index.md", "FOO", [], "Guides"))
+
+    results = list(main.publish_stream(iter(items), 4))
+
+    assert len(results) == len(items)
+    # a.md has not been held until the end, index.md updates the page it created
+    assert spans["/guides/index.md"][0] >= spans["/guides/a.md"][1]
+
+def test_prefetch():
+    produced = []
+    def numbers():
+        for number in range(100):
+            produced.append(number)
+            yield number
+
+    iterator = main.prefetch(numbers(), maxsize=4)
+    assert next(iterator) == 0
+    main.time.sleep(0.1)
+    # the producer runs ahead by the size of the queue at most
+    assert len(produced) <= 6
+    assert list(iterator) == list(range(1, 100))
+
+    def failing():
+        yield 1
+        raise ValueError("boom")
+    with pytest.raises(ValueError, match="boom"):
+        list(main.prefetch(failing()))
+
+def test_get_conflicts(monkeypatch):
+    monkeypatch.setattr('mark2confluence.main.cfg', dot.dotify({"github": {"WORKSPACE": "/ws"}}))
+    pages = {
+        "/ws/a.md": ("FOO", ["Docs"], "Install"),
+        "/ws/b.md": ("FOO", ["Guides"], "Install"),
+        "/ws/c.md": ("BAR", ["Docs"], "Install"),
+        "/ws/d.md": ("FOO", [], "Usage"),
+        "/ws/e.md": ("FOO", [], None),
+        "/ws/f.md": ("FOO", [], None),
+    }
+    headers = {
+        "/ws/d.md": [("Space", "FOO"), ("Title", "Usage"), ("title", "Other")],
+        "/ws/a.md": [("Space", "FOO"), ("Parent", "Docs"), ("Title", "Install")],
+    }
+    assert main.get_conflicts(pages, headers) == {
+        "/ws/a.md": "Page 'Install' of space FOO is published by a.md, b.md",
+        "/ws/b.md": "Page 'Install' of space FOO is published by a.md, b.md",
+        "/ws/d.md": "Conflicting Title headers: Other, Usage",
+    }
+
+def test_group_batches():
+    files = {path: path for path in ["/a/1.md", "/a/2.md", "/a/3.md", "/a/4.md", "/b/5.md"]}
+    spaces = {"/a/1.md": "FOO", "/a/2.md": "BAR", "/a/3.md": "FOO", "/a/4.md": "FOO", "/b/5.md": "FOO"}
+    assert main.group_batches(files, spaces, 2) == [["/a/1.md", "/a/3.md"], ["/a/4.md"], ["/a/2.md"], ["/b/5.md"]]
+
+def test_publish_files_with_batches(stub_mark, tmp_path):
+    files = {str(tmp_path / name): str(tmp_path / name) for name in ["a.md", "b.md", "fail.md", "c.md"]}
+    batches = [[str(tmp_path / "a.md"), str(tmp_path / "b.md")], [str(tmp_path / "fail.md"), str(tmp_path / "c.md")]]
+    status = main.publish_files(files, 2, batches)
+    assert list(status.keys()) == list(files.keys())
+    assert [result.success for result in status.values()] == [True, True, False, True]
+
+def test_run_mark_keeps_a_bounded_tail(monkeypatch, tmp_path):
+    monkeypatch.setattr('mark2confluence.main.cfg', dot.dotify({"inputs": {**main.DEFAULT_INPUTS, "ACTION": "verify"}}))
+    log = main.BufferedLog()
+    script = "for i in $(seq 1 100); do echo out$i; echo err$i >&2; done; exit 3"
+    returncode, errs = main.run_mark(["sh", "-c", script], str(tmp_path), 10, log)
+    assert returncode == 3
+    assert errs.splitlines() == [f"err{i}".encode() for i in range(51, 101)]
+    assert ("INFO", "Verify: out100") in log.records
+    assert ("DEBUG", "mark: err1") in log.records
+
+def test_run_mark_writes_the_output_file(monkeypatch, tmp_path):
+    monkeypatch.setattr('mark2confluence.main.cfg', dot.dotify({"inputs": {**main.DEFAULT_INPUTS, "ACTION": "publish"}}))
+    log = main.BufferedLog()
+    output_path = tmp_path / "logs" / "docs" / "page.md.log"
+    returncode, _ = main.run_mark(["sh", "-c", "echo out; echo err >&2"], str(tmp_path), 10, log, str(output_path))
+    assert returncode == 0
+    assert not log.records
+    assert sorted(output_path.read_text().splitlines()) == ["err", "out"]
+
+def test_run_mark_timeout(monkeypatch, tmp_path):
+    monkeypatch.setattr('mark2confluence.main.cfg', dot.dotify({"inputs": {**main.DEFAULT_INPUTS}}))
+    returncode, errs = main.run_mark(["sh", "-c", "echo started >&2; sleep 10; echo done"], str(tmp_path), 0.5)
+    assert returncode is None
+    assert errs == b"started\n"
+
+@pytest.mark.parametrize(
+    "policy,content,expected",
+    [
+        (main.TimeoutPolicy(120), "x" * 4096, 120),
+        (main.TimeoutPolicy(10, per_kb=0.5), "x" * 4096, 12),
+        (
+            main.TimeoutPolicy(10, per_attachment=5),
+            "<!-- Attachment: a.pdf -->\n![a](img/a.png) ![b](https://example.com/b.png)\n```mermaid\ngraph TD\n```\n",
+            25,
+        ),
+    ]
+)
+def test_timeout_policy(policy, content, expected):
+    assert policy.get_timeout(content) == expected
+
+@pytest.mark.parametrize(
+    "errs,expected",
+    [
+        (b"ERROR unexpected status code: 429 Too Many Requests", True),
+        (b"ERROR bad gateway", True),
+        (b"read tcp: connection reset by peer", True),
+        (b"ERROR Get https://confluence/rest/api: HTTP/1.1 502", True),
+        (b"ERROR: POST /content: 503 Service Unavailable: busy", True),
+        (b"ERROR updating page 4041234: read tcp: i/o timeout", True),
+        # our own timeout: mark hung, it would hang again
+        (b"read tcp: i/o timeout\nExec timeout after 120s", False),
+        (b"ERROR unexpected status code: 401 Unauthorized", False),
+        (b"ERROR: GET /space/OTHER: 404 Not Found: no space with key OTHER", False),
+        (b"ERROR template error at line 503: unexpected token", False),
+        (b"ERROR attachment of 404 bytes rejected: 429 Too Many Requests", True),
+        (b"ERROR unable to resolve parent page", False),
+        (None, False),
+    ]
+)
+def test_is_transient_failure(errs, expected):
+    assert main.is_transient_failure(errs) == expected
+
+@pytest.mark.parametrize(
+    "errors,expected_success,expected_attempts",
+    [
+        ([b"429 Too Many Requests", b"503 Service Unavailable"], True, 3),
+        ([b"429 Too Many Requests"] * 5, False, 3),
+        ([b"401 Unauthorized"], False, 1),
+    ]
+)
+def test_publish_with_retries(monkeypatch, errors, expected_success, expected_attempts):
+    calls = []
+    def fake_publish(path, log=main.logger, **kwargs):
+        calls.append(path)
+        if len(calls) <= len(errors):
+            return False, errors[len(calls) - 1]
+        return True, None
+    monkeypatch.setattr(main, "publish", fake_publish)
+    monkeypatch.setattr(main, "retry_policy", main.RetryPolicy(retries=2, backoff=0))
+
+    result = main.publish_with_retries("/tmp/foo.md", main.BufferedLog())
+
+    assert result.success == expected_success
+    assert result.attempts == expected_attempts
+    assert len(calls) == expected_attempts
+
+def test_publish_with_retries_within_run_budget(monkeypatch):
+    calls = []
+    def fake_publish(path, log=main.logger, timeout=120, **kwargs):
+        calls.append(timeout)
+        return False, b"503 Service Unavailable"
+    monkeypatch.setattr(main, "publish", fake_publish)
+    monkeypatch.setattr(main, "retry_policy", main.RetryPolicy(retries=5, backoff=4))
+    monkeypatch.setattr(main, "run_budget", main.RunBudget(time_budget=2))
+    # delays of 1s then 2s
+    monkeypatch.setattr(main.random, "uniform", lambda low, high: high / 4)
+
+    result = main.publish_with_retries("/tmp/foo.md", main.BufferedLog(), timeout=120)
+
+    # the timeout is capped to the budget, and no retry waits past it
+    assert calls[0] <= 2
+    assert result.attempted and not result.success
+    assert result.attempts == 2
+
+    main.run_budget.deadline = main.time.monotonic()
+    result = main.publish_with_retries("/tmp/foo.md", main.BufferedLog())
+    assert not result.attempted
+    assert result.errors == b"Not attempted, TIME_BUDGET exhausted"
+
+def test_publish_files_stops_after_consecutive_errors(stub_mark, tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "run_budget", main.RunBudget(fail_fast=2))
+    paths = [str(tmp_path / name) for name in ["fail1.md", "ok.md", "fail2.md", "fail3.md", "ok2.md"]]
+    results = main.publish_files({path: path for path in paths}, 1)
+    assert [result.attempts for result in results.values()] == [1, 1, 1, 1, 0]
+    assert main.run_budget.stop_reason == "FAIL_FAST after 2 consecutive failures"
+
+def test_retry_policy_delay():
+    policy = main.RetryPolicy(retries=5, backoff=2, max_backoff=5)
+    for attempt in range(1, 6):
+        assert 0 <= policy.get_delay(attempt) <= min(5, 2 ** attempt)
+
+def test_rate_limiter():
+    limiter = main.RateLimiter(20)
+    start = main.time.monotonic()
+    for _ in range(30):
+        limiter.acquire()
+    # the bucket starts full with 20 tokens, the other 10 come at 20 per second
+    assert main.time.monotonic() - start >= 0.45
+
+def test_run_report(monkeypatch, tmp_path):
+    monkeypatch.setattr('mark2confluence.main.cfg', dot.dotify({"github": {"WORKSPACE": str(tmp_path)}}))
+    report_path = tmp_path / "out" / "report.jsonl"
+    report = main.RunReport(str(report_path))
+    with report.timed("discovery"):
+        pass
+    with report.timed("publish"):
+        pass
+    with report.timed("discovery"):
+        pass
+    report.record_file(f"{tmp_path}/docs/skipped.md", main.OUTCOME_SKIPPED)
+    report.record_file(f"{tmp_path}/docs/fast.md", main.OUTCOME_SUCCESS, 2048, main.PublishResult(True, duration=1.5))
+    report.record_file(f"{tmp_path}/docs/slow.md", main.OUTCOME_FAILURE, 1024, main.PublishResult(False, b"err", 3, 30))
+    report.record_file(f"{tmp_path}/docs/late.md", main.OUTCOME_NOT_ATTEMPTED, 10)
+    report.stop_reason = "TIME_BUDGET exhausted"
+
+    # the files are written as they are recorded
+    report.output.flush()
+    assert len(report_path.read_text().splitlines()) == 4
+    report.close()
+    lines = [json.loads(line) for line in report_path.read_text().splitlines()]
+    assert [line["type"] for line in lines] == ["file", "file", "file", "file", "summary"]
+    assert lines[2] == {"type": "file", "path": "docs/slow.md", "outcome": "failure", "bytes": 1024, "duration": 30, "retries": 2}
+    assert list(lines[4]["phases"].keys()) == ["discovery", "publish"]
+    assert lines[4]["counters"] == {"success": 1, "failure": 1, "not attempted": 1, "unchanged": 0, "skipped": 1}
+    assert lines[4]["stop_reason"] == "TIME_BUDGET exhausted"
+
+    summary_path = tmp_path / "summary.md"
+    summary_path.write_text("previous step\n")
+    report.write_step_summary(str(summary_path))
+    summary = summary_path.read_text()
+    assert summary.startswith("previous step\n### mark2confluence\n")
+    assert "| 1 | 1 | 1 | 0 | 1 |" in summary
+    assert "**1 files not attempted** (TIME_BUDGET exhausted)" in summary
+    assert "- docs/slow.md: `err`" in summary
+    assert summary.index("docs/slow.md") < summary.index("docs/fast.md")
+    assert "docs/skipped.md" not in summary
+
+@pytest.fixture
+def run_main(tmp_path, monkeypatch):
+    """Run main() in a workspace of tmp_path, with a mark stub logging when it starts and ends each file."""
+    bin_dir = tmp_path / "bin"
+    os.makedirs(bin_dir)
+    events = tmp_path / "events"
+    stub = bin_dir / "mark"
+    stub.write_text(f"""#!/bin/sh
+if [ "$1" = "--version" ]; then echo "mark version 0.0.0"; exit 0; fi
+while [ $# -gt 0 ]; do
+  if [ "$1" = "-f" ]; then file=$(basename "$2"); fi
+  shift
+done
+echo "start $file $(date +%s.%N)" >> {events}
+sleep 0.2
+echo "end $file $(date +%s.%N)" >> {events}
+case "$file" in *fail*) echo "failed $file" >&2; exit 1;; esac
+exit 0
+""")
+    stub.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}:{os.environ['PATH']}")
+    for key in [key for key in os.environ if key.startswith(("INPUT_", "GITHUB_"))]:
+        monkeypatch.delenv(key)
+    # main() replaces them
+    for name in ["retry_policy", "rate_limiter", "run_budget", "confluence_client"]:
+        monkeypatch.setattr(main, name, getattr(main, name))
+    workspace = tmp_path / "workspace"
+    os.makedirs(workspace)
+
+    def run(**inputs):
+        if events.exists():
+            events.unlink()
+        monkeypatch.setattr('mark2confluence.main.cfg', dot.dotify({
+            "inputs": dict(main.DEFAULT_INPUTS),
+            "github": dict(main.DEFAULT_GITHUB),
+            "actions": {},
+            "runner": {},
+        }))
+        with monkeypatch.context() as env:
+            env.setenv("GITHUB_WORKSPACE", str(workspace))
+            env.setenv("GITHUB_SHA", "0123abc")
+            env.setenv("INPUT_REPORT_PATH", "report.jsonl")
+            for key, value in inputs.items():
+                env.setenv(f"INPUT_{key}", value)
+            rc = main.main()
+        with open(workspace / "report.jsonl") as f:
+            summary = [json.loads(line) for line in f][-1]
+        spans = {}
+        if events.exists():
+            for line in events.read_text().splitlines():
+                event, file, timestamp = line.split()
+                spans.setdefault(file, {})[event] = float(timestamp)
+        return rc, summary["counters"], spans
+
+    run.workspace = workspace
+    return run
+
+def test_main_end_to_end(run_main):
+    docs = run_main.workspace / "docs"
+    os.makedirs(docs / "guides")
+    # discovered before the index.md providing their parent page
+    (docs / "guides" / "a.md").write_text("<!-- Space: FOO -->\n<!-- Parent: Guides -->\n<!-- Title: A -->\n\na\n")
+    (docs / "guides" / "b.md").write_text("<!-- Space: FOO -->\n<!-- Parent: Guides -->\n<!-- Title: B -->\n\nb\n")
+    (docs / "guides" / "index.md").write_text("<!-- Space: FOO -->\n<!-- Title: Guides -->\n\nguides\n")
+    (docs / "fail.md").write_text("<!-- Space: FOO -->\n<!-- Title: Broken -->\n\nbroken\n")
+    (docs / "notes.md").write_text("no headers\n")
+    inputs = {
+        "DOC_DIR": "docs", "ACTION": "publish", "CONCURRENCY": "4", "STAGING": "true", "RETRIES": "0",
+        "CACHE_DIR": ".cache", "JOURNAL_PATH": "journal.jsonl", "RESUME": "true",
+    }
+
+    rc, counters, spans = run_main(**inputs)
+
+    assert rc == 1
+    assert counters == {"success": 3, "failure": 1, "not attempted": 0, "unchanged": 0, "skipped": 1}
+    assert spans["a.md"]["start"] >= spans["index.md"]["end"]
+    assert spans["b.md"]["start"] >= spans["index.md"]["end"]
+    # the source files are left untouched with STAGING
+    assert (docs / "guides" / "a.md").read_text().startswith("<!-- Space: FOO -->")
+
+    # interrupted before saving the cache: the journal resumes the run
+    shutil.rmtree(run_main.workspace / ".cache")
+    rc, counters, spans = run_main(**inputs)
+    assert rc == 1
+    assert counters == {"success": 0, "failure": 1, "not attempted": 0, "unchanged": 3, "skipped": 1}
+    assert list(spans) == ["fail.md"]
+
+    # the resumed files have been recorded in the cache
+    rc, counters, spans = run_main(**{**inputs, "RESUME": "false"})
+    assert counters["unchanged"] == 3
+    assert list(spans) == ["fail.md"]
+
+def test_main_checks_every_target_space_before_publishing(run_main):
+    docs = run_main.workspace / "docs"
+    os.makedirs(docs / "other")
+    (docs / "a.md").write_text("<!-- Space: DOCS -->\n<!-- Title: A -->\n\na\n")
+    # the space of this one comes from DEFAULT_PARENTS
+    (docs / "other" / "b.md").write_text("<!-- Title: B -->\n\nb\n")
+    with FakeConfluence(spaces=["DOCS"]) as fake:
+        rc, counters, spans = run_main(
+            ACTION="publish", CONFLUENCE_BASE_URL=fake.url, CONFLUENCE_USERNAME="bot", CONFLUENCE_PASSWORD="secret",
+            DOC_DIR="docs", DEFAULT_PARENTS="docs/other/=OTHER", CACHE_DIR=".cache", RETRIES="0",
+        )
+        assert fake.count("GET", "/space/DOCS") == 1
+        assert fake.count("GET", "/space/OTHER") == 1
+
+    # stopped before publishing anything, the cache and the report are still written
+    assert rc == 1
+    assert counters["not attempted"] == 2
+    assert spans == {}
+    assert os.listdir(run_main.workspace / ".cache")
+    with open(run_main.workspace / "report.jsonl") as f:
+        summary = [json.loads(line) for line in f][-1]
+    assert summary["stop_reason"].startswith("pre-flight check failed, space OTHER is not accessible")
+
+def test_main_republishes_a_page_whose_local_files_changed(run_main):
+    docs = run_main.workspace / "docs"
+    os.makedirs(docs / "images")
+    (docs / "images" / "flow.png").write_bytes(b"png 1")
+    (docs / "setup.sh").write_text("echo 1\n")
+    (docs / "a.md").write_text(
+        "<!-- Space: FOO -->\n<!-- Title: A -->\n<!-- Attachment: setup.sh -->\n\n![flow](images/flow.png \"Flow\")\n"
+    )
+    inputs = dict(DOC_DIR="docs", CACHE_DIR=".cache", STAGING="true")
+    assert run_main(**inputs)[1]["success"] == 1
+    assert run_main(**inputs)[1]["unchanged"] == 1
+
+    # only the image changes
+    (docs / "images" / "flow.png").write_bytes(b"png 2")
+    assert run_main(**inputs)[1]["success"] == 1
+    assert run_main(**inputs)[1]["unchanged"] == 1
+
+    # only the attachment changes
+    (docs / "setup.sh").write_text("echo 2\n")
+    assert run_main(**inputs)[1]["success"] == 1
+
+def test_main_publishes_the_largest_files_first_within_time_budget(run_main):
+    docs = run_main.workspace / "docs"
+    os.makedirs(docs)
+    for name, size in [("a.md", 10), ("b.md", 1000), ("c.md", 100)]:
+        (docs / name).write_text(f"<!-- Space: FOO -->\n<!-- Title: {name} -->\n\n{'x' * size}\n")
+
+    # without CACHE_DIR, the size stands for the duration of the last publish
+    rc, counters, spans = run_main(DOC_DIR="docs", TIME_BUDGET="600")
+
+    assert rc == 0
+    assert counters["success"] == 3
+    assert sorted(spans, key=lambda name: spans[name]["start"]) == ["b.md", "c.md", "a.md"]
@@ -0,0 +1,35 @@
+import json
+import pstats
+import subprocess
+import threading
+
+from mark2confluence.profiler import Profiler
+
+def busy_worker():
+    total = 0
+    for index in range(200000):
+        total += index % 7
+    subprocess.run(["sleep", "0.3"])
+
+def test_profiler(tmp_path):
+    with Profiler(str(tmp_path), interval=0.005):
+        thread = threading.Thread(target=busy_worker, name="Thread-7")
+        thread.start()
+        thread.join()
+
+    functions = {function for _, _, function in pstats.Stats(str(tmp_path / "profile.pstats")).stats}
+    # the functions run by the other threads are profiled too
+    assert "busy_worker" in functions
+    assert "busy_worker" in (tmp_path / "profile.txt").read_text()
+
+    stacks = (tmp_path / "stacks.collapsed").read_text().splitlines()
+    worker_stacks = [line for line in stacks if line.startswith("Thread;") and "busy_worker (tests/test_profiler.py)" in line]
+    assert worker_stacks
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in stacks)
+
+    summary = json.loads((tmp_path / "summary.json").read_text())
+    assert summary["wall"] >= 0.3
+    assert 0.2 <= summary["waiting"]["child processes"] <= summary["wall"]
+    assert summary["waiting"]["network"] == 0
+    assert summary["memory"]["peak"] > 0
+    assert (tmp_path / "memory.txt").read_text().startswith("Peak traced memory:")